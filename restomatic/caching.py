@@ -0,0 +1,70 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+    """Thread-safe, size-bounded LRU cache with an optional time-to-live (in seconds) and hit/miss counters"""
+
+    def __init__(self, max_size, ttl=None):
+        if max_size is None or max_size < 1:
+            raise ValueError('Expected max_size for LRUCache to be a positive integer')
+        if ttl is not None and ttl <= 0:
+            raise ValueError('Expected ttl for LRUCache to be a positive number of seconds')
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, is_valid=None):
+        """If is_valid is given, entries for which is_valid(value) is false are removed and counted as misses"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if (expires is not None and expires <= time.monotonic()) or (is_valid is not None and not is_valid(value)):
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'max_size': self.max_size,
+            }
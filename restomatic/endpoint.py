@@ -1,4 +1,14 @@
+import csv
+import hashlib
+import heapq
+import io
+import json
+import sqlite3
+import urllib.parse
+from functools import partial
+
 from .shared_exceptions import StatusMessageException
+from .wsgi_endpoint_router import EncodedResponse, StreamingResponse, get_header
 
 
 class RestOMaticBadRequest(StatusMessageException):
@@ -37,18 +47,140 @@ def restomatic_get(request, db, table_name, **parameters):
     if not parameters.get('allow_all') and not requested_id:
         raise RestOMaticBadRequest('Must specify an ID for this GET request')
 
+    cache_version = None
+    if requested_id:
+        cached_result, cache_version = db.cached_row(table_name, requested_id)
+        if cached_result is not None:
+            return EncodedResponse(cached_result)
+
     query = db.select_all(table_name)
 
     if requested_id:
         query = query.where(('id', 'eq', requested_id))
 
-    result = query.one_or_none_mapped()
-    if result:
-        return result
+    # Serialized straight to bytes, with the router's JSON codec (see register_restomatic_endpoint)
+    row = query.one_or_none()
+    if row is not None:
+        result = query.json_serializer(parameters.get('json_codec')).row_bytes(row)
+        if requested_id:
+            db.cache_row(table_name, requested_id, result, cache_version)
+        return EncodedResponse(result)
     else:
         return {'message': 'Requested ID not found'}, 404
 
 
+def json_search_response(query, row_chunks, keyset_limit=None, json_codec=None):
+    """
+    Generator of the JSON search response, {"results": [...]} (or null if there are none), and "next" for keyset pages,
+    serialized directly from the given chunks of result rows to bytes (with json_codec, if given)
+    """
+    serializer = query.json_serializer(json_codec)
+    row_count = 0
+    last_row = None
+
+    for rows in row_chunks:
+        if not rows:
+            continue
+        yield (b'{"results":[' if not row_count else b',') + serializer.rows_bytes(rows)
+        row_count += len(rows)
+        last_row = rows[-1]
+
+    yield b'{"results":null' if not row_count else b']'
+
+    if keyset_limit:
+        next_token = None
+        if row_count == keyset_limit:
+            next_token = query.next_keyset_token(last_row)
+        yield b',"next":' + json.dumps(next_token).encode('utf-8')
+
+    yield b'}'
+
+
+def stream_json_results(db, query, chunk_size, keyset_limit=None, json_codec=None):
+    # The query is only run once the response starts, on a connection checked out until it finishes,
+    # and at most chunk_size rows are held in memory at once.
+    with db.checkout(read_only=True):
+        yield from json_search_response(query, query.result().chunks(chunk_size), keyset_limit, json_codec)
+
+
+_export_formats = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+}
+
+
+def export_ndjson(query, row_chunks):
+    # One JSON object per line, serialized directly from the result rows
+    serializer = query.json_serializer()
+    for rows in row_chunks:
+        yield ''.join([serializer.row(row) + '\n' for row in rows])
+
+
+def export_csv(query, row_chunks):
+    # A header row of the column names, then one line per row, with empty values for nulls
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(query.data['column_list'])
+
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+
+    if output.tell():
+        yield output.getvalue()
+
+
+def stream_export(db, query, exporter, chunk_size):
+    # As with stream_json_results, at most chunk_size rows are held in memory at once
+    with db.checkout(read_only=True):
+        yield from exporter(query, query.result().chunks(chunk_size))
+
+
+# Supports: GET /example/export?format=csv -> for the whole table (if export set to true in parameters)
+# Or POST /example/export -> for the rows matching where (optional), in order_by order (optional)
+#   body: {'where': [...search criteria...], 'order_by': [...], 'format': 'ndjson' or 'csv'}
+def restomatic_export(request, db, table_name, **parameters):
+    body = request['body']
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) with the export parameters')
+
+    export_format = body.get('format')
+    if export_format is None:
+        export_format = urllib.parse.parse_qs(request['uri']['query']).get('format', ['ndjson'])[0]
+    if not isinstance(export_format, str):
+        raise RestOMaticBadRequest('Must specify the export format as a string, one of: ndjson, csv')
+    if export_format not in _export_formats:
+        raise RestOMaticBadRequest(f'Unsupported export format: {export_format}, expected one of: ndjson, csv')
+
+    query = db.select_all(table_name)
+
+    if body.get('where'):
+        query = query.where(body['where'])
+
+    if 'order_by' in body:
+        query = query.order_by(body['order_by'])
+
+    exporter = export_csv if export_format == 'csv' else export_ndjson
+    content_type, extension = _export_formats[export_format]
+    headers = [
+        ('Content-Type', content_type),
+        ('Content-Disposition', f'attachment; filename="{table_name}.{extension}"'),
+    ]
+
+    chunks = stream_export(db, query, exporter, parameters.get('export_chunk_size', 1000))
+    return StreamingResponse(chunks), 200, headers
+
+
+def search_cache_key(body):
+    # The canonical JSON of the parts of the search body which determine the response
+    return json.dumps({k: body[k] for k in ('where', 'order_by', 'limit', 'offset', 'after') if k in body},
+                      sort_keys=True, separators=(',', ':'))
+
+
 def perform_post(db, table_name, body):
     if not body or not isinstance(body, dict):
         raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) of columns to set for the new row')
@@ -75,12 +207,29 @@ def restomatic_post(request, db, table_name, **parameters):
         if 'order_by' in body:
             query = query.order_by(body['order_by'])
 
-        results = query.all_mapped()
+        # Keyset pagination, use 'after': None for the first page, and then the returned next token
+        keyset_limit = None
+        if 'after' in body:
+            if 'offset' in body:
+                raise RestOMaticBadRequest('Cannot use both offset and after (keyset pagination) in a search')
+            if 'limit' not in body:
+                raise RestOMaticBadRequest('Must specify a limit to use after (keyset pagination) in a search')
+            keyset_limit = query.data['limit']
+            query = query.keyset(body['after'])
 
-        if results:
-            return {'results': results}
-        else:
-            return {'results': None}
+        if parameters.get('stream_search'):
+            return StreamingResponse(stream_json_results(db, query, parameters.get('stream_chunk_size', 1000), keyset_limit,
+                                                         parameters.get('json_codec')))
+
+        search_key = search_cache_key(body)
+        cached_response, cache_token = db.cached_search(table_name, search_key)
+        if cached_response is not None:
+            return EncodedResponse(cached_response)
+
+        response = b''.join(json_search_response(query, [query.all()], keyset_limit, parameters.get('json_codec')))
+        db.cache_search(table_name, search_key, response, cache_token)
+
+        return EncodedResponse(response)
 
     body = request['body']
 
@@ -88,9 +237,12 @@ def restomatic_post(request, db, table_name, **parameters):
         raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) of columns to set for the new row')
 
     if isinstance(body, list):
-        ids = []
         for b in body:
-            ids.append(perform_post(db, table_name, b))
+            if not b or not isinstance(b, dict):
+                raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) of columns to set for the new row')
+
+        # One executemany per set of columns, instead of one insert per row
+        ids = db.insert_many_mapped(table_name, body)
 
         db.commit()
 
@@ -103,16 +255,188 @@ def restomatic_post(request, db, table_name, **parameters):
     return {'success': True, 'id': new_id}, 201
 
 
-def perform_put(db, table_name, body):
-    if not body or not isinstance(body, dict):
-        raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) of columns to set or update')
+# Errors for individual rows (such as constraint violations or unknown columns), which are reported rather than raised
+_row_errors = (sqlite3.Error, StatusMessageException, TypeError, ValueError)
+
+
+class IngestErrors():
+    """
+    The errors of an ingest or import, counted, but keeping only the max_errors with the lowest line numbers, so that
+    memory use does not depend on the number of failing rows. Once abort_after errors (if set) are counted,
+    aborted is set, and no more rows are read.
+    """
+
+    def __init__(self, max_errors, abort_after=None):
+        self.max_errors = max_errors
+        self.abort_after = abort_after
+        self.count = 0
+        self.aborted = False
+        # A heap of (-line number, message), so that the highest line number kept is the first to be replaced
+        self._kept = []
+
+    def append(self, error):
+        line_number, message = error
+        self.count += 1
+        if self.abort_after is not None and self.count >= self.abort_after:
+            self.aborted = True
+
+        if len(self._kept) < self.max_errors:
+            heapq.heappush(self._kept, (-line_number, message))
+        elif self._kept and -self._kept[0][0] > line_number:
+            heapq.heapreplace(self._kept, (-line_number, message))
+
+    def kept(self):
+        """The kept (line number, message) errors, by line number"""
+        return sorted([(-negative_line_number, message) for negative_line_number, message in self._kept])
+
+
+def insert_rows_batch(db, table_name, batch, errors):
+    """
+    Inserts a batch of (line number, row dict) with executemany and commits it, or if that fails, inserts the rows
+    one at a time to find the failing ones, which are appended to errors (stopping at the failure which aborts it).
+    Returns the number of rows inserted.
+    """
+    with db.checkout():
+        try:
+            db.insert_many_mapped(table_name, [row for line_number, row in batch])
+            db.commit()
+            return len(batch)
+        except _row_errors:
+            db.rollback()
+
+        inserted = 0
+        for line_number, row in batch:
+            try:
+                db.insert_mapped(table_name, row, autorun=True)
+                inserted += 1
+            except _row_errors as e:
+                errors.append((line_number, getattr(e, 'message', None) or f'{type(e).__name__}: {e}'))
+                if errors.aborted:
+                    break
+
+        db.commit(no_changes_ok=True)
+        return inserted
+
+
+def ingest_errors(parameters):
+    # Up to ingest_max_errors are listed in the response, and with ingest_abort_errors set, it stops after that many
+    return IngestErrors(parameters.get('ingest_max_errors', 1000), parameters.get('ingest_abort_errors'))
+
+
+def ingest_response(inserted, errors):
+    return {
+        'success': not errors.count,
+        'inserted': inserted,
+        'failed': errors.count,
+        'aborted': errors.aborted,
+        # Parse errors are found before the failed inserts of the same batch, so these are sorted by line number
+        'errors': [{'line': line_number, 'message': message} for line_number, message in errors.kept()],
+    }
+
+
+def ingest_rows(db, table_name, numbered_rows, errors, batch_size):
+    """
+    Inserts the (line number, row dict) pairs in batches, each inserted and committed as soon as it has been read,
+    until errors is aborted (the rows read before that are still inserted)
+    """
+    batch = []
+    inserted = 0
+
+    for numbered_row in numbered_rows:
+        if errors.aborted:
+            break
+        batch.append(numbered_row)
+        if len(batch) >= batch_size:
+            inserted += insert_rows_batch(db, table_name, batch, errors)
+            batch = []
+
+    if batch:
+        inserted += insert_rows_batch(db, table_name, batch, errors)
+
+    return inserted
+
+
+def ndjson_rows(stream, errors):
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            errors.append((line_number, f'Failed to parse JSON: {e}'))
+            continue
+
+        if not row or not isinstance(row, dict):
+            errors.append((line_number, 'Must specify a valid JSON object (dictionary) of columns to set for the new row'))
+            continue
+
+        yield line_number, row
+
+
+def csv_rows(reader, columns, errors):
+    try:
+        for values in reader:
+            if not values:
+                continue
+
+            if len(values) != len(columns):
+                errors.append((reader.line_num, f'Expected {len(columns)} values, got {len(values)}'))
+                continue
+
+            # Empty values are nulls
+            yield reader.line_num, {c: v if v != '' else None for c, v in zip(columns, values)}
+    except (csv.Error, UnicodeDecodeError) as e:
+        # The rest of the file can't be reliably read
+        errors.append((reader.line_num, f'Failed to parse CSV: {e}'))
+
+
+# Supports: POST /example/ingest (if ingest set to true in parameters)
+#   body: newline-delimited JSON objects (NDJSON), one row per line
+def restomatic_ingest(request, db, table_name, **parameters):
+    stream = request['body']
+    if stream is None:
+        raise RestOMaticBadRequest('Must specify newline-delimited JSON objects (dictionaries) of rows to ingest')
 
-    if 'id' in body:
-        update_id = body['id']
-        del body['id']
-        return db.update_mapped(table_name, body).where(('id', 'eq', update_id)).run()
+    errors = ingest_errors(parameters)
+    inserted = ingest_rows(db, table_name, ndjson_rows(stream, errors), errors, parameters.get('ingest_batch_size', 1000))
 
-    return db.insert_mapped(table_name, body, autorun=True)
+    return ingest_response(inserted, errors)
+
+
+# Supports: POST /example/import (if csv_import set to true in parameters)
+#   body: CSV with a header row of column names, and empty values for nulls
+def restomatic_csv_import(request, db, table_name, **parameters):
+    stream = request['body']
+    if stream is None:
+        raise RestOMaticBadRequest('Must specify CSV data with a header row to import')
+
+    # utf-8-sig skips the byte order mark spreadsheet programs often add
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+    try:
+        columns = next(reader, None)
+    except (csv.Error, UnicodeDecodeError) as e:
+        raise RestOMaticBadRequest(f'Failed to parse CSV header: {e}')
+
+    if not columns:
+        raise RestOMaticBadRequest('Must specify CSV data with a header row to import')
+
+    columns = [c.strip() for c in columns]
+    valid_columns = db.table_mappers[table_name]
+    unknown_columns = [c for c in columns if c not in valid_columns]
+    if unknown_columns:
+        raise RestOMaticBadRequest(f'Unknown columns in CSV header: {", ".join(unknown_columns)}, '
+                                   f'expected any of: {", ".join(valid_columns)}')
+    if len(set(columns)) != len(columns):
+        raise RestOMaticBadRequest('Duplicate columns in CSV header')
+
+    errors = ingest_errors(parameters)
+    inserted = ingest_rows(db, table_name, csv_rows(reader, columns, errors), errors,
+                           parameters.get('ingest_batch_size', 1000))
+
+    return ingest_response(inserted, errors)
 
 
 def restomatic_put(request, db, table_name, **parameters):
@@ -130,13 +454,32 @@ def restomatic_put(request, db, table_name, **parameters):
         body = [body]
 
     for b in body:
-        perform_put(db, table_name, b)
+        if not b or not isinstance(b, dict):
+            raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) of columns to set or update')
+
+    # Rows with an id are updated (with one executemany UPDATE per run of rows with the same columns), others are created
+    db.put_many_mapped(table_name, body)
 
     db.commit()
 
+    row_ids = [b['id'] for b in body if b.get('id') is not None]
+    if all([isinstance(row_id, int) for row_id in row_ids]):
+        db.invalidate_rows(table_name, row_ids)
+    else:
+        # Ids given as other types (such as strings) may not match the cached keys
+        db.invalidate_rows(table_name)
+
     return {'success': True}
 
 
+def invalidate_cached_rows(db, table_name, where_parameters):
+    # Only single-ID changes can invalidate just their row, where-based changes clear the table's row cache
+    if isinstance(where_parameters, tuple) and where_parameters[:2] == ('id', 'eq'):
+        db.invalidate_rows(table_name, [where_parameters[2]])
+    else:
+        db.invalidate_rows(table_name)
+
+
 def restomatic_patch(request, db, table_name, **parameters):
     where_parameters, set_values = determine_where_parameters(request, table_name, 'PATCH', set_required=True)
 
@@ -144,6 +487,8 @@ def restomatic_patch(request, db, table_name, **parameters):
 
     db.commit()
 
+    invalidate_cached_rows(db, table_name, where_parameters)
+
     return {'success': True}
 
 
@@ -154,6 +499,8 @@ def restomatic_delete(request, db, table_name, **parameters):
 
     db.commit()
 
+    invalidate_cached_rows(db, table_name, where_parameters)
+
     return {'success': True}
 
 
@@ -197,37 +544,86 @@ def determine_where_parameters(request, table_name, request_type, search_only=Fa
     return where_parameters
 
 
+def generate_rom_etag(db, table_name, search_only=False):
+    # ETags from the table version, so unchanged responses are not regenerated, plus a hash of what was requested
+    def rom_etag(request):
+        if search_only:
+            body = request['body']
+            if detect_id_from_request(request, table_name) != 'search' or not isinstance(body, dict):
+                return None
+            requested = search_cache_key(body)
+        else:
+            requested = request['uri']['path']
+
+        requested_hash = hashlib.blake2b(requested.encode('utf-8'), digest_size=8).hexdigest()
+        return f'{db.table_version(table_name)}-{requested_hash}'
+
+    return rom_etag
+
+
 def generate_rom_get(db, table_name, **parameters):
     def rom_get_wrapper(request):
-        return restomatic_get(request, db, table_name, **parameters)
+        # On a read-only connection, if the db has read_connections
+        with db.checkout(read_only=True):
+            return restomatic_get(request, db, table_name, **parameters)
 
     return rom_get_wrapper
 
 
 def generate_rom_post(db, table_name, **parameters):
     def rom_post_wrapper(request):
-        return restomatic_post(request, db, table_name, **parameters)
+        # Searches (POST /table/search or /table/where) are reads
+        if detect_id_from_request(request, table_name) in ('search', 'where'):
+            with db.checkout(read_only=True):
+                return restomatic_post(request, db, table_name, **parameters)
+
+        # Group committed if enabled on the db (see SQLiteDB.run_write)
+        return db.run_write(partial(restomatic_post, request, db, table_name, **parameters))
 
     return rom_post_wrapper
 
 
+def generate_rom_export(db, table_name, **parameters):
+    def rom_export_wrapper(request):
+        # The connection is checked out when the response starts (see stream_export)
+        return restomatic_export(request, db, table_name, **parameters)
+
+    return rom_export_wrapper
+
+
+def generate_rom_ingest(db, table_name, **parameters):
+    def rom_ingest_wrapper(request):
+        # Connections are checked out for each batch instead, so they are not held while waiting for the upload
+        return restomatic_ingest(request, db, table_name, **parameters)
+
+    return rom_ingest_wrapper
+
+
+def generate_rom_csv_import(db, table_name, **parameters):
+    def rom_csv_import_wrapper(request):
+        # As with ingest, connections are checked out for each batch
+        return restomatic_csv_import(request, db, table_name, **parameters)
+
+    return rom_csv_import_wrapper
+
+
 def generate_rom_put(db, table_name, **parameters):
     def rom_put_wrapper(request):
-        return restomatic_put(request, db, table_name, **parameters)
+        return db.run_write(partial(restomatic_put, request, db, table_name, **parameters))
 
     return rom_put_wrapper
 
 
 def generate_rom_patch(db, table_name, **parameters):
     def rom_patch_wrapper(request):
-        return restomatic_patch(request, db, table_name, **parameters)
+        return db.run_write(partial(restomatic_patch, request, db, table_name, **parameters))
 
     return rom_patch_wrapper
 
 
 def generate_rom_delete(db, table_name, **parameters):
     def rom_delete_wrapper(request):
-        return restomatic_delete(request, db, table_name, **parameters)
+        return db.run_write(partial(restomatic_delete, request, db, table_name, **parameters))
 
     return rom_delete_wrapper
 
@@ -236,13 +632,24 @@ def register_restomatic_endpoint(endpoint_router, db, table_name, allowed_method
     if not db.is_valid_table(table_name):
         raise RuntimeError(f'Unknown table: {table_name}')
 
-    # Note that all operations are always done in one transation
+    # GET and search responses are serialized to bytes with the router's JSON codec
+    parameters.setdefault('json_codec', endpoint_router.json_codec)
+
+    # Note that all operations are always done in one transation,
+    # on a connection checked out for the request if the db is pooled
+    # (or for writes with group commit enabled, in a savepoint of the group's transaction)
     for method in allowed_methods:
         method = method.upper()
         if method == 'GET':
             # GET one: /table/1 (returns 200 if found, 404 if no match)
             endpoint_router.register_endpoint(in_format='json', out_format='json', prefix=f'/{table_name}', method=method,
-                                              func=generate_rom_get(db, table_name, **parameters))
+                                              func=generate_rom_get(db, table_name, **parameters),
+                                              etag=generate_rom_etag(db, table_name) if parameters.get('etags') else None)
+            if parameters.get('export'):
+                # Streams the whole table as NDJSON (or CSV with ?format=csv), fetched in chunks of export_chunk_size rows
+                # GET all: /table/export
+                endpoint_router.register_endpoint(in_format='json', out_format='json', exact=f'/{table_name}/export',
+                                                  method=method, func=generate_rom_export(db, table_name, **parameters))
         elif method == 'POST':
             # This endpoint creates a new row (or multiple new rows) (returns 201)
             # Also supports a get-like search (but without the limits on uri size/format)
@@ -252,8 +659,29 @@ def register_restomatic_endpoint(endpoint_router, db, table_name, allowed_method
             #   body: [{...}, {...}]
             # or POST-based search: /table/search (returns 200 with a list of results if found, otherwise None)
             #   body: {'where': [...search criteria...]}
+            #   (streamed in chunks of stream_chunk_size rows if stream_search is set in the parameters)
+            # (with an ETag if etags is set in the parameters)
             endpoint_router.register_endpoint(in_format='json', out_format='json', prefix=f'/{table_name}', method=method,
-                                              func=generate_rom_post(db, table_name, **parameters))
+                                              func=generate_rom_post(db, table_name, **parameters),
+                                              etag=generate_rom_etag(db, table_name, True) if parameters.get('etags') else None)
+            if parameters.get('export'):
+                # Streams the rows matching where (if given) as NDJSON or CSV
+                # POST-based export: /table/export
+                #   body: {'where': [...search criteria...], 'order_by': [...], 'format': 'csv'}
+                endpoint_router.register_endpoint(in_format='json', out_format='json', exact=f'/{table_name}/export',
+                                                  method=method, func=generate_rom_export(db, table_name, **parameters))
+            if parameters.get('ingest'):
+                # NDJSON bulk load, read and inserted incrementally in batches of ingest_batch_size rows
+                # POST many: /table/ingest
+                #   body: {...}\n{...}\n...
+                endpoint_router.register_endpoint(in_format='stream', out_format='json', exact=f'/{table_name}/ingest',
+                                                  method=method, func=generate_rom_ingest(db, table_name, **parameters))
+            if parameters.get('csv_import'):
+                # CSV bulk load (with a header row of column names), read and inserted the same way as ingest
+                # POST many: /table/import
+                #   body: column1,column2\nvalue1,value2\n...
+                endpoint_router.register_endpoint(in_format='stream', out_format='json', exact=f'/{table_name}/import',
+                                                  method=method, func=generate_rom_csv_import(db, table_name, **parameters))
         elif method == 'PUT':
             # This endpoint can create or update the given rows (returns 200)
             # PUT one: /table
@@ -279,3 +707,88 @@ def register_restomatic_endpoint(endpoint_router, db, table_name, allowed_method
                                               func=generate_rom_delete(db, table_name, **parameters))
         else:
             raise RuntimeError(f'Method {method} not supported!')
+
+
+def register_index_advice_endpoint(endpoint_router, db, path='/_index_advice'):
+    """Registers a GET debug endpoint which returns db.index_advice() (requires index_advisor to be enabled)"""
+    if db.index_advisor is None:
+        raise RuntimeError('Must enable index_advisor on the db to register the index advice endpoint')
+
+    def index_advice_endpoint(request):
+        return db.index_advice()
+
+    endpoint_router.register_endpoint(in_format='json', out_format='json', exact=path, method='GET',
+                                      func=index_advice_endpoint)
+
+
+def run_batch_operations(endpoint_router, db, operations, use_transaction):
+    """
+    Dispatches each operation through the router, returning the encoded responses and whether all succeeded.
+    In a transaction, the first failure rolls back the changes of all operations, and the rest are not run.
+    """
+    responses = []
+    success = True
+
+    for operation in operations:
+        status_code, headers, response_data = endpoint_router.dispatch_internal(operation['method'], operation['path'],
+                                                                                operation.get('body'))
+
+        # JSON responses are included as-is, without decoding them again
+        if not (get_header(headers, 'Content-Type') or '').startswith('application/json'):
+            response_data = json.dumps(response_data.decode('utf-8')).encode('utf-8')
+        responses.append(b'{"status":' + str(status_code).encode('utf-8') + b',"body":' + response_data + b'}')
+
+        if status_code >= 400:
+            success = False
+            # Otherwise any partial changes of a failed operation would be committed by the next one
+            db.rollback()
+            if use_transaction:
+                break
+
+    return responses, success
+
+
+# Supports: POST /_batch (see register_batch_endpoint)
+#   body: {'operations': [{'method': 'GET', 'path': '/table/1'}, {'method': 'PATCH', 'path': '/table/2', 'body': {...}}],
+#          'transaction': True}
+def restomatic_batch(request, endpoint_router, db, batch_path, max_operations):
+    body = request['body']
+    if not isinstance(body, dict) or not isinstance(body.get('operations'), list) or not body['operations']:
+        raise RestOMaticBadRequest('Must specify a valid JSON object (dictionary) with a list of operations')
+
+    operations = body['operations']
+    if len(operations) > max_operations:
+        raise RestOMaticBadRequest(f'Too many operations in one batch, the maximum is {max_operations}')
+
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(operation.get('method'), str) or \
+                not isinstance(operation.get('path'), str):
+            raise RestOMaticBadRequest('Each operation must be a JSON object (dictionary) with a method and a path')
+        if operation['path'].split('?', 1)[0] == batch_path:
+            raise RestOMaticBadRequest('Batches cannot be nested')
+
+    use_transaction = bool(body.get('transaction'))
+
+    # All operations use one connection, and with transaction set, one transaction and one commit
+    with db.checkout():
+        if use_transaction:
+            with db.transaction():
+                responses, success = run_batch_operations(endpoint_router, db, operations, use_transaction)
+        else:
+            responses, success = run_batch_operations(endpoint_router, db, operations, use_transaction)
+
+    return EncodedResponse(b'{"success":' + (b'true' if success else b'false') +
+                           b',"responses":[' + b','.join(responses) + b']}')
+
+
+def register_batch_endpoint(endpoint_router, db, path='/_batch', max_operations=100):
+    """
+    Registers a POST endpoint which runs a list of operations (method, path and optional JSON body) through the
+    router's endpoints, and returns all of their statuses and response bodies. With transaction set, all changes
+    to db are committed together (or not at all if any operation fails).
+    """
+    def batch_endpoint(request):
+        return restomatic_batch(request, endpoint_router, db, path, max_operations)
+
+    endpoint_router.register_endpoint(in_format='json', out_format='json', exact=path, method='POST',
+                                      func=batch_endpoint)
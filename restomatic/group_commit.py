@@ -0,0 +1,184 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Savepoint around each grouped write, so that a failing write only rolls back its own changes
+_SAVEPOINT_NAME = 'grouped_write'
+
+
+class GroupCommitter():
+    """
+    Runs write functions (which make changes and call commit) one at a time on a dedicated writer thread and connection.
+    Writes which arrive within window seconds of the first one of a group (up to max_size writes) share one transaction
+    and one commit. Each write runs in its own savepoint, and its result (or exception) is returned to its caller once
+    the group has been committed.
+    """
+
+    def __init__(self, db, window, max_size=100):
+        if window is None or window < 0:
+            raise ValueError('Expected the group commit window to be a non-negative number of seconds')
+        if max_size is None or max_size < 1:
+            raise ValueError('Expected the group commit max_size to be a positive integer')
+
+        self.db = db
+        self.window = window
+        self.max_size = max_size
+        self.groups = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func):
+        """Runs func on the writer thread, and returns its result (or raises its exception) once committed"""
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='restomatic-group-commit', daemon=True)
+                self._thread.start()
+            self._queue.put((func, future))
+
+        return future.result()
+
+    def close(self):
+        """Stops the writer thread once the writes already submitted are committed"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            if thread is not None:
+                self._queue.put(None)
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'groups': self.groups,
+                'writes': self.writes,
+                'average_group_size': self.writes / self.groups if self.groups else 0.0,
+            }
+
+    def _run(self):
+        local = self.db._local
+        conn = self.db._connect()
+        local.connection = conn
+        local.cursor = None
+        try:
+            running = True
+            while running:
+                item = self._queue.get()
+                if item is None:
+                    break
+
+                futures = []
+                try:
+                    running = self._run_group(item, futures)
+                except Exception as e:
+                    # Unexpected errors (such as from the savepoint statements) fail the whole group
+                    local.after_commit = None
+                    local.savepoint = None
+                    if conn.in_transaction:
+                        conn.rollback()
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            local.connection = None
+            local.cursor = None
+            conn.close()
+
+    def _run_group(self, item, futures):
+        # Runs the write, and any others which arrive within the window, in one transaction, adding their futures
+        # to futures as they are taken from the queue. Returns False if the committer was closed while waiting.
+        db = self.db
+        local = db._local
+        futures.append(item[1])
+
+        try:
+            db.execute('BEGIN IMMEDIATE')
+        except Exception as e:
+            item[1].set_exception(e)
+            return True
+
+        # Defers the commit calls (and row cache invalidations) of the writes, as in SQLiteDB.transaction
+        local.after_commit = []
+        completed = []
+        running = True
+        deadline = time.perf_counter() + self.window
+
+        while True:
+            func, future = item
+            result, exception = self._run_write(func)
+            completed.append((future, result, exception))
+
+            if not db.in_transaction():
+                # Some errors (such as a full disk) make SQLite roll back the whole transaction
+                local.after_commit = None
+                error = exception or RuntimeError('The group commit transaction was rolled back')
+                for future, result, exception in completed:
+                    future.set_exception(error)
+                return running
+
+            if len(completed) >= self.max_size:
+                break
+
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is None:
+                running = False
+                break
+            futures.append(item[1])
+
+        after_commit = local.after_commit
+        local.after_commit = None
+        try:
+            db.commit(no_changes_ok=True)
+        except Exception as e:
+            db.rollback()
+            for future, result, exception in completed:
+                future.set_exception(e)
+            return running
+
+        with self._lock:
+            self.groups += 1
+            self.writes += len(completed)
+
+        for func in after_commit:
+            func()
+
+        for future, result, exception in completed:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        return running
+
+    def _run_write(self, func):
+        db = self.db
+        local = db._local
+
+        db.execute(f'SAVEPOINT {_SAVEPOINT_NAME}')
+        local.savepoint = (_SAVEPOINT_NAME, len(local.after_commit))
+        try:
+            result = func()
+        except Exception as e:
+            if db.in_transaction():
+                # Only to the savepoint (see SQLiteDB.rollback)
+                db.rollback()
+                db.execute(f'RELEASE {_SAVEPOINT_NAME}')
+            local.savepoint = None
+            return None, e
+
+        local.savepoint = None
+        db.execute(f'RELEASE {_SAVEPOINT_NAME}')
+        return result, None
@@ -0,0 +1,136 @@
+import sqlite3
+import threading
+
+# Operators which can use an index for an exact match (and so go first in a suggested index)
+_equality_operators = ('eq', '=', '==', 'in', 'isnull', 'is_null')
+
+# Operators which can use an index for a range scan (only one per index can)
+_range_operators = ('lt', '<', 'gt', '>', 'lte', '<=', 'gte', '>=')
+
+
+def conjunctive_column_usage(selector, equality_columns, range_columns):
+    """
+    Collects the columns compared in the AND-ed terms of a JSON-style where selector (see generate_selector)
+    into equality_columns and range_columns, in order. OR branches are skipped, as one index can't serve them.
+    """
+    if isinstance(selector, dict):
+        for kind, s_list in selector.items():
+            if kind.upper() == 'AND':
+                for s in s_list:
+                    conjunctive_column_usage(s, equality_columns, range_columns)
+        return
+
+    column = selector[0]
+    operator = selector[1].lower()
+
+    if operator in _equality_operators:
+        if column not in equality_columns:
+            equality_columns.append(column)
+    elif operator in _range_operators:
+        if column not in range_columns:
+            range_columns.append(column)
+
+
+def suggest_index_columns(where_selector, order_by):
+    """Index columns for a query: equality columns first, then the order by columns, then the first range column"""
+    equality_columns = []
+    range_columns = []
+    if where_selector is not None:
+        conjunctive_column_usage(where_selector, equality_columns, range_columns)
+
+    columns = list(equality_columns)
+    for column, direction in order_by or []:
+        if column not in columns:
+            columns.append(column)
+    for column in range_columns[:1]:
+        if column not in columns:
+            columns.append(column)
+
+    return columns
+
+
+def create_index_statement(table_name, columns):
+    index_name = '_'.join(['idx', table_name] + list(columns))
+    escaped_columns = ','.join([f'"{c}"' for c in columns])
+    return f'CREATE INDEX IF NOT EXISTS "{index_name}" ON {table_name}({escaped_columns})'
+
+
+class IndexAdvisor():
+    """
+    Runs EXPLAIN QUERY PLAN once for each new statement, recording full table scans (of filtered queries)
+    and temporary B-tree sorts, and suggests an index on the columns of the where clause and order by.
+    """
+
+    def __init__(self, max_statements=1000):
+        self.max_statements = max_statements
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    def analyze(self, connection, query, query_str, fill_values):
+        """Called for each statement run, the query plan is only read for statements not analyzed since the last clear"""
+        with self._lock:
+            if query_str in self.statements or len(self.statements) >= self.max_statements:
+                return
+
+        try:
+            plan = connection.execute(f'EXPLAIN QUERY PLAN {query_str}', fill_values).fetchall()
+        except sqlite3.Error:
+            # The statement itself will raise the error when it is run
+            return
+
+        details = [row[3] for row in plan]
+        order_by = query.data['order_by']
+
+        # Scans through an index (such as one which matches the order by) are not full table scans
+        full_scan = query.data['where'] is not None and any([d.startswith('SCAN') and ' USING ' not in d for d in details])
+        temp_b_tree = any(['USE TEMP B-TREE' in d for d in details])
+
+        suggested_index = None
+        if full_scan or temp_b_tree:
+            columns = suggest_index_columns(query.where_selector, order_by)
+            if columns:
+                suggested_index = create_index_statement(query.table_name, columns)
+
+        finding = {
+            'table': query.table_name,
+            'plan': details,
+            'full_scan': full_scan,
+            'temp_b_tree': temp_b_tree,
+            'suggested_index': suggested_index,
+        }
+
+        with self._lock:
+            self.statements.setdefault(query_str, finding)
+
+    def advice(self):
+        """
+        Findings by table, for tables with any: statements which do full table scans,
+        statements which sort with a temporary B-tree, and the suggested CREATE INDEX statements
+        """
+        tables = {}
+        with self._lock:
+            findings = list(self.statements.items())
+
+        for query_str, finding in findings:
+            if not finding['full_scan'] and not finding['temp_b_tree']:
+                continue
+
+            table_advice = tables.setdefault(finding['table'], {
+                'full_scans': [],
+                'temp_b_tree_sorts': [],
+                'suggested_indexes': [],
+            })
+            if finding['full_scan']:
+                table_advice['full_scans'].append(query_str)
+            if finding['temp_b_tree']:
+                table_advice['temp_b_tree_sorts'].append(query_str)
+            suggested_index = finding['suggested_index']
+            if suggested_index and suggested_index not in table_advice['suggested_indexes']:
+                table_advice['suggested_indexes'].append(suggested_index)
+
+        return tables
+
+    def clear(self):
+        """Forgets all analyzed statements, such as after creating the suggested indexes"""
+        with self._lock:
+            self.statements.clear()
@@ -0,0 +1,68 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibJSONCodec():
+    """JSON codec using the standard library json module"""
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonJSONCodec():
+    """
+    JSON codec using orjson, which encodes straight to UTF-8 bytes. Data orjson can't encode (such as integers
+    over 64 bits) falls back to the json module. Note that orjson writes NaN and Infinity as null (unlike the json
+    module, which writes them as NaN and Infinity), which is why it is opt-in.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError('orjson is not installed')
+
+    def dumps(self, data):
+        try:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(data).encode('utf-8')
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # For the same error messages as the json module
+            return json.loads(data)
+
+
+_codecs = {
+    'json': StdlibJSONCodec,
+    'orjson': OrjsonJSONCodec,
+}
+
+
+def get_json_codec(codec=None):
+    """
+    Returns the codec with the given name ('json' or 'orjson'), or the given codec object (with dumps returning bytes,
+    and loads), or by default the json module one
+    """
+    if codec is None:
+        codec = 'json'
+
+    if isinstance(codec, str):
+        if codec not in _codecs:
+            raise ValueError(f'Unknown JSON codec: {codec}, expected one of: {", ".join(_codecs.keys())}')
+        return _codecs[codec]()
+
+    if not hasattr(codec, 'dumps') or not hasattr(codec, 'loads'):
+        raise TypeError('Expected the JSON codec to have dumps and loads methods')
+
+    return codec
@@ -1,24 +1,81 @@
+import base64
+import json
+import os
+import queue
 import sqlite3
-
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from functools import partial
+
+from .caching import LRUCache
+from .group_commit import GroupCommitter
+from .index_advisor import IndexAdvisor
+from .json_codec import StdlibJSONCodec
 from .validations import type_pos_int, type_non_neg_int, expect_in, expect_type, expect_len_range, cast_expect_type
 from .shared_exceptions import StatusMessageException
 
 
-def _process_values(values, processors, column_list, context):
-    if not values or not processors:
-        return values
+class ProcessorPipeline():
+    """
+    Pre- or postprocessors resolved once for a column list into (position, callables) steps,
+    so that processing a row is only a loop over the processed columns.
+    """
 
-    if isinstance(values, (list, tuple)):
-        if isinstance(values[0], (list, tuple, dict)):
-            return [_process_values(v, processors, column_list, context) for v in values]
+    def __init__(self, processors, column_list, context=None):
+        self.context = context or {}
 
-        processors = {i: processors[c] for i, c in enumerate(column_list) if c in processors}
-        iterator = range(len(values))
-        values = list(values)
-    else:
-        iterator = values.keys()
+        steps = []
+        if processors and column_list:
+            for i, c in enumerate(column_list):
+                if c in processors:
+                    p_list = processors[c]
+                    if not isinstance(p_list, (list, tuple)):
+                        p_list = [p_list]
+                    steps.append((i, tuple(p_list)))
+
+        self.steps = tuple(steps)
+
+    def process_row(self, row):
+        if not self.steps:
+            return row
+
+        # Returned as a list, as it needs to be mutable for the processors to run
+        row = list(row)
+        context = self.context
+        for i, p_list in self.steps:
+            value = row[i]
+            for p in p_list:
+                value = p(value, **context) if context else p(value)
+            row[i] = value
+
+        return row
+
+    def process_rows(self, rows):
+        if not self.steps:
+            return rows
+
+        process_row = self.process_row
+        return [process_row(row) for row in rows]
+
+    def process(self, values):
+        # Either one row, or a list of rows
+        if not values or not self.steps:
+            return values
+
+        if isinstance(values[0], (list, tuple)):
+            return self.process_rows(values)
+
+        return self.process_row(values)
+
+
+def _process_mapped_values(values, processors, context):
+    # For dictionaries of column name to value (one row)
+    if not values or not processors:
+        return values
 
-    for key in iterator:
+    for key in values.keys():
         if key in processors:
             p_list = processors[key]
             if not isinstance(p_list, (list, tuple)):
@@ -32,20 +89,39 @@ def _process_values(values, processors, column_list, context):
 class SQLResult():
     """Result object from SQLite queries"""
 
-    def __init__(self, result_cursor, postprocessors=None, column_list=None):
+    def __init__(self, result_cursor, postprocessors=None, column_list=None, metrics=None, statement=None):
         self.result_cursor = result_cursor
-        self.postprocessors = postprocessors
         self.column_list = column_list
 
-    def _postprocess_values(self, values):
-        return _process_values(values, self.postprocessors, self.column_list, context={})
+        # Either a compiled ProcessorPipeline, or the postprocessors dict for the table
+        if not isinstance(postprocessors, ProcessorPipeline):
+            postprocessors = ProcessorPipeline(postprocessors, column_list)
+        self.pipeline = postprocessors
+
+        # For counting rows returned by the statement, if metrics are enabled
+        self.metrics = metrics
+        self.statement = statement
+        self._iterated_rows = 0
+
+    def _count_rows(self, count):
+        if self.metrics is not None:
+            self.metrics.record_rows_returned(self.statement, count)
 
     # This can be used as a iterator, WILL run the postprocessors
     def __iter__(self):
         return self
 
     def __next__(self):
-        return self._postprocess_values(next(self.result_cursor))
+        try:
+            row = next(self.result_cursor)
+        except StopIteration:
+            # Counted once at the end, rather than once per row
+            self._count_rows(self._iterated_rows)
+            self._iterated_rows = 0
+            raise
+
+        self._iterated_rows += 1
+        return self.pipeline.process_row(row)
 
     # Convenience functions for getting certain numbers of results, WILL run the postprocessors
     def one_or_none(self):
@@ -62,43 +138,350 @@ class SQLResult():
         if self.result_cursor.fetchone():
             raise SQLCompositorBadResult('Found too many results for query, where at most one was expected')
 
-        return self._postprocess_values(first_row)
+        self._count_rows(1)
+        return self.pipeline.process_row(first_row)
 
     def all(self):
-        return self._postprocess_values(self.result_cursor.fetchall())
+        rows = self.result_cursor.fetchall()
+        self._count_rows(len(rows))
+        return self.pipeline.process_rows(rows)
+
+    def chunks(self, size):
+        """Generator of lists of up to size rows, fetched as needed, WILL run the postprocessors"""
+        while True:
+            rows = self.result_cursor.fetchmany(size)
+            if not rows:
+                return
+            self._count_rows(len(rows))
+            yield self.pipeline.process_rows(rows)
 
     # Built-in functions in sqlite3, note that these DO NOT run the postprocessors, for raw data access
     def lastrowid(self):
         return self.result_cursor.lastrowid
 
     def fetchone(self):
-        return self.result_cursor.fetchone()
+        row = self.result_cursor.fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
 
     def fetchmany(self, size=None):
         if not size:
-            return self.result_cursor.fetchmany()
+            rows = self.result_cursor.fetchmany()
+        else:
+            rows = self.result_cursor.fetchmany(size)
 
-        return self.result_cursor.fetchmany(size)
+        self._count_rows(len(rows))
+        return rows
 
     def fetchall(self):
-        return self.result_cursor.fetchall()
+        rows = self.result_cursor.fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+
+# Row value comparisons, such as (a, b) > (?, ?), require SQLite 3.15.0+
+_row_values_supported = sqlite3.sqlite_version_info >= (3, 15, 0)
+
+# Named PRAGMA settings applied to every new connection, see SQLiteDB(pragma_profile=..., pragmas=...)
+PRAGMA_PROFILES = {
+    'read-heavy': {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,  # Negative values are in KiB, so 64 MiB
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    },
+    'write-heavy': {
+        'busy_timeout': 10000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16384,
+        'mmap_size': 67108864,
+        'temp_store': 'MEMORY',
+    },
+}
+
+# In the order they are applied, busy_timeout first so that changing the journal mode can wait for other connections
+_pragma_validators = {
+    'busy_timeout': type_non_neg_int,
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+    'cache_size': int,
+    'mmap_size': type_non_neg_int,
+    'temp_store': ('DEFAULT', 'FILE', 'MEMORY'),
+}
+
+
+def compile_pragmas(pragma_profile=None, pragmas=None):
+    """Returns the list of PRAGMA statements for the given profile name (or dict), with any overrides from pragmas"""
+    settings = {}
+
+    if pragma_profile:
+        if isinstance(pragma_profile, str):
+            expect_in(pragma_profile, PRAGMA_PROFILES, 'pragma profile')
+            pragma_profile = PRAGMA_PROFILES[pragma_profile]
+        expect_type(pragma_profile, dict, 'pragma profile')
+        settings.update(pragma_profile)
+
+    if pragmas:
+        expect_type(pragmas, dict, 'pragmas')
+        settings.update(pragmas)
+
+    statements = []
+    for name, validator in _pragma_validators.items():
+        if name not in settings:
+            continue
+
+        value = settings.pop(name)
+        if isinstance(validator, tuple):
+            value = str(value).upper()
+            expect_in(value, validator, f'{name} pragma value')
+        else:
+            value = cast_expect_type(value, validator, f'{name} pragma value')
+
+        statements.append(f'PRAGMA {name} = {value}')
+
+    if settings:
+        raise SQLCompositorBadInput('Unsupported pragma(s): ' + ', '.join(sorted(settings.keys())))
+
+    return statements
+
+
+class ConnectionPool():
+    """Bounded pool of SQLite connections, which can be checked out by one thread at a time"""
+
+    def __init__(self, connect, size, timeout=None):
+        if not size or size < 1:
+            raise SQLCompositorBadInput('Connection pool size must be a positive integer')
+
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def acquire(self):
+        start = time.perf_counter()
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is None:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise SQLCompositorPoolTimeout(f'Timed out waiting {self.timeout}s for a database connection')
+
+        wait_time = time.perf_counter() - start
+        with self._lock:
+            self.checkouts += 1
+            if wait_time > 0.001:
+                self.waits += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        return conn
+
+    def release(self, conn):
+        # Uncommitted changes are never carried over to the next user of the connection
+        if conn.in_transaction:
+            conn.rollback()
+
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._created,
+                'idle': self._idle.qsize(),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'total_wait_time': self.total_wait_time,
+                'max_wait_time': self.max_wait_time,
+                'average_wait_time': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+            }
+
+
+def _consecutive_runs(rows, func_name):
+    # Groups consecutive row dicts with the same columns, so that they can be written in order with executemany
+    runs = []
+    for row in rows:
+        expect_type(row, dict, f'{func_name} input row dictionary')
+        if not row:
+            raise SQLCompositorBadInput(f'Must provide at least one column value for each row for {func_name}')
+        if runs and runs[-1][0] == row.keys():
+            runs[-1][1].append(row)
+        else:
+            runs.append((row.keys(), [row]))
+    return runs
+
+
+def _table_cache_stats(caches):
+    stats = {}
+    for table_name, cache in caches.items():
+        table_stats = cache.stats()
+        lookups = table_stats['hits'] + table_stats['misses']
+        table_stats['hit_rate'] = table_stats['hits'] / lookups if lookups else 0.0
+        stats[table_name] = table_stats
+    return stats
 
 
 class SQLiteDB():
     """SQLite Database interface to auto-generate queries and results"""
 
     def __init__(self, db_path, table_mappers, preprocessors=None, postprocessors=None,
-                 enable_foreign_key_constraints=False):
+                 enable_foreign_key_constraints=False, statement_cache_size=256, cached_statements=None,
+                 pool_size=None, pool_timeout=None, pragma_profile=None, pragmas=None, metrics=None,
+                 index_advisor=False, row_cache=None, search_cache=None, group_commit_window=None,
+                 group_commit_max_size=100, read_connections=None):
+        # Set before any validation, so that close (called from __del__) is always safe
+        self.current_connection = None
+        self.current_cursor = None
+        self.pool = None
+        self.read_pool = None
+        self._data_version_connection = None
+        self.group_committer = None
+
         self.db_path = db_path
         if not table_mappers:
             raise SQLCompositorBadInput('Must define table_mappers to use this interface')
-        self.table_mappers = table_mappers
-        self.current_connection = None
-        self.current_cursor = None
+
+        # Tables can be defined by a list of columns, or by a dict with their types and indexes (see TableSchema)
+        self.table_mappers = {}
+        self.table_schemas = {}
+        for table_name, mapper in table_mappers.items():
+            if isinstance(mapper, dict):
+                schema = TableSchema(table_name, mapper)
+                self.table_schemas[table_name] = schema
+                mapper = schema.columns
+            self.table_mappers[table_name] = mapper
+
         self.enable_foreign_key_constraints = enable_foreign_key_constraints
+        self.connection_pragmas = compile_pragmas(pragma_profile, pragmas)
         self.preprocessors = preprocessors
         self.postprocessors = postprocessors
 
+        # Compiled SQL strings by query shape (see SQLQuery.shape_key), set statement_cache_size to 0 to disable
+        self.statement_cache = None
+        if statement_cache_size:
+            self.statement_cache = LRUCache(statement_cache_size)
+
+        # Compiled ProcessorPipelines by table, column list and mode
+        self.pipeline_cache = LRUCache(1024)
+
+        # JSONRowSerializers by column list and JSON codec
+        self.serializer_cache = LRUCache(256)
+
+        # Size of the sqlite3 prepared statement cache per connection (None uses the sqlite3 default)
+        self.cached_statements = cached_statements
+
+        # In pooled mode, each thread checks out its own connection (see checkout), otherwise one connection is shared
+        self._local = threading.local()
+        self._shared_connection_lock = threading.RLock()
+        if pool_size:
+            if db_path in ('', ':memory:'):
+                raise SQLCompositorBadInput('Connection pools require a database file, '
+                                            'as each in-memory connection is a separate database')
+            self.pool = ConnectionPool(partial(self._connect, check_same_thread=False), pool_size, pool_timeout)
+
+        # Optional pool of read-only connections, checked out with checkout(read_only=True), with one writer connection
+        if read_connections:
+            if db_path in ('', ':memory:'):
+                raise SQLCompositorBadInput('Read connections require a database file, '
+                                            'as each in-memory connection is a separate database')
+            if pool_size:
+                raise SQLCompositorBadInput('Cannot use pool_size with read_connections, which use one writer connection')
+            if group_commit_window is not None:
+                raise SQLCompositorBadInput('Cannot use group_commit_window with read_connections, '
+                                            'as group commit uses its own writer connection')
+            # The shared connection is the one writer connection, used by one thread at a time (see checkout)
+            self.read_pool = ConnectionPool(partial(self._connect, check_same_thread=False, read_only=True),
+                                            read_connections, pool_timeout)
+
+        # Optional per-table caches of serialized rows by id for GET requests, e.g. {'test': {'max_size': 10000, 'ttl': 60}}
+        self.row_caches = {}
+        # Bumped on each invalidation, so that rows read before a write are not cached after it
+        self._row_cache_versions = {}
+        self._row_cache_lock = threading.Lock()
+        for table_name, options in (row_cache or {}).items():
+            if not self.is_valid_table(table_name):
+                raise SQLCompositorBadInput(f'Unknown table for row_cache: {table_name}')
+            expect_type(options, dict, f'row_cache options for {table_name}')
+            self.row_caches[table_name] = LRUCache(options.get('max_size', 1024), options.get('ttl'))
+            self._row_cache_versions[table_name] = 0
+
+        # Optional per-table caches of serialized search responses by search body, e.g. {'test': {'max_size': 256}},
+        # which are valid until the data version (see search_cache_token) changes
+        self.search_caches = {}
+        for table_name, options in (search_cache or {}).items():
+            if not self.is_valid_table(table_name):
+                raise SQLCompositorBadInput(f'Unknown table for search_cache: {table_name}')
+            expect_type(options, dict, f'search_cache options for {table_name}')
+            self.search_caches[table_name] = LRUCache(options.get('max_size', 256), options.get('ttl'))
+
+        # Writes by table through SQLQuery, and the connection used only to read PRAGMA data_version
+        self._table_write_counts = {}
+        self._data_version_lock = threading.Lock()
+
+        # Distinguishes the data versions of this instance from those of other instances and processes (for ETags)
+        self.instance_id = os.urandom(8).hex()
+
+        # Optional restomatic.metrics.Metrics instance, to record statement counts, latencies and rows
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.add_collector(self._collect_metrics)
+
+        # Opt-in EXPLAIN QUERY PLAN analysis of each new SELECT/UPDATE/DELETE statement (see index_advice)
+        self.index_advisor = None
+        if index_advisor:
+            self.index_advisor = IndexAdvisor()
+
+        # Opt-in group commit of writes run with run_write: those arriving within group_commit_window seconds
+        # share one transaction and one commit, on a dedicated writer connection (see GroupCommitter)
+        if group_commit_window is not None:
+            if db_path in ('', ':memory:'):
+                raise SQLCompositorBadInput('Group commit requires a database file, '
+                                            'as each in-memory connection is a separate database')
+            self.group_committer = GroupCommitter(self, group_commit_window, group_commit_max_size)
+
     def __enter__(self):
         return self
 
@@ -106,7 +489,11 @@ class SQLiteDB():
         self.close()
 
     def __del__(self):
-        self.close()
+        try:
+            self.close()
+        except sqlite3.ProgrammingError:
+            # The garbage collector can run this on any thread, where a single-thread connection can't be closed
+            pass
 
     def is_valid_table(self, table_name):
         return table_name in self.table_mappers
@@ -121,6 +508,31 @@ class SQLiteDB():
             return None
         return self.postprocessors.get(table_name)
 
+    def get_processor_pipeline(self, table_name, column_list, mode):
+        """
+        Compiled processors for the given columns, postprocessors for mode SELECT,
+        otherwise preprocessors (with mode 'INSERT INTO', 'UPDATE' or 'WHERE' in their context)
+        """
+        key = (table_name, tuple(column_list), mode)
+        pipeline = self.pipeline_cache.get(key)
+        if pipeline is None:
+            if mode == 'SELECT':
+                pipeline = ProcessorPipeline(self.get_postprocessors(table_name), column_list)
+            else:
+                pipeline = ProcessorPipeline(self.get_preprocessors(table_name), column_list, {'db': self, 'mode': mode})
+            self.pipeline_cache.set(key, pipeline)
+
+        return pipeline
+
+    def get_json_serializer(self, column_list, json_codec=None):
+        key = (tuple(column_list), json_codec)
+        serializer = self.serializer_cache.get(key)
+        if serializer is None:
+            serializer = JSONRowSerializer(column_list, json_codec)
+            self.serializer_cache.set(key, serializer)
+
+        return serializer
+
     def select_all(self, table_name):
         return SQLQuery('SELECT', table_name, self).column_list(self.table_mappers[table_name])
 
@@ -153,27 +565,449 @@ class SQLiteDB():
         else:
             return SQLQuery('INSERT INTO', table_name, self).column_list(list(data.keys())).values_mapped(data, autorun=autorun)
 
+    def insert_many_mapped(self, table_name, rows):
+        """
+        Inserts the given row dicts with one executemany statement per distinct set of columns,
+        and returns the id of each new row, in the same order as the given rows.
+        """
+        expect_type(rows, (list, tuple), 'insert_many_mapped rows')
+
+        groups = {}
+        for position, row in enumerate(rows):
+            expect_type(row, dict, 'insert_many_mapped input row dictionary')
+            if not row:
+                raise SQLCompositorBadInput('Must provide at least one column value for each row to insert')
+            groups.setdefault(frozenset(row.keys()), []).append(position)
+
+        ids = [None] * len(rows)
+
+        for positions in groups.values():
+            columns = list(rows[positions[0]].keys())
+            query = SQLQuery('INSERT INTO', table_name, self).column_list(columns)
+            query.values_mapped([rows[p] for p in positions], autorun=False)
+
+            given_ids = None
+            if 'id' in columns:
+                id_index = columns.index('id')
+                given_ids = [values[id_index] for values in query.data['values']]
+
+            if given_ids is None:
+                query.run()
+                # Rows inserted by one statement get consecutive ids, ending with the last inserted one
+                last_id = self.execute('SELECT last_insert_rowid()').one()[0]
+                for i, p in enumerate(positions):
+                    ids[p] = last_id - len(positions) + 1 + i
+            elif all([isinstance(i, int) and not isinstance(i, bool) for i in given_ids]):
+                # Given integer ids are the new rows' ids
+                query.run()
+                for p, given_id in zip(positions, given_ids):
+                    ids[p] = given_id
+            else:
+                # Otherwise (such as null ids, which SQLite assigns), each row is inserted on its own to get its id
+                for p in positions:
+                    SQLQuery('INSERT INTO', table_name, self).column_list(columns).values_mapped(rows[p], autorun=True)
+                    ids[p] = self.execute('SELECT last_insert_rowid()').one()[0]
+
+        return ids
+
+    def put_many_mapped(self, table_name, rows):
+        """
+        Updates the existing row for each row dict with an id (skipping ids which do not exist) and inserts the others,
+        in order, with one executemany statement per consecutive run of rows with the same set of columns
+        """
+        expect_type(rows, (list, tuple), 'put_many_mapped rows')
+
+        for columns, run_rows in _consecutive_runs(rows, 'put_many_mapped'):
+            if 'id' in columns:
+                SQLQuery('UPDATE', table_name, self).set_values_many(run_rows, 'id').run()
+            else:
+                SQLQuery('INSERT INTO', table_name, self).column_list(list(columns)).values_mapped(run_rows, autorun=True)
+
     def delete(self, table_name):
         # TODO: Delete-all protection?
         return SQLQuery('DELETE', table_name, self)
 
     def connection(self):
+        bound_connection = getattr(self._local, 'connection', None)
+        if bound_connection is not None:
+            return bound_connection
+
+        read_connection = getattr(self._local, 'read_connection', None)
+        if read_connection is not None:
+            return read_connection
+
+        return self._shared_connection()
+
+    def _shared_connection(self):
         if not self.current_connection:
-            self.current_connection = sqlite3.connect(self.db_path)
+            # Can be used from any thread, one at a time (see checkout)
+            self.current_connection = self._connect(check_same_thread=False)
 
         return self.current_connection
 
+    def _connect(self, check_same_thread=True, read_only=False):
+        kwargs = {'check_same_thread': check_same_thread}
+        if self.cached_statements is not None:
+            kwargs['cached_statements'] = self.cached_statements
+
+        if read_only:
+            conn = sqlite3.connect(f'file:{urllib.request.pathname2url(self.db_path)}?mode=ro', uri=True, **kwargs)
+        else:
+            conn = sqlite3.connect(self.db_path, **kwargs)
+
+        for pragma in self.connection_pragmas:
+            if read_only and pragma.startswith('PRAGMA journal_mode'):
+                # Set on the database file by the writer, and can't be changed by a read-only connection
+                continue
+            conn.execute(pragma)
+
+        if self.enable_foreign_key_constraints:
+            conn.execute('PRAGMA foreign_keys = ON')
+
+        return conn
+
+    def _active_connection(self):
+        # The connection that commit/rollback apply to, without opening a new one
+        bound_connection = getattr(self._local, 'connection', None)
+        if bound_connection is not None:
+            return bound_connection
+
+        read_connection = getattr(self._local, 'read_connection', None)
+        if read_connection is not None:
+            return read_connection
+
+        return self.current_connection
+
+    @contextmanager
+    def checkout(self, read_only=False):
+        """
+        Checks out a pooled connection for the current thread, which all queries, commits and rollbacks
+        in this thread then use until the block exits. Any uncommitted changes are rolled back on exit.
+        Re-entrant, and without a pool this locks the shared connection for the current thread instead.
+        With read_only (and read_connections set), a read-only connection is checked out instead, until the
+        first write through the compositor (such as insert or update), which checks out the writer connection
+        for the rest of the block. Within a writer checkout, queries always use the writer, to see its changes.
+        """
+        if read_only and self.read_pool is not None and getattr(self._local, 'connection', None) is None:
+            if getattr(self._local, 'read_connection', None) is not None:
+                yield self._local.read_connection
+                return
+
+            conn = self.read_pool.acquire()
+            self._local.read_connection = conn
+            self._local.read_cursor = None
+            try:
+                yield conn
+            finally:
+                self._local.read_connection = None
+                self._local.read_cursor = None
+                self.read_pool.release(conn)
+                self._release_upgraded_writer()
+            return
+
+        if getattr(self._local, 'connection', None) is not None:
+            yield self.connection()
+            return
+
+        if self.pool is None:
+            # The shared connection is used by one thread at a time (such as the pool threads of the ASGI application)
+            with self._shared_connection_lock:
+                if self.read_pool is None:
+                    yield self.connection()
+                    return
+
+                # With read connections, the shared connection is the writer, bound to this thread as a pooled one is
+                conn = self._shared_connection()
+                self._local.connection = conn
+                self._local.cursor = None
+                try:
+                    yield conn
+                finally:
+                    self._local.connection = None
+                    self._local.cursor = None
+                    if conn.in_transaction:
+                        conn.rollback()
+            return
+
+        conn = self.pool.acquire()
+        self._local.connection = conn
+        self._local.cursor = None
+        try:
+            yield conn
+        finally:
+            self._local.connection = None
+            self._local.cursor = None
+            self.pool.release(conn)
+
+    def use_writer(self):
+        """Checks out the writer connection for the rest of a read-only checkout, called before compositor writes"""
+        if getattr(self._local, 'read_connection', None) is None or getattr(self._local, 'connection', None) is not None:
+            return
+
+        self._shared_connection_lock.acquire()
+        self._local.connection = self._shared_connection()
+        self._local.cursor = None
+        self._local.upgraded_writer = True
+
+    def _release_upgraded_writer(self):
+        if not getattr(self._local, 'upgraded_writer', False):
+            return
+
+        conn = self._local.connection
+        self._local.connection = None
+        self._local.cursor = None
+        self._local.upgraded_writer = False
+
+        # As with pooled connections, uncommitted changes are not carried over to the next user
+        if conn.in_transaction:
+            conn.rollback()
+        self._shared_connection_lock.release()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in one transaction, on one (checked out) connection: commit calls within it are deferred,
+        and everything is committed once when the block exits (or rolled back if it raises). Row cache invalidations
+        are also deferred until after the commit (see after_commit). A rollback within the block rolls back all of
+        its changes so far. Nested transaction blocks are part of the outer one.
+        """
+        if getattr(self._local, 'after_commit', None) is not None:
+            yield
+            return
+
+        with self.checkout():
+            if not self.in_transaction():
+                self.execute('BEGIN')
+            self._local.after_commit = []
+            try:
+                yield
+            except BaseException:
+                self._local.after_commit = None
+                self.rollback()
+                raise
+
+            after_commit = self._local.after_commit
+            self._local.after_commit = None
+            self.commit(no_changes_ok=True)
+
+        for func in after_commit:
+            func()
+
+    def run_write(self, func):
+        """
+        Runs func (which makes changes and commits them) and returns its result, on a checked out connection,
+        or with group commit enabled, on the writer connection as part of the next group commit (returning once
+        committed). Writes within a transaction block are run as part of it.
+        """
+        if self.group_committer is None or getattr(self._local, 'after_commit', None) is not None:
+            with self.checkout():
+                return func()
+
+        return self.group_committer.submit(func)
+
+    def group_commit_stats(self):
+        if self.group_committer is None:
+            return None
+
+        return self.group_committer.stats()
+
+    def after_commit(self, func):
+        """Calls func once the current transaction block (see transaction) has committed, or now if not in one"""
+        after_commit = getattr(self._local, 'after_commit', None)
+        if after_commit is None:
+            func()
+        else:
+            after_commit.append(func)
+
+    def migrate_schema(self):
+        """
+        Creates any missing tables and indexes declared in table_mappers, adds any missing columns to existing tables,
+        and recreates any indexes whose definition has changed, in one transaction. Columns and indexes that are not
+        declared are left as-is, so this is safe to run at every startup. Returns the list of statements run.
+        """
+        statements = []
+        with self.checkout():
+            for table_name, schema in self.table_schemas.items():
+                existing_columns = [row[1] for row in self.execute(f'PRAGMA table_info({table_name})').all()]
+                if not existing_columns:
+                    statements.append(schema.create_table_statement())
+                else:
+                    for column in schema.columns:
+                        if column not in existing_columns:
+                            statements.append(schema.add_column_statement(column))
+
+                existing_indexes = dict(self.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+                                                     [table_name]).all())
+                for index in schema.indexes:
+                    index_statement = schema.create_index_statement(index)
+                    if index['name'] in existing_indexes:
+                        if existing_indexes[index['name']] == index_statement:
+                            continue
+                        statements.append(f'DROP INDEX "{index["name"]}"')
+                    statements.append(index_statement)
+
+            if not statements:
+                return statements
+
+            if not self.in_transaction():
+                self.execute('BEGIN')
+            try:
+                for statement in statements:
+                    self.execute(statement)
+            except Exception:
+                self.rollback()
+                raise
+            self.commit()
+
+        return statements
+
+    def pool_stats(self):
+        if self.pool is None:
+            return None
+
+        return self.pool.stats()
+
+    def read_pool_stats(self):
+        if self.read_pool is None:
+            return None
+
+        return self.read_pool.stats()
+
+    def cached_row(self, table_name, row_id):
+        """
+        Returns the cached serialized row (or None if not cached, or the table has no row cache),
+        and the version of the table's cache to pass to cache_row if the row is then read from the db.
+        Rows are not cached within an open transaction, as they can include its uncommitted changes.
+        """
+        row_cache = self.row_caches.get(table_name)
+        if row_cache is None or self.in_transaction():
+            return None, None
+
+        with self._row_cache_lock:
+            version = self._row_cache_versions[table_name]
+        return row_cache.get(row_id), version
+
+    def cache_row(self, table_name, row_id, serialized_row, version):
+        """Caches the serialized row, unless the table's cache was invalidated since version was returned by cached_row"""
+        row_cache = self.row_caches.get(table_name)
+        if row_cache is None or version is None:
+            return
+
+        with self._row_cache_lock:
+            if self._row_cache_versions[table_name] == version:
+                row_cache.set(row_id, serialized_row)
+
+    def invalidate_rows(self, table_name, row_ids=None):
+        """Removes the given ids from the table's row cache (or all rows if row_ids is None), call after committing changes"""
+        row_cache = self.row_caches.get(table_name)
+        if row_cache is None:
+            return
+
+        if getattr(self._local, 'after_commit', None) is not None:
+            # Otherwise the rows could be cached again (by other threads) before the changes are committed
+            self.after_commit(partial(self.invalidate_rows, table_name, row_ids))
+            return
+
+        with self._row_cache_lock:
+            self._row_cache_versions[table_name] += 1
+            if row_ids is None:
+                row_cache.clear()
+                return
+            for row_id in row_ids:
+                row_cache.invalidate(row_id)
+
+    def row_cache_stats(self):
+        """Hits, misses, hit rate and size of the row cache of each table which has one"""
+        return _table_cache_stats(self.row_caches)
+
+    def table_changed(self, table_name):
+        """Records a write to the table, called by SQLQuery after running an INSERT, UPDATE or DELETE"""
+        with self._data_version_lock:
+            self._table_write_counts[table_name] = self._table_write_counts.get(table_name, 0) + 1
+
+    def _data_version(self):
+        # PRAGMA data_version changes whenever another connection (including from another process) commits,
+        # so it is read from a dedicated connection which never writes. In-memory databases are private to
+        # their connection, so only the table write counts apply to them.
+        if self.db_path in ('', ':memory:'):
+            return None
+
+        with self._data_version_lock:
+            if self._data_version_connection is None:
+                self._data_version_connection = self._connect(check_same_thread=False)
+            return self._data_version_connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def search_cache_token(self, table_name):
+        """Changes whenever the table may have changed: after any commit to the database, or any write to the table"""
+        data_version = self._data_version()
+        with self._data_version_lock:
+            return data_version, self._table_write_counts.get(table_name, 0)
+
+    def table_version(self, table_name):
+        """Opaque version string which changes whenever the table may have changed (see search_cache_token)"""
+        data_version, write_count = self.search_cache_token(table_name)
+        return f'{self.instance_id}-{data_version}-{write_count}'
+
+    def cached_search(self, table_name, search_key):
+        """
+        Returns the cached search response for the search_key (or None), and the token to pass to cache_search
+        if the search is then run. Searches within an open transaction are not cached, as they can see its changes.
+        """
+        search_cache = self.search_caches.get(table_name)
+        if search_cache is None or self.in_transaction():
+            return None, None
+
+        token = self.search_cache_token(table_name)
+        entry = search_cache.get(search_key, is_valid=lambda e: e[0] == token)
+        if entry is None:
+            return None, token
+        return entry[1], token
+
+    def cache_search(self, table_name, search_key, response, token):
+        search_cache = self.search_caches.get(table_name)
+        if search_cache is None or token is None:
+            return
+
+        search_cache.set(search_key, (token, response))
+
+    def search_cache_stats(self):
+        """Hits, misses, hit rate and size of the search cache of each table which has one"""
+        return _table_cache_stats(self.search_caches)
+
+    def index_advice(self):
+        """Full table scans, temporary B-tree sorts and suggested CREATE INDEX statements by table, if index_advisor is enabled"""
+        if self.index_advisor is None:
+            return None
+        return self.index_advisor.advice()
+
+    def statement_cache_info(self):
+        if self.statement_cache is None:
+            return {'hits': 0, 'misses': 0, 'size': 0, 'max_size': 0}
+
+        return self.statement_cache.stats()
+
     def cursor(self):
+        if getattr(self._local, 'connection', None) is not None:
+            if self._local.cursor is None:
+                self._local.cursor = self._local.connection.cursor()
+            return self._local.cursor
+
+        if getattr(self._local, 'read_connection', None) is not None:
+            if self._local.read_cursor is None:
+                self._local.read_cursor = self._local.read_connection.cursor()
+            return self._local.read_cursor
+
         if not self.current_cursor:
             self.current_cursor = self.connection().cursor()
 
-            if self.enable_foreign_key_constraints:
-                self.current_cursor.execute('PRAGMA foreign_keys = ON')
-
         return self.current_cursor
 
     def execute(self, query_str, fill_values=None, postprocessors=None, column_list=None):
         cur = self.cursor()
+        if self.metrics is not None:
+            return self._run_measured(cur.execute, query_str, (fill_values, ) if fill_values else (),
+                                      postprocessors, column_list)
+
         if not fill_values:
             cur.execute(query_str)
         else:
@@ -182,30 +1016,127 @@ class SQLiteDB():
 
     def executemany(self, query_str, fill_values, postprocessors=None, column_list=None):
         cur = self.cursor()
+        if self.metrics is not None:
+            return self._run_measured(cur.executemany, query_str, (fill_values, ), postprocessors, column_list)
+
         cur.executemany(query_str, fill_values)
         return SQLResult(cur, postprocessors, column_list)
 
+    def _run_measured(self, execute_func, query_str, args, postprocessors, column_list):
+        # Compositor queries bind all values, so the query string identifies the statement shape
+        start = time.perf_counter()
+        try:
+            cur = execute_func(query_str, *args)
+        except Exception:
+            self.metrics.record_statement(query_str, time.perf_counter() - start, error=True)
+            raise
+
+        self.metrics.record_statement(query_str, time.perf_counter() - start, rows_affected=cur.rowcount)
+        return SQLResult(cur, postprocessors, column_list, self.metrics, query_str)
+
+    def _collect_metrics(self):
+        samples = []
+        cache_stats = self.statement_cache_info()
+        samples.append(('restomatic_statement_cache_hits_total', 'counter', 'Compiled statement cache hits',
+                        [('db', self.db_path)], cache_stats['hits']))
+        samples.append(('restomatic_statement_cache_misses_total', 'counter', 'Compiled statement cache misses',
+                        [('db', self.db_path)], cache_stats['misses']))
+
+        pool_stats = self.pool_stats()
+        if pool_stats:
+            samples.append(('restomatic_pool_checkouts_total', 'counter', 'Connection pool checkouts',
+                            [('db', self.db_path)], pool_stats['checkouts']))
+            samples.append(('restomatic_pool_wait_seconds_total', 'counter', 'Time spent waiting for pooled connections',
+                            [('db', self.db_path)], pool_stats['total_wait_time']))
+            samples.append(('restomatic_pool_timeouts_total', 'counter', 'Connection pool checkout timeouts',
+                            [('db', self.db_path)], pool_stats['timeouts']))
+
+        read_pool_stats = self.read_pool_stats()
+        if read_pool_stats:
+            samples.append(('restomatic_read_pool_checkouts_total', 'counter', 'Read-only connection pool checkouts',
+                            [('db', self.db_path)], read_pool_stats['checkouts']))
+            samples.append(('restomatic_read_pool_wait_seconds_total', 'counter',
+                            'Time spent waiting for pooled read-only connections',
+                            [('db', self.db_path)], read_pool_stats['total_wait_time']))
+            samples.append(('restomatic_read_pool_timeouts_total', 'counter', 'Read-only connection pool checkout timeouts',
+                            [('db', self.db_path)], read_pool_stats['timeouts']))
+
+        group_commit_stats = self.group_commit_stats()
+        if group_commit_stats:
+            samples.append(('restomatic_group_commits_total', 'counter', 'Group commits',
+                            [('db', self.db_path)], group_commit_stats['groups']))
+            samples.append(('restomatic_group_commit_writes_total', 'counter', 'Writes committed by group commits',
+                            [('db', self.db_path)], group_commit_stats['writes']))
+
+        for table_name, table_stats in self.row_cache_stats().items():
+            labels = [('db', self.db_path), ('table', table_name)]
+            samples.append(('restomatic_row_cache_hits_total', 'counter', 'Row cache hits', labels, table_stats['hits']))
+            samples.append(('restomatic_row_cache_misses_total', 'counter', 'Row cache misses', labels, table_stats['misses']))
+            samples.append(('restomatic_row_cache_size', 'gauge', 'Rows in the row cache', labels, table_stats['size']))
+
+        for table_name, table_stats in self.search_cache_stats().items():
+            labels = [('db', self.db_path), ('table', table_name)]
+            samples.append(('restomatic_search_cache_hits_total', 'counter', 'Search cache hits', labels, table_stats['hits']))
+            samples.append(('restomatic_search_cache_misses_total', 'counter', 'Search cache misses', labels,
+                            table_stats['misses']))
+            samples.append(('restomatic_search_cache_size', 'gauge', 'Responses in the search cache', labels,
+                            table_stats['size']))
+
+        return samples
+
     def rollback(self):
-        if not self.current_connection:
+        savepoint = getattr(self._local, 'savepoint', None)
+        if savepoint is not None:
+            # Only the changes (and deferred invalidations) of the current grouped write (see GroupCommitter)
+            name, after_commit_count = savepoint
+            del self._local.after_commit[after_commit_count:]
+            self.execute(f'ROLLBACK TO {name}')
+            return
+
+        if getattr(self._local, 'after_commit', None) is not None:
+            # The rolled back changes don't need any invalidations
+            self._local.after_commit = []
+
+        conn = self._active_connection()
+        if not conn:
             return
 
-        self.current_connection.rollback()
+        conn.rollback()
 
     def in_transaction(self):
-        if not self.current_connection:
+        conn = self._active_connection()
+        if not conn:
             return False
 
-        return self.current_connection.in_transaction
+        return conn.in_transaction
 
     def commit(self, no_changes_ok=False):
+        if getattr(self._local, 'after_commit', None) is not None:
+            # Committed at the end of the transaction block instead
+            return
+
         if not self.in_transaction():
             if no_changes_ok:
                 return
             raise RuntimeError('No changes in a transaction open for SQLiteDB instance, cannot commit nothing')
 
-        self.current_connection.commit()
+        self._active_connection().commit()
 
     def close(self):
+        if self.group_committer is not None:
+            self.group_committer.close()
+
+        if self.pool is not None:
+            # Only idle connections are closed, checked-out ones are closed when this is called after they are returned
+            self.pool.close()
+
+        if self.read_pool is not None:
+            self.read_pool.close()
+
+        if self._data_version_connection is not None:
+            self._data_version_connection.close()
+            self._data_version_connection = None
+
         if not self.current_connection:
             return
 
@@ -226,6 +1157,13 @@ class SQLCompositorBadResult(StatusMessageException):
         StatusMessageException.__init__(self, message, status_code, additional_information)
 
 
+class SQLCompositorPoolTimeout(StatusMessageException):
+    status_code = 503
+
+    def __init__(self, message, status_code=None, additional_information=None):
+        StatusMessageException.__init__(self, message, status_code, additional_information)
+
+
 def _process_single_column_values(values, column, processors, context):
     if not values or not processors:
         return values
@@ -318,6 +1256,208 @@ def generate_selector(selector, fill_values, valid_columns, processors, context)
     return f'"{column}" {sql_operator}'
 
 
+def generate_seek_predicate(order_by, after_values, fill_values):
+    """
+    Generates the condition for rows strictly after after_values in the given (column, direction) ordering,
+    which must end in a unique column. SQLite sorts NULLs first, so they are handled explicitly.
+    """
+    directions = set([d for c, d in order_by])
+    if _row_values_supported and len(directions) == 1 and None not in after_values:
+        return generate_row_value_seek_predicate(order_by, after_values, fill_values)
+
+    terms = []
+    equal_phrases = []
+    equal_fill_values = []
+
+    for (column, direction), value in zip(order_by, after_values):
+        after_phrase = None
+        after_fill_values = []
+        if direction == 'ASC':
+            if value is None:
+                after_phrase = f'"{column}" IS NOT NULL'
+            else:
+                after_phrase = f'"{column}" > ?'
+                after_fill_values.append(value)
+        elif value is not None:
+            after_phrase = f'("{column}" < ? OR "{column}" IS NULL)'
+            after_fill_values.append(value)
+
+        if after_phrase:
+            terms.append(' AND '.join(equal_phrases + [after_phrase]))
+            fill_values.extend(equal_fill_values + after_fill_values)
+
+        if value is None:
+            equal_phrases.append(f'"{column}" IS NULL')
+        else:
+            equal_phrases.append(f'"{column}" = ?')
+            equal_fill_values.append(value)
+
+    if not terms:
+        # Already past the last possible row
+        return '0'
+
+    return ' OR '.join([f'({t})' for t in terms])
+
+
+def generate_row_value_seek_predicate(order_by, after_values, fill_values):
+    """
+    The same condition as generate_seek_predicate, for orderings all in one direction (and no NULL after_values),
+    as a row value comparison such as ("value", "id") > (?, ?), which SQLite can seek to in an index directly
+    """
+    columns = ', '.join([f'"{c}"' for c, d in order_by])
+    placeholders = ', '.join(['?'] * len(order_by))
+    fill_values.extend(after_values)
+
+    if order_by[0][1] == 'ASC':
+        # Rows with NULLs compare as NULL (so are excluded), which is correct as they sort first
+        return f'({columns}) > ({placeholders})'
+
+    # But they sort last in descending order, so they are added back (after the equal leading columns)
+    terms = [f'({columns}) < ({placeholders})']
+    for i, (column, direction) in enumerate(order_by):
+        terms.append(' AND '.join([f'"{c}" = ?' for c, d in order_by[:i]] + [f'"{column}" IS NULL']))
+        fill_values.extend(after_values[:i])
+
+    return ' OR '.join([f'({t})' for t in terms])
+
+
+def encode_keyset_token(order_by, values):
+    data = json.dumps({'o': [list(o) for o in order_by], 'v': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_keyset_token(token, order_by):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        token_order_by = [tuple(o) for o in data['o']]
+        values = data['v']
+    except (TypeError, ValueError, KeyError, AttributeError):
+        raise SQLCompositorBadInput('Invalid pagination token')
+
+    if token_order_by != list(order_by) or not isinstance(values, list) or len(values) != len(order_by):
+        raise SQLCompositorBadInput('Pagination token does not match the order_by of this query')
+
+    return values
+
+
+def _sql_literal(value):
+    # Only for index definitions, which can't use bound parameters
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise SQLCompositorBadInput(f'Unsupported value in index where clause: {value!r}')
+
+
+class TableSchema():
+    """
+    Declared columns, primary key and indexes of a table, from the extended table_mappers format:
+    {'columns': {'id': 'INTEGER', 'description': 'TEXT NOT NULL', ...}, 'primary_key': 'id',
+     'indexes': [{'columns': ['description', {'column': 'value', 'direction': 'DESC'}],
+                  'unique': False, 'where': [...selector...], 'include': ['extra_column'], 'name': 'idx_name'}]}
+    """
+
+    def __init__(self, table_name, definition):
+        self.table_name = table_name
+        expect_type(definition, dict, f'table definition for {table_name}')
+
+        for key in definition.keys():
+            expect_in(key, ('columns', 'primary_key', 'indexes'), f'table definition key for {table_name}')
+
+        columns = definition.get('columns')
+        if isinstance(columns, dict):
+            self.column_types = dict(columns)
+        elif isinstance(columns, (list, tuple)):
+            self.column_types = {c: '' for c in columns}
+        else:
+            raise SQLCompositorBadInput(f'Must define columns for table {table_name}')
+
+        for column, column_type in self.column_types.items():
+            expect_type(column, str, 'column name')
+            expect_type(column_type, str, f'column type for {column}')
+
+        self.columns = list(self.column_types.keys())
+
+        primary_key = definition.get('primary_key')
+        if isinstance(primary_key, str):
+            primary_key = [primary_key]
+        self.primary_key = list(primary_key or [])
+        for column in self.primary_key:
+            expect_in(column, self.columns, 'primary key column')
+
+        self.indexes = []
+        index_names = set()
+        for index in definition.get('indexes', []):
+            index = self._normalize_index(index)
+            if index['name'] in index_names:
+                raise SQLCompositorBadInput(f'Duplicate index name {index["name"]} for table {table_name}, '
+                                            'specify a name for each index on the same columns')
+            index_names.add(index['name'])
+            self.indexes.append(index)
+
+    def _normalize_index(self, index):
+        expect_type(index, dict, 'index definition')
+        for key in index.keys():
+            expect_in(key, ('columns', 'unique', 'where', 'include', 'name'), 'index definition key')
+
+        columns = index.get('columns')
+        expect_type(columns, (list, tuple), 'index columns')
+        if not columns:
+            raise SQLCompositorBadInput('Must specify one or more columns for each index')
+
+        # Covering indexes: SQLite has no INCLUDE clause, so the included columns are appended to the index columns
+        column_tuples = []
+        for c_obj in list(columns) + list(index.get('include') or []):
+            if isinstance(c_obj, str):
+                c_obj = {'column': c_obj}
+            expect_type(c_obj, dict, 'index column/direction object')
+            column = c_obj.get('column')
+            expect_in(column, self.columns, 'index column')
+            direction = c_obj.get('direction', 'ASC').upper()
+            expect_in(direction, ('ASC', 'DESC'), 'index column direction')
+            column_tuples.append((column, direction))
+
+        name = index.get('name')
+        if name is None:
+            name = '_'.join(['idx', self.table_name] + [c for c, d in column_tuples])
+        expect_type(name, str, 'index name')
+
+        return {
+            'name': name,
+            'columns': column_tuples,
+            'unique': bool(index.get('unique')),
+            'where': index.get('where'),
+        }
+
+    def create_table_statement(self):
+        definitions = [f'"{c}" {t}'.strip() for c, t in self.column_types.items()]
+        if self.primary_key:
+            definitions.append('PRIMARY KEY (' + ','.join([f'"{c}"' for c in self.primary_key]) + ')')
+        return f'CREATE TABLE IF NOT EXISTS {self.table_name} (' + ', '.join(definitions) + ')'
+
+    def add_column_statement(self, column):
+        return f'ALTER TABLE {self.table_name} ADD COLUMN ' + f'"{column}" {self.column_types[column]}'.strip()
+
+    def create_index_statement(self, index):
+        """The statement as SQLite stores it in sqlite_master, so changed definitions can be detected"""
+        unique = 'UNIQUE ' if index['unique'] else ''
+        columns = ','.join([f'"{c}" DESC' if d == 'DESC' else f'"{c}"' for c, d in index['columns']])
+        statement = f'CREATE {unique}INDEX "{index["name"]}" ON {self.table_name}({columns})'
+
+        if index['where'] is not None:
+            # Partial indexes: the values are written into the statement as literals
+            fill_values = []
+            clause = generate_selector(index['where'], fill_values, self.columns, None, None)
+            clause_parts = clause.split('?')
+            statement += ' WHERE ' + clause_parts[0] + ''.join([_sql_literal(v) + part for v, part in zip(fill_values, clause_parts[1:])])
+
+        return statement
+
+
 # Table to dict mapper for results (multiple rows)
 def map_index(index_names, values):
     mapped_values = []
@@ -335,13 +1475,67 @@ def map_index_one_row(index_names, row):
     if row is None:
         return None
 
-    mapped_row = {}
-    for i, name in enumerate(index_names):
-        if len(row) <= i:
-            break
-        mapped_row[name] = row[i]
+    # Stops at the shorter of the two
+    return dict(zip(index_names, row))
 
-    return mapped_row
+
+def _encode_json_float(value):
+    if value != value or value in (float('inf'), float('-inf')):
+        # NaN and Infinity, as json.dumps writes them
+        return json.dumps(value)
+    return float.__repr__(value)
+
+
+# Encoders by exact type for the values SQLite returns, anything else (such as postprocessed values) uses json.dumps
+_json_value_encoders = {
+    str: json.encoder.encode_basestring_ascii,
+    int: int.__repr__,
+    float: _encode_json_float,
+    type(None): lambda value: 'null',
+}
+
+
+class JSONRowSerializer():
+    """
+    Writes rows as JSON objects directly from their tuples (the same as json.dumps of the mapped rows),
+    with the "column": key fragments encoded once for the column list. The _bytes forms encode with the given
+    json_codec instead (such as the router's), unless it is the json module one, which the templates already match.
+    """
+
+    def __init__(self, column_list, json_codec=None):
+        self.column_list = list(column_list)
+        # A %-format template for one row, such as: {"id":%s,"description":%s}
+        keys = [json.dumps(c).replace('%', '%%') + ':%s' for c in column_list]
+        self.template = '{' + ','.join(keys) + '}'
+        self.json_codec = None if isinstance(json_codec, StdlibJSONCodec) else json_codec
+
+    def row(self, row):
+        encoders = _json_value_encoders
+        dumps = json.dumps
+        return self.template % tuple([encoders.get(type(v), dumps)(v) for v in row])
+
+    def rows(self, rows):
+        """The rows as comma-separated JSON objects (without the surrounding list brackets)"""
+        encoders = _json_value_encoders
+        dumps = json.dumps
+        template = self.template
+        return ','.join([template % tuple([encoders.get(type(v), dumps)(v) for v in row]) for row in rows])
+
+    def row_bytes(self, row):
+        """The row as a UTF-8 encoded JSON object"""
+        if self.json_codec is None:
+            return self.row(row).encode('utf-8')
+
+        return self.json_codec.dumps(dict(zip(self.column_list, row)))
+
+    def rows_bytes(self, rows):
+        """The rows as UTF-8 encoded, comma-separated JSON objects (without the surrounding list brackets)"""
+        if self.json_codec is None:
+            return self.rows(rows).encode('utf-8')
+
+        dumps = self.json_codec.dumps
+        column_list = self.column_list
+        return b','.join([dumps(dict(zip(column_list, row))) for row in rows])
 
 
 # Dict to index mapper for input values (one row at a time)
@@ -380,16 +1574,17 @@ class SQLQuery():
             'values': None,
             'limit': None,
             'offset': None,
+            'seek': None,
         }
         self.count_mode = False
         self.many_query = False
         self.fill_values = []
+        self.seek_fill_values = []
+        # The JSON-style where selector, for the index advisor
+        self.where_selector = None
 
         self.db = db
 
-    def _get_table_map(self):
-        return self.db.table_mappers[self.table_name]
-
     # Validations
     def _validate_clause(self, clause, fill_values):
         if clause.count('?') != len(fill_values):
@@ -442,6 +1637,7 @@ class SQLQuery():
         self._validate_clause(clause, new_fill_values)
 
         self._set_query_data_only_once('where', clause)
+        self.where_selector = selector
 
         self.fill_values.extend(new_fill_values)
         return self
@@ -451,8 +1647,10 @@ class SQLQuery():
         return self.where(['id', 'eq', row_id])
 
     def _preprocess_values(self, values, mode='INSERT INTO'):
-        return _process_values(values, self.db.get_preprocessors(self.table_name), self.data['column_list'],
-                               {'db': self.db, 'mode': mode})
+        if isinstance(values, dict):
+            return _process_mapped_values(values, self.db.get_preprocessors(self.table_name), {'db': self.db, 'mode': mode})
+
+        return self.db.get_processor_pipeline(self.table_name, self.data['column_list'], mode).process(values)
 
     def set_values(self, set_values):
         self.expect_kind('UPDATE', 'set_values')
@@ -466,6 +1664,52 @@ class SQLQuery():
         self._set_query_data_only_once('set_values', self._preprocess_values(set_values, mode='UPDATE'))
         return self
 
+    def set_values_many(self, rows, key_column='id'):
+        """
+        Sets the other columns of each row dict (all with the same columns, in any order) on the row with its
+        key_column value, as one executemany statement: UPDATE ... SET ... WHERE key_column = ?
+        """
+        self.expect_kind('UPDATE', 'set_values_many')
+        if key_column not in self.valid_columns:
+            raise SQLCompositorBadInput(f'Unknown column: {key_column}')
+        expect_type(rows, (list, tuple), 'set_values_many rows')
+
+        processors = self.db.get_preprocessors(self.table_name)
+        set_columns = None
+        many_values = []
+        for row in rows:
+            expect_type(row, dict, 'set_values_many input row dictionary')
+            if key_column not in row:
+                raise SQLCompositorBadInput(f'Must provide {key_column} for each row to update')
+
+            set_values = {c: v for c, v in row.items() if c != key_column}
+            for c in set_values.keys():
+                if c not in self.valid_columns:
+                    raise SQLCompositorBadInput(f'Unknown column: {c}')
+
+            set_values = self._preprocess_values(set_values, mode='UPDATE')
+            if set_columns is None:
+                set_columns = list(set_values.keys())
+                if not set_columns:
+                    raise SQLCompositorBadInput('Must provide at least one column value to set for each row to update')
+            elif set_values.keys() != set(set_columns):
+                raise SQLCompositorBadInput('Must provide the same columns for each row to update')
+
+            key_value = _process_single_column_values(row[key_column], key_column, processors,
+                                                      {'db': self.db, 'mode': 'WHERE'})
+            # In the column order of the first row
+            many_values.append([set_values[c] for c in set_columns] + [key_value])
+
+        if not many_values:
+            raise SQLCompositorBadInput('Must provide at least one row to update')
+
+        self._set_query_data_only_once('set_values', dict(zip(set_columns, many_values[0])))
+        self._set_query_data_only_once('where', f'"{key_column}" = ?')
+        self.where_selector = [key_column, 'eq', None]
+        self._set_query_data_only_once('values', many_values)
+        self.many_query = True
+        return self
+
     def values(self, values, autorun=True):
         self.expect_kind('INSERT INTO', 'values')
         if not self.data['column_list']:
@@ -538,7 +1782,10 @@ class SQLQuery():
                 raise SQLCompositorBadInput('Complex order_by request must contain a column key '
                                             'and an optional direction key in the input dictionary')
             column = c_obj['column']
-            direction = c_obj.get('direction', 'ASC').upper()
+            direction = c_obj.get('direction', 'ASC')
+            expect_type(direction, str, 'order_by direction')
+            direction = direction.upper()
+            expect_in(direction, ('ASC', 'DESC'), 'order_by direction')
 
             if column not in self.valid_columns:
                 raise SQLCompositorBadInput(f'Unknown column: {column}')
@@ -548,6 +1795,44 @@ class SQLQuery():
         self._set_query_data_only_once('order_by', order_by_tuples)
         return self
 
+    def keyset(self, after_token=None):
+        """
+        Keyset pagination: orders by the order_by columns (if set) and then id, and if after_token
+        (from next_keyset_token of the last row of the previous page) is given, only returns rows after it.
+        Unlike offset, this seeks directly to the start of the page, so every page costs about the same.
+        Must be called after order_by.
+        """
+        self.expect_kind('SELECT', 'keyset')
+        if 'id' not in self.valid_columns:
+            raise SQLCompositorBadInput('Keyset pagination requires an id column')
+
+        order_by = list(self.data['order_by'] or [])
+        if 'id' not in [c for c, d in order_by]:
+            order_by.append(('id', 'ASC'))
+        self.data['order_by'] = order_by
+
+        if after_token is None:
+            return self
+
+        after_values = decode_keyset_token(after_token, order_by)
+        after_values = [_process_single_column_values(v, c, self.db.get_preprocessors(self.table_name),
+                                                      {'db': self.db, 'mode': 'WHERE'}) if v is not None else v
+                        for (c, d), v in zip(order_by, after_values)]
+
+        self._set_query_data_only_once('seek', generate_seek_predicate(order_by, after_values, self.seek_fill_values))
+        return self
+
+    def next_keyset_token(self, last_row):
+        """Returns the token for the page after the given row (mapped, or in column_list order), for use with keyset"""
+        order_by = self.data['order_by']
+        if not order_by or 'id' not in [c for c, d in order_by]:
+            raise SQLCompositorBadInput('Must call keyset before next_keyset_token')
+
+        if not isinstance(last_row, dict):
+            last_row = map_index_one_row(self.data['column_list'], last_row)
+
+        return encode_keyset_token(order_by, [last_row[c] for c, d in order_by])
+
     def limit(self, value):
         self.expect_kind('SELECT', 'limit')
         value = cast_expect_type(value, type_pos_int, 'LIMIT')
@@ -570,36 +1855,41 @@ class SQLQuery():
         self.count_mode = True
         return self
 
-    # Run and return the result of the query
-    def result(self):
+    def shape_key(self):
+        """
+        Hashable key identifying the compiled SQL of this query, independent of the bound values.
+        The where clause is already in placeholder form, so it encodes the where-tree structure.
+        """
+        set_values = self.data['set_values']
+        column_list = self.data['column_list']
+        order_by = self.data['order_by']
+        return (
+            self.kind,
+            self.table_name,
+            tuple(column_list) if column_list else None,
+            self.data['where'],
+            self.data['seek'],
+            tuple(order_by) if order_by else None,
+            self.data['limit'] is not None,
+            self.data['offset'] is not None,
+            tuple(set_values.keys()) if set_values else None,
+            self.data['values'] is not None,
+            self.count_mode,
+        )
+
+    def _compile(self):
         column_list = self.data['column_list']
         escaped_column_list = None
         if column_list:
             escaped_column_list = ','.join([f'"{c}"' for c in column_list])
         where = self.data['where']
         order_by = self.data['order_by']
-        limit = self.data['limit']
-        offset = self.data['offset']
-        values = self.data['values']
-        postprocessors = None
 
         if self.kind == 'SELECT':
             query_str = 'SELECT ' + escaped_column_list + ' FROM ' + self.table_name
 
-            postprocessors = self.db.get_postprocessors(self.table_name)
-
         elif self.kind == 'UPDATE':
-            query_str = 'UPDATE ' + self.table_name + ' SET '
-
-            set_phrases = []
-            add_fill_values = []
-            for column, value in self.data['set_values'].items():
-                set_phrases.append(f'"{column}" = ?')
-                add_fill_values.append(value)
-
-            query_str += ','.join(set_phrases)
-            add_fill_values.extend(self.fill_values)
-            self.fill_values = add_fill_values
+            query_str = 'UPDATE ' + self.table_name + ' SET ' + ','.join([f'"{c}" = ?' for c in self.data['set_values'].keys()])
 
         elif self.kind == 'INSERT INTO':
             query_str = 'INSERT INTO ' + self.table_name + '(' + escaped_column_list + ')'
@@ -607,20 +1897,25 @@ class SQLQuery():
         elif self.kind == 'DELETE':
             query_str = 'DELETE FROM ' + self.table_name
 
-        if where:
+        seek = self.data['seek']
+        if where and seek:
+            query_str += ' WHERE (' + where + ') AND (' + seek + ')'
+        elif where:
             query_str += ' WHERE ' + where
+        elif seek:
+            query_str += ' WHERE ' + seek
 
         if order_by:
             query_str += ' ORDER BY ' + ','.join([f'"{c}" {d}' for c, d in order_by])
 
-        if limit:
-            query_str += f' LIMIT {limit}'
-            if offset is not None:
-                query_str += f' OFFSET {offset}'
+        # Limit and offset are bound as parameters, so that all pages of a query share one compiled statement
+        if self.data['limit'] is not None:
+            query_str += ' LIMIT ?'
+            if self.data['offset'] is not None:
+                query_str += ' OFFSET ?'
 
-        if values:
+        if self.data['values'] is not None and self.kind == 'INSERT INTO':
             query_str += ' VALUES (' + ','.join(['?'] * len(column_list)) + ')'
-            self.fill_values = values
 
         if self.count_mode:
             query_str = 'SELECT COUNT(*) FROM (' + query_str + ')'
@@ -628,12 +1923,72 @@ class SQLQuery():
         if ';' in query_str:
             raise SQLCompositorBadInput('Composite statements are not allowed')
 
-        self._validate_clause(query_str, self.fill_values)
+        return query_str
+
+    def _bind_fill_values(self):
+        if self.data['values'] is not None:
+            return self.data['values']
+
+        fill_values = []
+        if self.kind == 'UPDATE':
+            fill_values.extend(self.data['set_values'].values())
+
+        fill_values.extend(self.fill_values)
+        fill_values.extend(self.seek_fill_values)
+
+        if self.data['limit'] is not None:
+            fill_values.append(self.data['limit'])
+            if self.data['offset'] is not None:
+                fill_values.append(self.data['offset'])
+
+        return fill_values
+
+    # Run and return the result of the query
+    def result(self):
+        statement_cache = self.db.statement_cache
+        query_str = None
+        if statement_cache is not None:
+            shape_key = self.shape_key()
+            query_str = statement_cache.get(shape_key)
+
+        fill_values = self._bind_fill_values()
+
+        if query_str is None:
+            query_str = self._compile()
+            if self.many_query:
+                # values() has already checked that every row has the same length
+                self._validate_clause(query_str, fill_values[0])
+            else:
+                self._validate_clause(query_str, fill_values)
+
+            if statement_cache is not None:
+                statement_cache.set(shape_key, query_str)
+
+        # On every run, not just statement cache misses, so that statements are analyzed again after the advisor is
+        # cleared (the advisor skips statements it has already analyzed)
+        if self.db.index_advisor is not None and self.kind != 'INSERT INTO':
+            self.db.index_advisor.analyze(self.db.connection(), self, query_str,
+                                          fill_values[0] if self.many_query else fill_values)
+
+        if self.kind != 'SELECT':
+            # Writes within a read-only checkout go to the writer connection
+            self.db.use_writer()
+
+        column_list = self.data['column_list']
+        postprocessors = None
+        if self.kind == 'SELECT' and not self.count_mode:
+            postprocessors = self.db.get_processor_pipeline(self.table_name, column_list, 'SELECT')
 
         if self.many_query:
-            return self.db.executemany(query_str, self.fill_values, postprocessors, column_list)
+            result = self.db.executemany(query_str, fill_values, postprocessors, column_list)
+        else:
+            result = self.db.execute(query_str, fill_values, postprocessors, column_list)
+
+        if self.kind != 'SELECT':
+            # After the write, so that searches read before it are cached with the previous token
+            self.db.table_changed(self.table_name)
 
-        return self.db.execute(query_str, self.fill_values, postprocessors, column_list)
+        return result
 
     # For executing a query directly (used for update().set_values().where().run() etc.
     # Insert into can autorun, and all, one, one_or_none forms are used for select
@@ -657,10 +2012,32 @@ class SQLQuery():
         return self.result().one_or_none()
 
     def all_mapped(self):
-        return map_index(self._get_table_map(), self.result())
+        return map_index(self.data['column_list'], self.result())
+
+    def chunks_mapped(self, size):
+        """Generator of lists of up to size mapped rows, for streaming results without holding them all in memory"""
+        index_names = self.data['column_list']
+        for rows in self.result().chunks(size):
+            yield map_index(index_names, rows)
 
     def one_mapped(self):
-        return map_index_one_row(self._get_table_map(), self.result().one())
+        return map_index_one_row(self.data['column_list'], self.result().one())
 
     def one_or_none_mapped(self):
-        return map_index_one_row(self._get_table_map(), self.result().one_or_none())
+        return map_index_one_row(self.data['column_list'], self.result().one_or_none())
+
+    # JSON forms of the _mapped functions, serialized straight from the row tuples without building dicts
+    def json_serializer(self, json_codec=None):
+        return self.db.get_json_serializer(self.data['column_list'], json_codec)
+
+    def all_json(self):
+        return '[' + self.json_serializer().rows(self.all()) + ']'
+
+    def one_json(self):
+        return self.json_serializer().row(self.one())
+
+    def one_or_none_json(self):
+        row = self.one_or_none()
+        if row is None:
+            return None
+        return self.json_serializer().row(row)
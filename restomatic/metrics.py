@@ -0,0 +1,172 @@
+import bisect
+import threading
+from collections import OrderedDict
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used for any statements after max_statements distinct ones are tracked, to bound memory use
+OTHER_STATEMENTS_LABEL = 'other'
+
+
+class Histogram():
+    """Cumulative-bucket latency histogram, as in the Prometheus histogram type (not thread-safe on its own)"""
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for c in self.bucket_counts:
+            total += c
+            counts.append(total)
+        return counts
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join([f'{k}="{_escape_label_value(v)}"' for k, v in labels]) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metrics():
+    """
+    Thread-safe counters and latency histograms for SQL statements (by statement shape) and requests (by route),
+    which can be shared by a SQLiteDB and an EndpointRouter, and rendered in the Prometheus text format.
+    """
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS, max_statements=1000):
+        self.buckets = tuple(buckets)
+        self.max_statements = max_statements
+        self.statements = {}
+        self.requests = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def _statement_entry(self, statement):
+        entry = self.statements.get(statement)
+        if entry is None:
+            if len(self.statements) >= self.max_statements:
+                statement = OTHER_STATEMENTS_LABEL
+                entry = self.statements.get(statement)
+            if entry is None:
+                entry = {
+                    'executions': 0,
+                    'errors': 0,
+                    'rows_returned': 0,
+                    'rows_affected': 0,
+                    'latency': Histogram(self.buckets),
+                }
+                self.statements[statement] = entry
+        return entry
+
+    def record_statement(self, statement, duration, rows_affected=0, error=False):
+        with self._lock:
+            entry = self._statement_entry(statement)
+            entry['executions'] += 1
+            if error:
+                entry['errors'] += 1
+            if rows_affected > 0:
+                entry['rows_affected'] += rows_affected
+            entry['latency'].observe(duration)
+
+    def record_rows_returned(self, statement, count):
+        if not count:
+            return
+
+        with self._lock:
+            self._statement_entry(statement)['rows_returned'] += count
+
+    def record_request(self, method, route, status_code, duration):
+        key = (method, route)
+        with self._lock:
+            entry = self.requests.get(key)
+            if entry is None:
+                entry = {'statuses': {}, 'latency': Histogram(self.buckets)}
+                self.requests[key] = entry
+            entry['statuses'][status_code] = entry['statuses'].get(status_code, 0) + 1
+            entry['latency'].observe(duration)
+
+    def add_collector(self, collector):
+        """
+        Adds a function called on each render, which returns a list of additional
+        (metric name, type, help text, labels, value) samples, such as cache statistics,
+        where labels is a list of (name, value) pairs
+        """
+        self.collectors.append(collector)
+
+    def _render_histogram(self, lines, name, labels, histogram):
+        for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.cumulative_counts()):
+            lines.append(f'{name}_bucket{_format_labels(labels + [("le", bound)])} {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+    def render_prometheus(self):
+        lines = []
+
+        with self._lock:
+            statement_counters = (
+                ('restomatic_statement_executions_total', 'executions', 'SQL statements executed'),
+                ('restomatic_statement_errors_total', 'errors', 'SQL statements which raised an error'),
+                ('restomatic_statement_rows_returned_total', 'rows_returned', 'Rows fetched from SQL statement results'),
+                ('restomatic_statement_rows_affected_total', 'rows_affected', 'Rows changed by SQL statements'),
+            )
+            for name, key, help_text in statement_counters:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for statement, entry in self.statements.items():
+                    lines.append(f'{name}{_format_labels([("statement", statement)])} {entry[key]}')
+
+            name = 'restomatic_statement_duration_seconds'
+            lines.append(f'# HELP {name} SQL statement execution latency')
+            lines.append(f'# TYPE {name} histogram')
+            for statement, entry in self.statements.items():
+                self._render_histogram(lines, name, [('statement', statement)], entry['latency'])
+
+            name = 'restomatic_requests_total'
+            lines.append(f'# HELP {name} Requests handled, by route and status code')
+            lines.append(f'# TYPE {name} counter')
+            for (method, route), entry in self.requests.items():
+                for status_code, count in entry['statuses'].items():
+                    labels = [('method', method), ('route', route), ('status', status_code)]
+                    lines.append(f'{name}{_format_labels(labels)} {count}')
+
+            name = 'restomatic_request_duration_seconds'
+            lines.append(f'# HELP {name} Request latency, by route')
+            lines.append(f'# TYPE {name} histogram')
+            for (method, route), entry in self.requests.items():
+                self._render_histogram(lines, name, [('method', method), ('route', route)], entry['latency'])
+
+            collectors = list(self.collectors)
+
+        # Samples of the same metric are grouped together, even if from different collectors
+        families = OrderedDict()
+        for collector in collectors:
+            for name, metric_type, help_text, labels, value in collector():
+                if name not in families:
+                    families[name] = [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+                families[name].append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        for family_lines in families.values():
+            lines.extend(family_lines)
+
+        return '\n'.join(lines) + '\n'
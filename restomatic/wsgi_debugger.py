@@ -11,14 +11,19 @@ class WSGIDebugger():
         self.status = status
         self.headers = headers
 
-    def test_endpoint(self, method, uri, body=None):
+    def test_endpoint(self, method, uri, body=None, headers=None):
         environ = {
             'REQUEST_METHOD': method.upper(),
             'REQUEST_URI': uri,
         }
 
+        # Request headers, as HTTP_ environ keys
+        for key, value in (headers or {}).items():
+            environ['HTTP_' + key.upper().replace('-', '_')] = value
+
         if body:
             environ['CONTENT_LENGTH'] = len(body)
             environ['wsgi.input'] = io.StringIO(body)
 
-        return self.application(environ, self.start_response)[0].decode('utf-8')
+        # Joins all chunks, for streaming responses
+        return b''.join(self.application(environ, self.start_response)).decode('utf-8')
@@ -1,8 +1,15 @@
+import asyncio
+import hashlib
 import html
-import json
+import io
+import threading
+import time
 import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
+from .json_codec import get_json_codec, StdlibJSONCodec
 from .validations import expect_in, expect_type, expect_len, expect_len_range, expect_only_one_of, set_dict_data_only_once
 from .shared_exceptions import StatusMessageException
 
@@ -45,16 +52,317 @@ def default_render_html_error(error_title, error_message=None):
                                       (error_title, error_message))
 
 
-def _method_not_allowed_endpoint(out_format, allowed):
+class EncodedResponse():
+    """
+    Response data which is already encoded in the endpoint's out_format (such as a JSON string), and is sent as-is.
+    The data can be a str, or bytes already encoded as UTF-8.
+    """
+    def __init__(self, data):
+        self.data = data
+
+
+class StreamingResponse():
+    """
+    Response data produced incrementally by an iterable of str (or bytes) chunks, which is sent as-is
+    (in the endpoint's out_format) without a Content-Length header. If the iterable has a close method,
+    it is called once the response is finished or aborted.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+
+def _encode_stream(chunks):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+def format_etag(version):
+    """Quotes an opaque version string as an ETag, unless it already is one"""
+    if version.startswith('"') or version.startswith('W/"'):
+        return version
+    return f'"{version}"'
+
+
+def hash_etag(encoded_response):
+    return '"' + hashlib.blake2b(encoded_response, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Weak comparison of the ETag against an If-None-Match header value (a list of ETags, or *),
+    ignoring any content coding suffix (see encoded_etag)
+    """
+    if if_none_match.strip() == '*':
+        return True
+
+    etag = _strip_etag_encoding(etag)
+
+    for candidate in if_none_match.split(','):
+        if _strip_etag_encoding(candidate.strip()) == etag:
+            return True
+
+    return False
+
+
+# wbits for zlib.compressobj: gzip format, and zlib format (which HTTP calls deflate)
+_compression_wbits = {
+    'gzip': 31,
+    'deflate': 15,
+}
+
+
+def _strip_etag_encoding(etag):
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in _compression_wbits.keys():
+        suffix = f'-{encoding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def encoded_etag(etag, encoding):
+    """The ETag of the compressed response, which is a different representation than the uncompressed one"""
+    if not encoding or not etag.endswith('"'):
+        return etag
+    return etag[:-1] + f'-{encoding}"'
+
+
+def negotiate_encoding(accept_encoding):
+    """The best supported content coding (gzip or deflate) allowed by an Accept-Encoding header value, or None"""
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for part in accept_encoding.split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+
+    best_encoding = None
+    best_quality = 0.0
+    # gzip is preferred if equally acceptable
+    for encoding in ('gzip', 'deflate'):
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding = encoding
+            best_quality = quality
+
+    return best_encoding
+
+
+def compress_response(data, encoding, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _compression_wbits[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def _compress_stream(chunks, encoding, level):
+    # Each chunk is flushed, so that it can be decompressed as soon as it arrives
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _compression_wbits[encoding])
+    try:
+        for chunk in chunks:
+            compressed = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+
+
+def add_vary_header(headers, value):
+    for i, (key, existing) in enumerate(headers):
+        if key.lower() == 'vary':
+            if value.lower() not in [v.strip().lower() for v in existing.split(',')]:
+                headers[i] = (key, f'{existing}, {value}')
+            return headers
+
+    headers.append(('Vary', value))
+
+    return headers
+
+
+def get_header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def set_header(headers, name, value):
+    lower_name = name.lower()
+    for i, (key, existing) in enumerate(headers):
+        if key.lower() == lower_name:
+            headers[i] = (key, value)
+            return headers
+
+    headers.append((name, value))
+
+    return headers
+
+
+def _not_modified_headers(headers):
+    # A 304 has no body, so no content headers
+    return [(k, v) for k, v in headers if k.lower() not in ('content-type', 'content-length', 'content-encoding')]
+
+
+def asgi_scope_to_environ(scope, body):
+    """Builds a WSGI environ for an ASGI http scope and its (already received) request body"""
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    raw_path = scope.get('raw_path')
+    if raw_path:
+        path = raw_path.decode('latin-1')
+    else:
+        path = urllib.parse.quote(scope['path'])
+
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'].upper(),
+        'REQUEST_URI': path + ('?' + query_string if query_string else ''),
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+    }
+
+    for key, value in scope.get('headers', []):
+        key = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif key != 'CONTENT_LENGTH':
+            key = 'HTTP_' + key
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+
+    return environ
+
+
+def _asgi_response_start(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    }
+
+
+def _method_not_allowed_endpoint(out_format, allowed, route):
     return {
         'in_format': 'plain',
         'out_format': out_format,
         'status': 405,
         'allowed': allowed,
+        'route': route,
     }
 
 
-def run_endpoint(func, request, out_format):
+# Route label used in metrics for requests which did not match any endpoint
+UNMATCHED_ROUTE = 'unmatched'
+
+_not_found_endpoint = {'status': 404, 'route': UNMATCHED_ROUTE}
+
+
+class _PrefixTreeNode():
+    __slots__ = ('edges', 'value')
+
+    def __init__(self):
+        # First character of each edge -> (edge label, child node)
+        self.edges = {}
+        self.value = None
+
+
+class PrefixTree():
+    """Compressed radix tree of strings, to find the values of all registered prefixes of a path in O(path length)"""
+
+    def __init__(self):
+        self.root = _PrefixTreeNode()
+
+    def insert(self, prefix, value):
+        node = self.root
+        rest = prefix
+
+        while rest:
+            edge = node.edges.get(rest[0])
+            if edge is None:
+                child = _PrefixTreeNode()
+                node.edges[rest[0]] = (rest, child)
+                node = child
+                break
+
+            label, child = edge
+            common = 1
+            while common < len(label) and common < len(rest) and label[common] == rest[common]:
+                common += 1
+
+            if common < len(label):
+                # Split the edge where the prefix diverges from (or ends within) it
+                middle = _PrefixTreeNode()
+                middle.edges[label[common]] = (label[common:], child)
+                node.edges[rest[0]] = (label[:common], middle)
+                child = middle
+
+            node = child
+            rest = rest[common:]
+
+        node.value = value
+
+    def matches(self, path):
+        """Values of all inserted prefixes of path, longest first"""
+        found = []
+        node = self.root
+        if node.value is not None:
+            found.append(node.value)
+
+        position = 0
+        while position < len(path):
+            edge = node.edges.get(path[position])
+            if edge is None:
+                break
+            label, node = edge
+            if not path.startswith(label, position):
+                break
+            position += len(label)
+            if node.value is not None:
+                found.append(node.value)
+
+        found.reverse()
+        return found
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+_default_json_codec = StdlibJSONCodec()
+
+
+def run_endpoint(func, request, out_format, json_codec=_default_json_codec):
     response = func(request)
 
     response_data = response
@@ -84,8 +392,17 @@ def run_endpoint(func, request, out_format):
 
     headers = add_content_type_header(headers, out_format)
 
+    if isinstance(response_data, StreamingResponse):
+        return response_data, status_code, headers
+
+    if isinstance(response_data, EncodedResponse):
+        response_data = response_data.data
+        expect_type(response_data, (str, bytes), 'encoded response data')
+        return response_data, status_code, headers
+
     if out_format == 'json':
-        response_data = json.dumps(response_data)
+        # Encoded straight to bytes
+        response_data = json_codec.dumps(response_data)
     else:
         # raw, plain, html, js
         expect_type(response_data, str, 'response data')
@@ -127,11 +444,13 @@ _code_status_lookup = {
     201: '201 Created',
     301: '301 Moved Permanently',
     302: '302 Found',
+    304: '304 Not Modified',
     400: '400 Bad Request',
     401: '401 Unauthorized',
     404: '404 Not Found',
     405: '405 Method Not Allowed',
     500: '500 Internal Server Error',
+    503: '503 Service Unavailable',
 }
 
 
@@ -139,7 +458,51 @@ def code_to_status(code):
     return _code_status_lookup.get(code, '500 Internal Server Error')
 
 
-def parse_request_body(environ, in_format):
+def exception_status(e):
+    # The status code and message of an error response for the exception
+    status_code = getattr(e, 'status_code', 500)
+
+    if hasattr(e, 'message'):
+        return status_code, f'{e.message}'
+    return status_code, f'{type(e).__name__}: {e}'
+
+
+class RequestBodyStream(io.RawIOBase):
+    """Reads at most length characters or bytes from wsgi.input, as bytes (str input is encoded as UTF-8)"""
+
+    def __init__(self, wsgi_input, length):
+        self.wsgi_input = wsgi_input
+        self.remaining = length
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending:
+            if self.remaining <= 0:
+                return 0
+            data = self.wsgi_input.read(min(len(buffer), self.remaining))
+            if not data:
+                self.remaining = 0
+                return 0
+            self.remaining -= len(data)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            self.pending = data
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def open_request_stream(environ, body_size, buffer_size=65536):
+    """Buffered binary reader of the request body (which can be iterated by line), read incrementally"""
+    return io.BufferedReader(RequestBodyStream(environ['wsgi.input'], body_size), buffer_size)
+
+
+def parse_request_body(environ, in_format, json_codec=_default_json_codec):
     try:
         body_size = int(environ.get('CONTENT_LENGTH', 0))
     except (TypeError, ValueError):
@@ -148,11 +511,15 @@ def parse_request_body(environ, in_format):
     if body_size <= 0:
         return None
 
+    if in_format == 'stream':
+        # Not read here, so the endpoint can process the body as it arrives
+        return open_request_stream(environ, body_size)
+
     body = environ['wsgi.input'].read(body_size)
 
     if in_format == 'json':
         try:
-            return json.loads(body)
+            return json_codec.loads(body)
         except (TypeError, ValueError) as e:
             raise EndpointRouterBadInput(f'Failed to parse JSON input: {e}')
 
@@ -177,7 +544,9 @@ def serve_static_data(data, request):
 
 class EndpointRouter():
     """WSGI router to send requests to the appropriate registered endpoint"""
-    def __init__(self, default_in_format='plain', default_out_format='plain', default_html_error=default_render_html_error):
+    def __init__(self, default_in_format='plain', default_out_format='plain', default_html_error=default_render_html_error,
+                 metrics=None, asgi_max_workers=None, json_codec=None,
+                 compression=False, compression_min_size=1024, compression_level=6):
         # First check for any exact matches, then prefix matches
         self._endpoints_exact = {}
 
@@ -190,17 +559,49 @@ class EndpointRouter():
         # Use '/' for catch-all
         self._endpoints_prefix = {}
 
+        # Compiled from the above on the first request after any registration (see _compile_routes)
+        self._routes_compiled = False
+        self._routes_lock = threading.Lock()
+        self._prefix_tree = None
+        self._exact_not_allowed = {}
+
         self.server_default_in_format = default_in_format
         self.server_default_out_format = default_out_format
         self.server_render_html_error = default_html_error
 
+        # Encodes JSON responses (to bytes) and decodes JSON requests: 'orjson', 'json', or an object with dumps and
+        # loads methods, by default the json module (see restomatic.json_codec)
+        self.json_codec = get_json_codec(json_codec)
+
+        # gzip/deflate compression (as negotiated with Accept-Encoding) of responses of at least compression_min_size
+        # bytes, and all streaming responses, unless the endpoint is registered with compress=False
+        self.compression = compression
+        self.compression_min_size = compression_min_size
+        self.compression_level = compression_level
+
+        # Optional restomatic.metrics.Metrics instance, to record request counts and latency per route
+        self.metrics = metrics
+
+        # The endpoint funcs are synchronous, so asgi_application runs them in a bounded thread pool (created on first use)
+        self.asgi_max_workers = asgi_max_workers
+        self._asgi_executor = None
+
     def _register_endpoint_internal(self, type_str, type_dict, location, method, endpoint_def):
         expect_type(location, str, f'{type_str} uri')
+        # Each location gets its own copy, so that the registered uri can be used as the route label in metrics
+        endpoint_def = dict(endpoint_def, route=location)
         set_dict_data_only_once(type_dict, [location, method], endpoint_def,
                                 f'{type_str} uri definition for {location} for method {method}')
 
     def register_endpoint(self, func=None, static_file=None, static_data=None,
-                          in_format=None, out_format=None, exact=None, prefix=None, method=None, disallow_other_methods=None):
+                          in_format=None, out_format=None, exact=None, prefix=None, method=None, disallow_other_methods=None,
+                          etag=None, compress=True):
+        """
+        etag can be True to send an ETag header with a hash of each 200 response, or a function of the request
+        returning a version string (or None) for the response, which is checked before the endpoint func is called.
+        If-None-Match is honoured for GET and HEAD requests, and for other methods only if etag is a function.
+        Set compress to False to never compress this endpoint's responses (if compression is enabled on the router).
+        """
         if not func and not static_file and not static_data:
             raise EndpointRouterBadDefinition('Must define func for register_endpoint')
 
@@ -225,7 +626,7 @@ class EndpointRouter():
         in_format = in_format.lower().strip()
         out_format = out_format.lower().strip()
 
-        expect_in(in_format, ('raw', 'plain', 'form', 'json'), 'in_format')
+        expect_in(in_format, ('raw', 'plain', 'form', 'json', 'stream'), 'in_format')
         expect_in(out_format, ('raw', 'plain', 'html', 'js', 'json'), 'out_format')
 
         endpoint_def = {
@@ -234,6 +635,14 @@ class EndpointRouter():
             'func': func,
         }
 
+        if etag:
+            if etag is not True and not callable(etag):
+                raise EndpointRouterBadDefinition('etag must be True or a function of the request')
+            endpoint_def['etag'] = etag
+
+        if not compress:
+            endpoint_def['compress'] = False
+
         if exact:
             location = exact
             type_str = 'exact'
@@ -250,6 +659,8 @@ class EndpointRouter():
         for loc in location:
             self._register_endpoint_internal(type_str, type_dict, loc, method, endpoint_def)
 
+        self._routes_compiled = False
+
         if disallow_other_methods:
             if not exact:
                 raise EndpointRouterBadDefinition('Can only use disallow_other_methods with exact match endpoints, '
@@ -258,6 +669,18 @@ class EndpointRouter():
             for loc in location:
                 self._endpoints_exact_disallow[loc] = out_format
 
+    def register_metrics_endpoint(self, path='/_metrics', metrics=None):
+        """Registers a GET endpoint which returns the router's (or the given) metrics in the Prometheus text format"""
+        if metrics is None:
+            metrics = self.metrics
+        if metrics is None:
+            raise EndpointRouterBadDefinition('Must provide metrics to the EndpointRouter or to register_metrics_endpoint')
+
+        def metrics_endpoint(request):
+            return metrics.render_prometheus(), 200, [('Content-Type', PROMETHEUS_CONTENT_TYPE)]
+
+        self.register_endpoint(func=metrics_endpoint, exact=path, method='GET', out_format='plain')
+
     # TODO: Convenience register_class function (auto-detects get/post/etc. class methods)
 
     def generate_error_response(self, format, error_title, error_message=None):
@@ -265,48 +688,232 @@ class EndpointRouter():
         if format in ('html', 'js'):
             return self.server_render_html_error(error_title, error_message), [('Content-Type', 'text/html; charset=utf-8')]
         if format == 'json':
-            return json.dumps({'message': html.escape(error_message or error_title)}), [('Content-Type', 'application/json; charset=utf-8')]
+            return self.json_codec.dumps({'message': html.escape(error_message or error_title)}), [('Content-Type', 'application/json; charset=utf-8')]
         # raw / plain
         return html.escape(error_message or error_title), [('Content-Type', 'text/plain; charset=utf-8')]
 
+    def _compile_routes(self):
+        # Builds the prefix tree, and the 405 responses (with their Allow lists) for each route
+        with self._routes_lock:
+            if self._routes_compiled:
+                return
+
+            exact_not_allowed = {}
+            for uri, test_exact in self._endpoints_exact.items():
+                out_format = self._endpoints_exact_disallow.get(uri, list(test_exact.values())[0]['out_format'])
+                exact_not_allowed[uri] = _method_not_allowed_endpoint(out_format, list(test_exact.keys()), uri)
+
+            prefix_tree = PrefixTree()
+            for prefix, test_prefix in self._endpoints_prefix.items():
+                not_allowed = _method_not_allowed_endpoint(list(test_prefix.values())[0]['out_format'],
+                                                           list(test_prefix.keys()), prefix)
+                prefix_tree.insert(prefix, (test_prefix, not_allowed))
+
+            self._exact_not_allowed = exact_not_allowed
+            self._prefix_tree = prefix_tree
+            self._routes_compiled = True
+
     def find_endpoint(self, uri_path, method):
-        allowed = ['GET']
-        other_method_matched = False
-        other_out_format = self.server_default_out_format
+        """
+        Returns the exact match for the uri and method if any, otherwise the longest matching prefix with the method,
+        otherwise a 405 with the methods of the exact match or longest matching prefix, otherwise a 404
+        """
+        if not self._routes_compiled:
+            self._compile_routes()
+
+        not_allowed = None
 
-        if uri_path in self._endpoints_exact:
-            test_exact = self._endpoints_exact[uri_path]
+        test_exact = self._endpoints_exact.get(uri_path)
+        if test_exact is not None:
             if method in test_exact:
                 return test_exact[method]
-            allowed = list(test_exact.keys())
-            other_method_matched = True
-            other_out_format = list(test_exact.values())[0].get('out_format', other_out_format)
+            not_allowed = self._exact_not_allowed[uri_path]
+            if uri_path in self._endpoints_exact_disallow:
+                return not_allowed
+
+        for test_prefix, prefix_not_allowed in self._prefix_tree.matches(uri_path):
+            if method in test_prefix:
+                return test_prefix[method]
+            if not_allowed is None:
+                not_allowed = prefix_not_allowed
+
+        if not_allowed is not None:
+            return not_allowed
+
+        return _not_found_endpoint
+
+    def dispatch_internal(self, method, uri, body=None):
+        """
+        Runs the endpoint for the method and uri with an already decoded body (such as a JSON object), without a WSGI
+        request, for batched requests. Returns the status code, headers and response (as bytes), with errors as error
+        responses. Only endpoints with the json or plain in_format can be run this way.
+        """
+        status_code = 500
+        error_message = None
 
-        if uri_path in self._endpoints_exact_disallow:
-            return _method_not_allowed_endpoint(self._endpoints_exact_disallow[uri_path], allowed)
+        parsed_uri = urllib.parse.urlparse(uri)
+        uri_path = urllib.parse.unquote(parsed_uri[2])
 
-        for prefix, test_prefix in self._endpoints_prefix.items():
-            if uri_path.startswith(prefix):
-                if method in test_prefix:
-                    return test_prefix[method]
-                if not other_method_matched:
-                    # If multiple match, then the first match determines the allowed methods
-                    allowed = list(test_prefix.keys())
-                    other_method_matched = True
-                    other_out_format = list(test_prefix.values())[0].get('out_format', other_out_format)
+        method = method.upper()
 
-        if other_method_matched:
-            return _method_not_allowed_endpoint(other_out_format, allowed)
+        endpoint = self.find_endpoint(uri_path, method)
+        in_format = endpoint.get('in_format') or self.server_default_in_format
+        out_format = endpoint.get('out_format') or self.server_default_out_format
 
-        return {'status': 404}
+        try:
+            if endpoint.get('status'):
+                status_code = endpoint['status']
+            elif in_format not in ('json', 'plain'):
+                status_code = 400
+                error_message = f'Endpoints with the {in_format} in_format cannot be called internally'
+            else:
+                request = {
+                    'uri': {
+                        'path': uri_path,
+                        'params': urllib.parse.unquote(parsed_uri[3]),
+                        'query': urllib.parse.unquote(parsed_uri[4]),
+                        'fragment': urllib.parse.unquote(parsed_uri[5]),
+                    },
+                    'environ': {'REQUEST_METHOD': method, 'REQUEST_URI': uri},
+                    'body': body if method not in ('GET', 'HEAD') else None,
+                }
+
+                response_data, status_code, headers = run_endpoint(endpoint['func'], request, out_format, self.json_codec)
+
+                if isinstance(response_data, StreamingResponse):
+                    response_data = b''.join(_encode_stream(response_data.chunks))
+                elif isinstance(response_data, str):
+                    response_data = response_data.encode('utf-8')
+
+                return status_code, headers, response_data
+
+        except Exception as e:
+            status_code, error_message = exception_status(e)
+
+        response_data, headers = self.generate_error_response(out_format, code_to_status(status_code), error_message)
+        if isinstance(response_data, str):
+            response_data = response_data.encode('utf-8')
+
+        return status_code, headers, response_data
 
     # WSGI Entrypoint
     def application(self, environ, start_response):
+        if self.metrics is None:
+            return self._dispatch(environ, start_response, {})
+
+        start_time = time.perf_counter()
+        info = {}
+
+        def start_response_recorded(status, headers, exc_info=None):
+            info['status'] = status
+            if exc_info:
+                return start_response(status, headers, exc_info)
+            return start_response(status, headers)
+
+        try:
+            return self._dispatch(environ, start_response_recorded, info)
+        finally:
+            # Streaming responses are timed until the response starts, not until the last chunk is sent
+            try:
+                status_code = int(info.get('status', '500').split(' ', 1)[0])
+            except ValueError:
+                status_code = 500
+            self.metrics.record_request(environ.get('REQUEST_METHOD', '').upper(), info.get('route', UNMATCHED_ROUTE),
+                                        status_code, time.perf_counter() - start_time)
+
+    # ASGI Entrypoint
+    async def asgi_application(self, scope, receive, send):
+        """
+        ASGI entrypoint for the same endpoints: request bodies are received asynchronously, and the endpoints are run
+        (via the WSGI application) in a thread pool of at most asgi_max_workers threads. Streaming responses are
+        iterated on one pool thread (as they may hold a connection checked out for it), and each chunk is sent before
+        the next is generated.
+        """
+        if scope['type'] == 'lifespan':
+            await self._asgi_lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            raise RuntimeError(f'Unsupported ASGI scope type: {scope["type"]}')
+
+        body_chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body_chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        environ = asgi_scope_to_environ(scope, b''.join(body_chunks))
+
+        if self._asgi_executor is None:
+            self._asgi_executor = ThreadPoolExecutor(max_workers=self.asgi_max_workers)
+
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(self._asgi_executor, self._run_asgi_request, environ, loop, send)
+
+        if response is not None:
+            # Already complete, so sent from the event loop rather than holding a thread for slow clients
+            status, headers, chunks = response
+            await send(_asgi_response_start(status, headers))
+            await send({'type': 'http.response.body', 'body': b''.join(chunks), 'more_body': False})
+
+    def _run_asgi_request(self, environ, loop, send):
+        # Runs on a pool thread: returns (status, headers, chunks) for complete responses, or sends streaming responses
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = status
+            response_start['headers'] = headers
+
+        result = self.application(environ, start_response)
+
+        if isinstance(result, list):
+            return response_start['status'], response_start['headers'], result
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        try:
+            started = False
+            for chunk in result:
+                if not started:
+                    send_message(_asgi_response_start(response_start['status'], response_start['headers']))
+                    started = True
+                if chunk:
+                    send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+            if not started:
+                send_message(_asgi_response_start(response_start['status'], response_start['headers']))
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            close = getattr(result, 'close', None)
+            if close:
+                close()
+
+        return None
+
+    async def _asgi_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._asgi_executor is not None:
+                    self._asgi_executor.shutdown(wait=False)
+                    self._asgi_executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _dispatch(self, environ, start_response, info):
         # Default in case of unexpected errors
         status_code = 500
         error = True
         error_message = None
         additional_headers = []
+        etag = None
+        if_none_match = None
 
         parsed_uri = urllib.parse.urlparse(environ['REQUEST_URI'])
         uri_path = urllib.parse.unquote(parsed_uri[2])
@@ -314,6 +921,8 @@ class EndpointRouter():
         method = environ['REQUEST_METHOD'].upper()
 
         endpoint = self.find_endpoint(uri_path, method)
+        if endpoint:
+            info['route'] = endpoint.get('route', UNMATCHED_ROUTE)
 
         in_format = self.server_default_in_format
         if endpoint and endpoint.get('in_format'):
@@ -323,6 +932,11 @@ class EndpointRouter():
         if endpoint and endpoint.get('out_format'):
             out_format = endpoint['out_format']
 
+        compressible = self.compression and endpoint.get('compress', True)
+        encoding = None
+        if compressible:
+            encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+
         try:
             if not endpoint or endpoint.get('status') == 404:
                 status_code = 404
@@ -353,33 +967,98 @@ class EndpointRouter():
                 }
 
                 if method not in ('GET', 'HEAD'):
-                    request['body'] = parse_request_body(environ, in_format)
+                    request['body'] = parse_request_body(environ, in_format, self.json_codec)
+
+                etag_option = endpoint.get('etag')
+                if method in ('GET', 'HEAD') or callable(etag_option):
+                    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+
+                if callable(etag_option):
+                    # A cheap version from the endpoint, so unchanged responses are not even generated
+                    etag = etag_option(request)
+                    if etag is not None:
+                        etag = format_etag(etag)
+                        if if_none_match and etag_matches(if_none_match, etag):
+                            not_modified_headers = [('ETag', encoded_etag(etag, encoding))]
+                            if compressible:
+                                add_vary_header(not_modified_headers, 'Accept-Encoding')
+                            start_response(code_to_status(304), not_modified_headers)
+                            return []
+
+                response_data, status_code, headers = run_endpoint(func, request, out_format, self.json_codec)
 
-                response_data, status_code, headers = run_endpoint(func, request, out_format)
+                if etag is not None and status_code == 200 and get_header(headers, 'ETag') is None:
+                    headers.append(('ETag', etag))
 
                 error = False
 
         except Exception as e:
-            if hasattr(e, 'status_code'):
-                status_code = e.status_code
-            else:
-                status_code = 500
-
-            if hasattr(e, 'message'):
-                error_message = f'{e.message}'
-            else:
-                error_message = f'{type(e).__name__}: {e}'
+            status_code, error_message = exception_status(e)
 
         status = code_to_status(status_code)
 
         if error:
             response_data, headers = self.generate_error_response(out_format, status, error_message)
 
-        expect_type(response_data, str, 'internal response_data')
-
         headers.extend(additional_headers)
-        encoded_response = response_data.encode('utf-8')
-        add_content_length_header(headers, len(encoded_response))
+
+        if compressible:
+            add_vary_header(headers, 'Accept-Encoding')
+            if get_header(headers, 'Content-Encoding') is not None:
+                # Already encoded by the endpoint
+                encoding = None
+
+        if isinstance(response_data, StreamingResponse):
+            chunks = _encode_stream(response_data.chunks)
+            if encoding:
+                headers.append(('Content-Encoding', encoding))
+                etag = get_header(headers, 'ETag')
+                if etag is not None:
+                    set_header(headers, 'ETag', encoded_etag(etag, encoding))
+                chunks = _compress_stream(chunks, encoding, self.compression_level)
+            start_response(status, headers)
+            return chunks
+
+        expect_type(response_data, (str, bytes), 'internal response_data')
+
+        encoded_response = response_data
+        if isinstance(response_data, str):
+            encoded_response = response_data.encode('utf-8')
+
+        # Responses with an ETag from the endpoint's etag function are compressed whatever their size, as the 304s
+        # for them are sent before the response is generated, with the compressed representation's ETag
+        if len(encoded_response) < self.compression_min_size and (error or etag is None):
+            encoding = None
+
+        etag = None
+        if not error and status_code == 200:
+            # ETags (and If-None-Match) are of the uncompressed response, so this is before any compression
+            etag = get_header(headers, 'ETag')
+            if etag is None and endpoint.get('etag') is True:
+                etag = hash_etag(encoded_response)
+                headers.append(('ETag', etag))
+            if etag is not None and if_none_match and etag_matches(if_none_match, etag):
+                set_header(headers, 'ETag', encoded_etag(etag, encoding))
+                start_response(code_to_status(304), _not_modified_headers(headers))
+                return []
+
+        # Only compressed once the response is known to be sent
+        if encoding:
+            compressed_response = compress_response(encoded_response, encoding, self.compression_level)
+            # Responses with an ETag are always sent compressed, so that it matches the one their 304s have
+            if etag is not None or len(compressed_response) < len(encoded_response):
+                encoded_response = compressed_response
+                headers.append(('Content-Encoding', encoding))
+            else:
+                encoding = None
+
+        if etag is not None:
+            set_header(headers, 'ETag', encoded_etag(etag, encoding))
+
+        if encoding:
+            set_header(headers, 'Content-Length', str(len(encoded_response)))
+        else:
+            add_content_length_header(headers, len(encoded_response))
 
         start_response(status, headers)
         return [encoded_response]
@@ -26,6 +26,9 @@ setup(
     license='MIT',
     py_modules=['restomatic'],
     packages=find_packages(),
+    extras_require={
+        'orjson': ['orjson'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
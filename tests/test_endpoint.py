@@ -1,8 +1,12 @@
+import io
 import json
 import pytest
+import sqlite3
+import threading
 
-from restomatic.endpoint import register_restomatic_endpoint, RestOMaticBadRequest
-from restomatic.wsgi_endpoint_router import EndpointRouter
+from restomatic.endpoint import register_restomatic_endpoint, register_index_advice_endpoint, register_batch_endpoint, \
+    RestOMaticBadRequest
+from restomatic.wsgi_endpoint_router import EndpointRouter, open_request_stream
 from restomatic.json_sql_compositor import SQLiteDB
 
 from restomatic.wsgi_debugger import WSGIDebugger
@@ -206,3 +210,725 @@ def test_exceptions():
 
     assert bad_request.status_code == 401
     assert bad_request.to_dict() == {'found exception': 'here', 'message': 'message'}
+
+
+def test_restomatic_streaming_search():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    db.insert_mapped('test', [{'description': f'test {i}', 'value': i * 0.5} for i in range(1, 6)])
+
+    db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['POST'], stream_search=True, stream_chunk_size=2)
+
+    wsgi = WSGIDebugger(router.application)
+
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gte', 2], 'order_by': 'id'}))
+    assert json.loads(response) == {
+        'results': [{'id': i, 'description': f'test {i}', 'value': i * 0.5} for i in range(2, 6)]
+    }
+    assert wsgi.status == '200 OK'
+    assert wsgi.headers == [('Content-Type', 'application/json; charset=utf-8')]
+
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gte', 5]}))
+    assert json.loads(response) == {'results': [{'id': 5, 'description': 'test 5', 'value': 2.5}]}
+
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gte', 10]}))
+    assert json.loads(response) == {'results': None}
+
+    # Errors in the request are still reported before streaming starts
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gte', 10], 'order_by': 'bogus'}))
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Unknown column: bogus'})
+
+    # Rows are only fetched as the response is read
+    chunks = router.application({
+        'REQUEST_METHOD': 'POST',
+        'REQUEST_URI': '/test/search',
+        'CONTENT_LENGTH': 27,
+        'wsgi.input': io.StringIO('{"where": ["id", "gte", 1]}'),
+    }, wsgi.start_response)
+    assert next(chunks) == b'{"results":[{"id":1,"description":"test 1","value":0.5},{"id":2,"description":"test 2","value":1.0}'
+    chunks.close()
+
+
+def test_restomatic_keyset_search():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    db.insert_mapped('test', [{'description': f'test {i}', 'value': (i % 3) * 1.0} for i in range(1, 8)])
+
+    db.commit()
+
+    for stream_search in (False, True):
+        router = EndpointRouter()
+
+        register_restomatic_endpoint(router, db, 'test', ['POST'], stream_search=stream_search, stream_chunk_size=2)
+
+        wsgi = WSGIDebugger(router.application)
+
+        ids = []
+        body = {'where': ['id', 'isnotnull'], 'order_by': 'value', 'limit': 3, 'after': None}
+        while True:
+            response = json.loads(wsgi.test_endpoint('POST', '/test/search', json.dumps(body)))
+            assert wsgi.status == '200 OK'
+            ids.extend([r['id'] for r in response['results'] or []])
+            if not response['next']:
+                break
+            body['after'] = response['next']
+
+        assert ids == [3, 6, 1, 4, 7, 2, 5]
+
+        response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gt', 10], 'limit': 3, 'after': None}))
+        assert json.loads(response) == {'results': None, 'next': None}
+
+        response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gt', 1], 'after': None}))
+        assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Must specify a limit to use after (keyset pagination) in a search'})
+
+        response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gt', 1], 'limit': 1, 'offset': 1, 'after': None}))
+        assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Cannot use both offset and after (keyset pagination) in a search'})
+
+        response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gt', 1], 'limit': 1, 'after': 'bogus'}))
+        assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Invalid pagination token'})
+
+
+def test_restomatic_post_ids():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    # The ids SQLite assigned, for null (or string) ids too
+    response = wsgi.test_endpoint('POST', '/test', json.dumps([{'id': None, 'description': 'a'}, {'description': 'b'}]))
+    assert_json_response(wsgi, response, '201 Created', {'success': True, 'ids': [1, 2]})
+
+    response = wsgi.test_endpoint('POST', '/test', json.dumps([{'id': '5', 'description': 'c'}, {'id': 7, 'description': 'd'}]))
+    assert_json_response(wsgi, response, '201 Created', {'success': True, 'ids': [5, 7]})
+
+    response = wsgi.test_endpoint('GET', '/test/5')
+    assert_json_response(wsgi, response, '200 OK', {'id': 5, 'description': 'c', 'value': None})
+
+
+def test_restomatic_bulk_put():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'PUT'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    response = wsgi.test_endpoint('PUT', '/test', json.dumps([{'description': f'test {i}', 'value': i} for i in range(1, 101)]))
+    assert_json_response(wsgi, response, '200 OK', {'success': True})
+
+    response = wsgi.test_endpoint('PUT', '/test', json.dumps(
+        [{'id': i, 'value': -i} for i in range(1, 101)] + [{'id': 200, 'description': 'test 200'}]
+    ))
+    assert_json_response(wsgi, response, '200 OK', {'success': True})
+
+    response = wsgi.test_endpoint('GET', '/test/100')
+    assert_json_response(wsgi, response, '200 OK', {'id': 100, 'description': 'test 100', 'value': -100})
+
+    # IDs which do not exist are not created
+    response = wsgi.test_endpoint('GET', '/test/200')
+    assert wsgi.status == '404 Not Found'
+
+    # Rows with the same columns in a different order
+    response = wsgi.test_endpoint('PUT', '/test', json.dumps([{'id': 1, 'description': 'x', 'value': 1},
+                                                              {'id': 2, 'value': 2, 'description': 'y'}]))
+    assert_json_response(wsgi, response, '200 OK', {'success': True})
+
+    response = wsgi.test_endpoint('GET', '/test/2')
+    assert_json_response(wsgi, response, '200 OK', {'id': 2, 'description': 'y', 'value': 2})
+
+    response = wsgi.test_endpoint('PUT', '/test', json.dumps([{'id': 1, 'value': 1}, {}]))
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Must specify a valid JSON object (dictionary) of columns to set or update'})
+
+    response = wsgi.test_endpoint('GET', '/test/1')
+    assert_json_response(wsgi, response, '200 OK', {'id': 1, 'description': 'x', 'value': 1})
+
+
+def test_restomatic_partial_put():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT NOT NULL, value REAL)')
+    db.insert_many_mapped('test', [{'description': f'test {i}', 'value': i} for i in range(1, 4)])
+    db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['PUT'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    # Only the given columns are updated, so the NOT NULL description is not required
+    response = wsgi.test_endpoint('PUT', '/test', json.dumps({'id': 1, 'value': 5}))
+    assert_json_response(wsgi, response, '200 OK', {'success': True})
+
+    response = wsgi.test_endpoint('PUT', '/test', json.dumps([{'id': 2, 'value': 6}, {'id': 3, 'value': 7},
+                                                               {'description': 'test 4'}, {'id': 9, 'value': 9}]))
+    assert_json_response(wsgi, response, '200 OK', {'success': True})
+
+    assert db.select_all('test').all() == [(1, 'test 1', 5.0), (2, 'test 2', 6.0), (3, 'test 3', 7.0), (4, 'test 4', None)]
+
+
+def test_restomatic_index_advice():
+    db = SQLiteDB(':memory:', table_mappers, index_advisor=True)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST'])
+    register_index_advice_endpoint(router, db)
+
+    wsgi = WSGIDebugger(router.application)
+
+    wsgi.test_endpoint('GET', '/test/1')
+    wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': {'and': [['value', 'gt', 1], ['description', 'eq', 'test']]}}))
+    wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gt', 1], 'order_by': ['value']}))
+
+    scan_statement = 'SELECT "id","description","value" FROM test WHERE ("value" > ?) AND ("description" = ?)'
+    sort_statement = 'SELECT "id","description","value" FROM test WHERE "id" > ? ORDER BY "value" ASC'
+    expected_advice = {
+        'test': {
+            'full_scans': [scan_statement],
+            'temp_b_tree_sorts': [sort_statement],
+            'suggested_indexes': [
+                'CREATE INDEX IF NOT EXISTS "idx_test_description_value" ON test("description","value")',
+                'CREATE INDEX IF NOT EXISTS "idx_test_value_id" ON test("value","id")',
+            ],
+        }
+    }
+    assert db.index_advice() == expected_advice
+
+    response = wsgi.test_endpoint('GET', '/_index_advice')
+    assert_json_response(wsgi, response, '200 OK', expected_advice)
+
+    # Statements already in the statement cache are analyzed again after clearing
+    db.index_advisor.clear()
+    assert db.index_advice() == {}
+
+    wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': {'and': [['value', 'gt', 1], ['description', 'eq', 'test']]}}))
+    assert db.index_advice() == {'test': {
+        'full_scans': [scan_statement],
+        'temp_b_tree_sorts': [],
+        'suggested_indexes': [expected_advice['test']['suggested_indexes'][0]],
+    }}
+
+    for statement in expected_advice['test']['suggested_indexes']:
+        db.execute(statement)
+    db.index_advisor.clear()
+
+    wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': {'and': [['value', 'gt', 1], ['description', 'eq', 'test']]}}))
+    wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'gt', 1], 'order_by': ['value']}))
+    assert len(db.index_advisor.statements) == 2
+    assert db.index_advice() == {}
+
+    with pytest.raises(RuntimeError):
+        register_index_advice_endpoint(router, SQLiteDB(':memory:', table_mappers), '/_other_advice')
+
+
+def test_restomatic_row_cache():
+    db = SQLiteDB(':memory:', table_mappers, row_cache={'test': {'max_size': 2, 'ttl': 60}})
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    wsgi.test_endpoint('POST', '/test', json.dumps([{'description': f'test {i}', 'value': i} for i in range(1, 4)]))
+
+    for _ in range(3):
+        response = wsgi.test_endpoint('GET', '/test/1')
+        assert_json_response(wsgi, response, '200 OK', {'id': 1, 'description': 'test 1', 'value': 1})
+
+    assert db.row_cache_stats() == {'test': {'hits': 2, 'misses': 1, 'size': 1, 'max_size': 2, 'hit_rate': 2 / 3}}
+
+    # Not found rows are not cached
+    response = wsgi.test_endpoint('GET', '/test/4')
+    assert wsgi.status == '404 Not Found'
+    wsgi.test_endpoint('POST', '/test', json.dumps({'description': 'test 4'}))
+    response = wsgi.test_endpoint('GET', '/test/4')
+    assert_json_response(wsgi, response, '200 OK', {'id': 4, 'description': 'test 4', 'value': None})
+
+    wsgi.test_endpoint('PATCH', '/test/1', json.dumps({'value': 10}))
+    response = wsgi.test_endpoint('GET', '/test/1')
+    assert_json_response(wsgi, response, '200 OK', {'id': 1, 'description': 'test 1', 'value': 10})
+
+    wsgi.test_endpoint('PUT', '/test', json.dumps([{'id': 1, 'value': 20}]))
+    response = wsgi.test_endpoint('GET', '/test/1')
+    assert_json_response(wsgi, response, '200 OK', {'id': 1, 'description': 'test 1', 'value': 20})
+
+    wsgi.test_endpoint('PATCH', '/test/where', json.dumps({'where': ['value', 'gt', 5], 'set': {'description': 'updated'}}))
+    response = wsgi.test_endpoint('GET', '/test/1')
+    assert_json_response(wsgi, response, '200 OK', {'id': 1, 'description': 'updated', 'value': 20})
+
+    wsgi.test_endpoint('DELETE', '/test/1')
+    response = wsgi.test_endpoint('GET', '/test/1')
+    assert wsgi.status == '404 Not Found'
+
+    # Rows read before an invalidation are not cached after it
+    cached_result, version = db.cached_row('test', 2)
+    assert cached_result is None
+    db.invalidate_rows('test', [3])
+    db.cache_row('test', 2, '{"id":2}', version)
+    assert db.cached_row('test', 2)[0] is None
+
+
+def test_restomatic_search_cache(tmp_path):
+    db_path = str(tmp_path / 'search.db')
+    db = SQLiteDB(db_path, table_mappers, search_cache={'test': {'max_size': 2}})
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+    db.insert_many_mapped('test', [{'description': f'test {i}', 'value': i} for i in range(1, 4)])
+    db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['POST', 'PATCH'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    search = {'where': ['value', 'gt', 1], 'order_by': ['value'], 'limit': 10}
+    expected_results = [{'id': 2, 'description': 'test 2', 'value': 2}, {'id': 3, 'description': 'test 3', 'value': 3}]
+
+    for body in (search, dict(reversed(list(search.items())))):
+        response = wsgi.test_endpoint('POST', '/test/search', json.dumps(body))
+        assert_json_response(wsgi, response, '200 OK', {'results': expected_results})
+
+    assert db.search_cache_stats()['test']['hits'] == 1
+
+    # Writes through the endpoints
+    wsgi.test_endpoint('PATCH', '/test/2', json.dumps({'value': 20}))
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps(search))
+    assert_json_response(wsgi, response, '200 OK', {'results': [expected_results[1], {'id': 2, 'description': 'test 2', 'value': 20}]})
+
+    # Writes by another connection (or process)
+    other_connection = sqlite3.connect(db_path)
+    other_connection.execute('DELETE FROM test WHERE id = 3')
+    other_connection.commit()
+    other_connection.close()
+
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps(search))
+    assert_json_response(wsgi, response, '200 OK', {'results': [{'id': 2, 'description': 'test 2', 'value': 20}]})
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps(search))
+    assert_json_response(wsgi, response, '200 OK', {'results': [{'id': 2, 'description': 'test 2', 'value': 20}]})
+
+    assert db.search_cache_stats() == {'test': {'hits': 2, 'misses': 3, 'size': 1, 'max_size': 2, 'hit_rate': 0.4}}
+
+    # Writes to an in-memory db, which has no data version
+    db = SQLiteDB(':memory:', table_mappers, search_cache={'test': {'max_size': 2}})
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    token = db.search_cache_token('test')
+    db.insert_mapped('test', {'description': 'test 1'})
+    assert db.search_cache_token('test') != token
+
+
+def test_restomatic_etags():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+    db.insert_many_mapped('test', [{'description': f'test {i}', 'value': i} for i in range(1, 4)])
+    db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST', 'PATCH'], etags=True)
+
+    wsgi = WSGIDebugger(router.application)
+
+    wsgi.test_endpoint('GET', '/test/1')
+    row_etag = dict(wsgi.headers)['ETag']
+
+    search = json.dumps({'where': ['value', 'gt', 1]})
+    wsgi.test_endpoint('POST', '/test/search', search)
+    search_etag = dict(wsgi.headers)['ETag']
+    assert search_etag != row_etag
+
+    response = wsgi.test_endpoint('GET', '/test/1', headers={'If-None-Match': row_etag})
+    assert wsgi.status == '304 Not Modified'
+    response = wsgi.test_endpoint('POST', '/test/search', search, headers={'If-None-Match': search_etag})
+    assert wsgi.status == '304 Not Modified'
+
+    # Different searches and rows have different ETags
+    wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['value', 'gt', 2]}), headers={'If-None-Match': search_etag})
+    assert wsgi.status == '200 OK'
+    wsgi.test_endpoint('GET', '/test/2', headers={'If-None-Match': row_etag})
+    assert wsgi.status == '200 OK'
+
+    # Creates are never conditional
+    response = wsgi.test_endpoint('POST', '/test', json.dumps({'description': 'test 4'}), headers={'If-None-Match': '*'})
+    assert_json_response(wsgi, response, '201 Created', {'success': True, 'id': 4})
+
+    wsgi.test_endpoint('PATCH', '/test/1', json.dumps({'value': 10}))
+    response = wsgi.test_endpoint('GET', '/test/1', headers={'If-None-Match': row_etag})
+    assert wsgi.status == '200 OK'
+    assert json.loads(response) == {'id': 1, 'description': 'test 1', 'value': 10}
+    assert dict(wsgi.headers)['ETag'] != row_etag
+
+
+def test_restomatic_ingest():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT NOT NULL, value REAL)')
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST'], ingest=True, ingest_batch_size=3)
+
+    wsgi = WSGIDebugger(router.application)
+
+    lines = [json.dumps({'description': f'test é {i}', 'value': i}) for i in range(1, 8)]
+    lines[2] = '{"description": "broken'
+    lines[4] = json.dumps({'value': 5})  # Fails the NOT NULL constraint, so that batch is retried row by row
+    lines[5] = json.dumps({'description': 'test 6', 'bogus': 1})
+    body = '\n'.join(lines[:3]) + '\n\n' + '\n'.join(lines[3:]) + '\n' + json.dumps(['not', 'a', 'row'])
+
+    response = wsgi.test_endpoint('POST', '/test/ingest', body)
+    assert_json_response(wsgi, response, '200 OK', {
+        'success': False,
+        'inserted': 4,
+        'failed': 4,
+        'aborted': False,
+        'errors': [
+            {'line': 3, 'message': 'Failed to parse JSON: Unterminated string starting at: line 1 column 17 (char 16)'},
+            {'line': 6, 'message': 'IntegrityError: NOT NULL constraint failed: test.description'},
+            {'line': 7, 'message': 'Unknown column: bogus'},
+            {'line': 9, 'message': 'Must specify a valid JSON object (dictionary) of columns to set for the new row'},
+        ],
+    })
+
+    assert db.select('test', ['description']).all() == [('test é 1', ), ('test é 2', ), ('test é 4', ), ('test é 7', )]
+
+    response = wsgi.test_endpoint('POST', '/test/ingest', '\n'.join([json.dumps({'description': 'more'})] * 5))
+    assert_json_response(wsgi, response, '200 OK', {'success': True, 'inserted': 5, 'failed': 0, 'aborted': False, 'errors': []})
+    assert db.select_all('test').count().scalar() == 9
+
+    response = wsgi.test_endpoint('POST', '/test/ingest')
+    assert wsgi.status == '400 Bad Request'
+
+    # Only ingest_max_errors errors (with the lowest line numbers) are kept, and it stops after ingest_abort_errors
+    router = EndpointRouter()
+    register_restomatic_endpoint(router, db, 'test', ['POST'], ingest=True, ingest_batch_size=3, ingest_max_errors=2,
+                                 ingest_abort_errors=4)
+    wsgi = WSGIDebugger(router.application)
+
+    lines = ['broken', json.dumps({'description': 'test 10'}), json.dumps({'value': 1}), json.dumps({'value': 2}),
+             json.dumps({'description': 'test 11'}), 'broken', json.dumps({'description': 'test 12'})]
+    response = wsgi.test_endpoint('POST', '/test/ingest', '\n'.join(lines))
+    assert_json_response(wsgi, response, '200 OK', {
+        'success': False,
+        'inserted': 2,
+        'failed': 4,
+        'aborted': True,
+        'errors': [
+            {'line': 1, 'message': 'Failed to parse JSON: Expecting value: line 1 column 1 (char 0)'},
+            {'line': 3, 'message': 'IntegrityError: NOT NULL constraint failed: test.description'},
+        ],
+    })
+    assert db.select('test', ['description']).where(('id', 'gt', 9)).all() == [('test 10', ), ('test 11', )]
+
+    # The request stream reads only the given length
+    environ = {'CONTENT_LENGTH': '7', 'wsgi.input': io.BytesIO(b'line 1\nline 2\n')}
+    assert list(open_request_stream(environ, 7, buffer_size=2)) == [b'line 1\n']
+
+
+def test_restomatic_export():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+    db.insert_many_mapped('test', [{'description': f'test, "{i}"', 'value': i / 2} for i in range(1, 6)] + [{'id': 6}])
+    db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST'], export=True, export_chunk_size=2)
+
+    wsgi = WSGIDebugger(router.application)
+
+    response = wsgi.test_endpoint('GET', '/test/export')
+    assert wsgi.status == '200 OK'
+    assert wsgi.headers == [('Content-Type', 'application/x-ndjson'), ('Content-Disposition', 'attachment; filename="test.ndjson"')]
+    assert [json.loads(line) for line in response.splitlines()] == \
+        [{'id': i, 'description': f'test, "{i}"', 'value': i / 2} for i in range(1, 6)] + [{'id': 6, 'description': None, 'value': None}]
+    assert response.endswith('}\n')
+
+    response = wsgi.test_endpoint('GET', '/test/export?format=csv')
+    assert dict(wsgi.headers)['Content-Type'] == 'text/csv; charset=utf-8'
+    assert response == 'id,description,value\n' + ''.join([f'{i},"test, ""{i}""",{i / 2}\n' for i in range(1, 6)]) + '6,,\n'
+
+    response = wsgi.test_endpoint('POST', '/test/export', json.dumps({'where': ['value', 'gte', 2], 'order_by': [{'column': 'id', 'direction': 'DESC'}]}))
+    assert [json.loads(line)['id'] for line in response.splitlines()] == [5, 4]
+
+    response = wsgi.test_endpoint('POST', '/test/export', json.dumps({'where': ['value', 'gt', 10], 'format': 'csv'}))
+    assert response == 'id,description,value\n'
+
+    response = wsgi.test_endpoint('POST', '/test/export', json.dumps({'format': 'xml'}))
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Unsupported export format: xml, expected one of: ndjson, csv'})
+
+    response = wsgi.test_endpoint('POST', '/test/export', json.dumps({'format': ['csv']}))
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Must specify the export format as a string, one of: ndjson, csv'})
+
+
+def test_restomatic_csv_import():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT NOT NULL, value REAL)')
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST'], csv_import=True, ingest_batch_size=2)
+
+    wsgi = WSGIDebugger(router.application)
+
+    body = '﻿description, value\r\n' \
+           '"test, ""1""",1.5\r\n' \
+           '"multi\nline",2\r\n' \
+           ',3\r\n' \
+           'too,many,values\r\n' \
+           '\r\n' \
+           'test 5,\r\n'
+
+    response = wsgi.test_endpoint('POST', '/test/import', body)
+    assert_json_response(wsgi, response, '200 OK', {
+        'success': False,
+        'inserted': 3,
+        'failed': 2,
+        'aborted': False,
+        'errors': [
+            # Line numbers count the lines within quoted values
+            {'line': 5, 'message': 'IntegrityError: NOT NULL constraint failed: test.description'},
+            {'line': 6, 'message': 'Expected 2 values, got 3'},
+        ],
+    })
+
+    assert db.select_all('test').all() == [(1, 'test, "1"', 1.5), (2, 'multi\nline', 2.0), (3, 'test 5', None)]
+
+    # Export output can be imported again
+    db.execute('DELETE FROM test')
+    db.commit()
+    response = wsgi.test_endpoint('POST', '/test/import', 'id,description,value\n7,test 7,7\n8,test 8,\n')
+    assert_json_response(wsgi, response, '200 OK', {'success': True, 'inserted': 2, 'failed': 0, 'aborted': False, 'errors': []})
+    assert db.select_all('test').all() == [(7, 'test 7', 7.0), (8, 'test 8', None)]
+
+    response = wsgi.test_endpoint('POST', '/test/import', 'description,bogus\ntest,1\n')
+    assert_json_response(wsgi, response, '400 Bad Request', {
+        'message': 'Unknown columns in CSV header: bogus, expected any of: id, description, value'})
+
+    response = wsgi.test_endpoint('POST', '/test/import', 'value,value\n1,2\n')
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Duplicate columns in CSV header'})
+
+    response = wsgi.test_endpoint('POST', '/test/import')
+    assert wsgi.status == '400 Bad Request'
+
+
+def test_restomatic_batch():
+    db = SQLiteDB(':memory:', table_mappers, row_cache={'test': {}})
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT NOT NULL, value REAL)')
+    db.insert_many_mapped('test', [{'description': f'test {i}', 'value': i} for i in range(1, 4)])
+    db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST', 'PATCH', 'DELETE'], ingest=True)
+    register_batch_endpoint(router, db, max_operations=5)
+
+    wsgi = WSGIDebugger(router.application)
+
+    # Cached before the batch, and invalidated once it has committed
+    wsgi.test_endpoint('GET', '/test/2')
+
+    response = wsgi.test_endpoint('POST', '/_batch', json.dumps({'transaction': True, 'operations': [
+        {'method': 'GET', 'path': '/test/1'},
+        {'method': 'PATCH', 'path': '/test/2', 'body': {'value': 20}},
+        {'method': 'POST', 'path': '/test', 'body': {'description': 'test 4'}},
+        {'method': 'POST', 'path': '/test/search', 'body': {'where': ['value', 'gte', 3]}},
+        {'method': 'GET', 'path': '/other'},
+    ]}))
+    assert_json_response(wsgi, response, '200 OK', {'success': False, 'responses': [
+        {'status': 200, 'body': {'id': 1, 'description': 'test 1', 'value': 1.0}},
+        {'status': 200, 'body': {'success': True}},
+        {'status': 201, 'body': {'success': True, 'id': 4}},
+        {'status': 200, 'body': {'results': [{'id': 2, 'description': 'test 2', 'value': 20.0},
+                                             {'id': 3, 'description': 'test 3', 'value': 3.0}]}},
+        {'status': 404, 'body': '404 Not Found'},
+    ]})
+
+    # The failed batch was rolled back
+    assert db.select_all('test').all() == [(1, 'test 1', 1.0), (2, 'test 2', 2.0), (3, 'test 3', 3.0)]
+
+    response = wsgi.test_endpoint('POST', '/_batch', json.dumps({'transaction': True, 'operations': [
+        {'method': 'PATCH', 'path': '/test/2', 'body': {'value': 20}},
+        {'method': 'DELETE', 'path': '/test/3'},
+        {'method': 'GET', 'path': '/test/2'},
+    ]}))
+    assert_json_response(wsgi, response, '200 OK', {'success': True, 'responses': [
+        {'status': 200, 'body': {'success': True}},
+        {'status': 200, 'body': {'success': True}},
+        {'status': 200, 'body': {'id': 2, 'description': 'test 2', 'value': 20.0}},
+    ]})
+    assert not db.in_transaction()
+    assert db.select_all('test').all() == [(1, 'test 1', 1.0), (2, 'test 2', 20.0)]
+
+    response = wsgi.test_endpoint('GET', '/test/2')
+    assert_json_response(wsgi, response, '200 OK', {'id': 2, 'description': 'test 2', 'value': 20.0})
+
+    # Without a transaction, each operation commits on its own, and all are run
+    response = wsgi.test_endpoint('POST', '/_batch', json.dumps({'operations': [
+        {'method': 'PATCH', 'path': '/test/1', 'body': {'description': None}},
+        {'method': 'POST', 'path': '/test/ingest', 'body': {'description': 'test 5'}},
+        {'method': 'DELETE', 'path': '/test/2'},
+    ]}))
+    assert_json_response(wsgi, response, '200 OK', {'success': False, 'responses': [
+        {'status': 500, 'body': {'message': 'IntegrityError: NOT NULL constraint failed: test.description'}},
+        {'status': 400, 'body': {'message': 'Endpoints with the stream in_format cannot be called internally'}},
+        {'status': 200, 'body': {'success': True}},
+    ]})
+    assert db.select_all('test').all() == [(1, 'test 1', 1.0)]
+
+    response = wsgi.test_endpoint('POST', '/_batch', json.dumps({'operations': [{'method': 'GET', 'path': '/test/1'}] * 6}))
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Too many operations in one batch, the maximum is 5'})
+
+    response = wsgi.test_endpoint('POST', '/_batch', json.dumps({'operations': [{'method': 'POST', 'path': '/_batch'}]}))
+    assert_json_response(wsgi, response, '400 Bad Request', {'message': 'Batches cannot be nested'})
+
+    response = wsgi.test_endpoint('POST', '/_batch', json.dumps([{'method': 'GET', 'path': '/test/1'}]))
+    assert wsgi.status == '400 Bad Request'
+
+
+@pytest.mark.parametrize('codec_name', ['json', 'orjson'])
+def test_restomatic_json_codec(codec_name):
+    if codec_name == 'orjson':
+        pytest.importorskip('orjson')
+
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+    db.insert_mapped('test', {'description': 'test é', 'value': float('inf')})
+
+    router = EndpointRouter(json_codec=codec_name)
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    # The GET and search responses are encoded with the router's codec (where orjson writes Infinity as null)
+    expected = {'id': 1, 'description': 'test é', 'value': None if codec_name == 'orjson' else 'Infinity'}
+
+    response = wsgi.test_endpoint('GET', '/test/1')
+    assert json.loads(response, parse_constant=str) == expected
+
+    response = wsgi.test_endpoint('POST', '/test/search', json.dumps({'where': ['id', 'eq', 1]}))
+    assert json.loads(response, parse_constant=str) == {'results': [expected]}
+
+
+def test_restomatic_read_connections(tmp_path):
+    db = SQLiteDB(str(tmp_path / 'read.db'), table_mappers, read_connections=2, pragma_profile='write-heavy')
+
+    with db.checkout():
+        db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT NOT NULL, value REAL)')
+        db.insert_mapped('test', {'description': 'test 1', 'value': 1})
+        db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST', 'PATCH'])
+
+    wsgi = WSGIDebugger(router.application)
+
+    # Reads (including searches) use the read-only connections, and writes the writer
+    assert json.loads(wsgi.test_endpoint('GET', '/test/1'))['value'] == 1.0
+    assert db.read_pool_stats()['checkouts'] == 1
+    where = {'where': ['value', 'eq', 1.0]}
+    assert len(json.loads(wsgi.test_endpoint('POST', '/test/search', json.dumps(where)))) == 1
+    assert len(json.loads(wsgi.test_endpoint('POST', '/test/where', json.dumps(where)))) == 1
+    assert db.read_pool_stats()['checkouts'] == 3
+
+    wsgi.test_endpoint('PATCH', '/test/1', json.dumps({'value': 2}))
+    assert wsgi.status == '200 OK'
+    assert db.read_pool_stats()['checkouts'] == 3
+    assert json.loads(wsgi.test_endpoint('GET', '/test/1'))['value'] == 2.0
+
+    db.close()
+
+
+def test_restomatic_group_commit(tmp_path):
+    db_path = str(tmp_path / 'group_commit.db')
+    db = SQLiteDB(db_path, table_mappers, pool_size=4, pragma_profile='write-heavy', row_cache={'test': {}},
+                  group_commit_window=0.2)
+
+    with db.checkout():
+        db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT NOT NULL, value REAL)')
+        db.insert_mapped('test', {'description': 'test 1', 'value': 1})
+        db.commit()
+
+    router = EndpointRouter()
+
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST', 'PATCH'])
+
+    # Cached before the writes, and invalidated once they are committed
+    assert json.loads(WSGIDebugger(router.application).test_endpoint('GET', '/test/1'))['value'] == 1.0
+
+    bodies = [{'description': f'test {i}', 'value': i} for i in range(2, 8)] + [{'value': 8}]
+    barrier = threading.Barrier(len(bodies) + 1)
+    responses = {}
+
+    def post(i, body):
+        wsgi = WSGIDebugger(router.application)
+        barrier.wait()
+        responses[i] = (wsgi.test_endpoint('POST', '/test', json.dumps(body)), wsgi.status)
+
+    def patch():
+        wsgi = WSGIDebugger(router.application)
+        barrier.wait()
+        responses['patch'] = (wsgi.test_endpoint('PATCH', '/test/1', json.dumps({'value': 10})), wsgi.status)
+
+    threads = [threading.Thread(target=post, args=(i, body)) for i, body in enumerate(bodies)]
+    threads.append(threading.Thread(target=patch))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each request gets its own result, and the failing one only rolls back its own changes
+    assert sorted([json.loads(responses[i][0])['id'] for i in range(6)]) == [2, 3, 4, 5, 6, 7]
+    assert all([responses[i][1] == '201 Created' for i in range(6)])
+    assert json.loads(responses[6][0]) == {'message': 'IntegrityError: NOT NULL constraint failed: test.description'}
+    assert responses[6][1] == '500 Internal Server Error'
+    assert json.loads(responses['patch'][0]) == {'success': True}
+
+    stats = db.group_commit_stats()
+    assert stats['writes'] == 8
+    assert stats['groups'] < stats['writes']
+
+    # Searches are not run as writes
+    wsgi = WSGIDebugger(router.application)
+    for path in ('/test/search', '/test/where'):
+        response = wsgi.test_endpoint('POST', path, json.dumps({'where': ['id', 'eq', 2]}))
+        assert json.loads(response)['results'][0]['id'] == 2
+    assert db.group_commit_stats()['writes'] == 8
+
+    wsgi = WSGIDebugger(router.application)
+    assert json.loads(wsgi.test_endpoint('GET', '/test/1'))['value'] == 10.0
+
+    with db.checkout():
+        assert db.select_all('test').count().scalar() == 7
+
+    db.close()
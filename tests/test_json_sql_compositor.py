@@ -1,7 +1,12 @@
+import json
+import threading
 import pytest
-from sqlite3 import IntegrityError
+from sqlite3 import IntegrityError, OperationalError
 
-from restomatic.json_sql_compositor import SQLiteDB, SQLQuery, SQLCompositorBadInput, SQLCompositorBadResult
+from restomatic.json_sql_compositor import SQLiteDB, SQLQuery, SQLCompositorBadInput, SQLCompositorBadResult, SQLCompositorPoolTimeout, \
+    JSONRowSerializer, generate_seek_predicate
+from restomatic.json_codec import StdlibJSONCodec
+from restomatic.metrics import Metrics
 
 table_mappers = {
     'test': ['id', 'description', 'value']
@@ -275,3 +280,533 @@ def test_exceptions():
 
     assert bad_result.status_code == 401
     assert bad_result.to_dict() == {'found exception': 'here', 'message': 'message'}
+
+
+def test_statement_cache():
+    db = SQLiteDB(':memory:', table_mappers, statement_cache_size=2, cached_statements=16)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    db.insert_mapped('test', ({'description': 'test 1', 'value': 1.0}, {'description': 'test 2', 'value': 2.0},
+                              {'description': 'test 3', 'value': 3.0}))
+
+    assert db.statement_cache_info() == {'hits': 0, 'misses': 1, 'size': 1, 'max_size': 2}
+
+    assert db.select_all('test').where(['id', 'eq', 1]).one() == (1, 'test 1', 1.0)
+    assert db.select_all('test').where(['id', 'eq', 2]).one() == (2, 'test 2', 2.0)
+
+    assert db.statement_cache_info() == {'hits': 1, 'misses': 2, 'size': 2, 'max_size': 2}
+
+    # Limit and offset are bound, so different pages share the same shape
+    assert db.select_all('test').order_by('id').limit(1).offset(0).one() == (1, 'test 1', 1.0)
+    assert db.select_all('test').order_by('id').limit(1).offset(2).one() == (3, 'test 3', 3.0)
+
+    # Different lengths of in lists are different shapes
+    assert db.select_all('test').where(['id', 'in', [1]]).all() == [(1, 'test 1', 1.0)]
+    assert db.select_all('test').where(['id', 'in', [1, 2]]).all() == [(1, 'test 1', 1.0), (2, 'test 2', 2.0)]
+
+    update = db.update_mapped('test', {'value': 5.0}).where(['id', 'eq', 1])
+    update.run()
+    update.run()
+
+    assert db.select_all('test').where(['id', 'eq', 1]).one() == (1, 'test 1', 5.0)
+
+    assert db.statement_cache_info() == {'hits': 3, 'misses': 7, 'size': 2, 'max_size': 2}
+
+    db_no_cache = SQLiteDB(':memory:', table_mappers, statement_cache_size=0)
+
+    assert db_no_cache.select_all('test').where(['id', 'eq', 1]).shape_key() == \
+        db_no_cache.select_all('test').where(['id', 'eq', 2]).shape_key()
+    assert db_no_cache.select_all('test').where(['id', 'eq', 1]).shape_key() != \
+        db_no_cache.select_all('test').where(['id', 'lt', 1]).shape_key()
+    assert db_no_cache.statement_cache_info() == {'hits': 0, 'misses': 0, 'size': 0, 'max_size': 0}
+
+
+def test_connection_pool(tmp_path):
+    db = SQLiteDB(str(tmp_path / 'pool.db'), table_mappers, pool_size=2, pool_timeout=0.05)
+
+    assert SQLiteDB(':memory:', table_mappers).pool_stats() is None
+    with pytest.raises(SQLCompositorBadInput):
+        SQLiteDB(':memory:', table_mappers, pool_size=2)
+
+    with db.checkout():
+        db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+        db.commit(no_changes_ok=True)
+
+    def insert_rows(thread_index):
+        for i in range(10):
+            with db.checkout():
+                db.insert_mapped('test', {'description': f'thread {thread_index}', 'value': i})
+                db.commit()
+
+    threads = [threading.Thread(target=insert_rows, args=(t, )) for t in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with db.checkout() as conn:
+        # Nested checkouts use the same connection
+        with db.checkout() as nested_conn:
+            assert nested_conn is conn
+        assert db.select_all('test').count().scalar() == 40
+
+        # Uncommitted changes are rolled back when the connection is returned
+        db.delete('test').run()
+        assert db.in_transaction() is True
+
+    with db.checkout():
+        assert db.in_transaction() is False
+        assert db.select_all('test').count().scalar() == 40
+
+        other_thread_errors = []
+
+        def checkout_from_other_thread():
+            with db.checkout():
+                try:
+                    # Both connections are now checked out
+                    db.pool.acquire()
+                except SQLCompositorPoolTimeout as e:
+                    other_thread_errors.append(e)
+
+        thread = threading.Thread(target=checkout_from_other_thread)
+        thread.start()
+        thread.join()
+
+        assert len(other_thread_errors) == 1
+        assert other_thread_errors[0].status_code == 503
+
+    stats = db.pool_stats()
+    assert stats['size'] == 2
+    assert stats['open'] == 2
+    assert stats['idle'] == 2
+    assert stats['checkouts'] == 44
+    assert stats['timeouts'] == 1
+    assert stats['max_wait_time'] >= stats['average_wait_time']
+
+    db.close()
+
+    assert db.pool_stats()['open'] == 0
+
+
+def test_pragma_profiles(tmp_path):
+    db = SQLiteDB(str(tmp_path / 'pragmas.db'), table_mappers, pragma_profile='read-heavy', pragmas={'busy_timeout': 1234})
+
+    assert db.connection_pragmas == [
+        'PRAGMA busy_timeout = 1234',
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -65536',
+        'PRAGMA mmap_size = 268435456',
+        'PRAGMA temp_store = MEMORY',
+    ]
+
+    assert db.execute('PRAGMA journal_mode').one() == ('wal', )
+    assert db.execute('PRAGMA synchronous').one() == (1, )
+    assert db.execute('PRAGMA busy_timeout').one() == (1234, )
+    assert db.execute('PRAGMA temp_store').one() == (2, )
+
+    db.close()
+
+    pooled_db = SQLiteDB(str(tmp_path / 'pragmas.db'), table_mappers, pool_size=1,
+                         pragma_profile={'synchronous': 'full', 'cache_size': '-2000'})
+
+    with pooled_db.checkout():
+        assert pooled_db.execute('PRAGMA synchronous').one() == (2, )
+        assert pooled_db.execute('PRAGMA cache_size').one() == (-2000, )
+
+    pooled_db.close()
+
+    assert SQLiteDB(':memory:', table_mappers).connection_pragmas == []
+
+    with pytest.raises(ValueError):
+        SQLiteDB(':memory:', table_mappers, pragma_profile='bogus')
+
+    with pytest.raises(ValueError):
+        SQLiteDB(':memory:', table_mappers, pragmas={'journal_mode': 'bogus'})
+
+    with pytest.raises(TypeError):
+        SQLiteDB(':memory:', table_mappers, pragmas={'mmap_size': -1})
+
+    with pytest.raises(SQLCompositorBadInput):
+        SQLiteDB(':memory:', table_mappers, pragmas={'writable_schema': 1})
+
+
+def test_keyset_pagination():
+    db = SQLiteDB(':memory:', table_mappers)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    db.insert('test', ('description', 'value')).values([
+        ['a', 2.0], ['b', None], ['c', 1.0], ['d', 2.0], ['e', None], ['f', 3.0], ['g', 1.0],
+    ])
+
+    def all_pages(order_by, page_size):
+        pages = []
+        token = None
+        while True:
+            query = db.select_all('test')
+            if order_by:
+                query = query.order_by(order_by)
+            query = query.keyset(token).limit(page_size)
+            rows = query.all_mapped()
+            pages.append([r['description'] for r in rows])
+            if len(rows) < page_size:
+                return pages
+            token = query.next_keyset_token(rows[-1])
+
+    assert all_pages(None, 3) == [['a', 'b', 'c'], ['d', 'e', 'f'], ['g']]
+    assert all_pages('value', 2) == [['b', 'e'], ['c', 'g'], ['a', 'd'], ['f']]
+
+    for order_by in ('value', {'column': 'value', 'direction': 'desc'}, ['description'],
+                     [{'column': 'value', 'direction': 'DESC'}, {'column': 'id', 'direction': 'DESC'}]):
+        expected = [r[1] for r in db.select_all('test').order_by(order_by).keyset().all()]
+        for page_size in (1, 2, 3, 7):
+            pages = all_pages(order_by, page_size)
+            assert [d for page in pages for d in page] == expected
+            assert all(len(page) == page_size for page in pages[:-1])
+
+    # Row value comparisons when all directions match (and no after value is NULL), otherwise one term per column
+    fill_values = []
+    assert generate_seek_predicate([('value', 'ASC'), ('id', 'ASC')], [1.0, 3], fill_values) == '("value", "id") > (?, ?)'
+    assert fill_values == [1.0, 3]
+    fill_values = []
+    assert generate_seek_predicate([('value', 'DESC'), ('id', 'DESC')], [1.0, 3], fill_values) == \
+        '(("value", "id") < (?, ?)) OR ("value" IS NULL) OR ("value" = ? AND "id" IS NULL)'
+    assert fill_values == [1.0, 3, 1.0]
+    fill_values = []
+    assert generate_seek_predicate([('value', 'DESC'), ('id', 'ASC')], [1.0, 3], fill_values) == \
+        '(("value" < ? OR "value" IS NULL)) OR ("value" = ? AND "id" > ?)'
+    assert fill_values == [1.0, 1.0, 3]
+    fill_values = []
+    assert generate_seek_predicate([('value', 'ASC'), ('id', 'ASC')], [None, 3], fill_values) == \
+        '("value" IS NOT NULL) OR ("value" IS NULL AND "id" > ?)'
+    assert fill_values == [3]
+
+    query = db.select_all('test').where(['value', 'isnotnull']).order_by('value').keyset(
+        db.select_all('test').order_by('value').keyset().next_keyset_token({'id': 3, 'value': 1.0}))
+    assert [r[1] for r in query.all()] == ['g', 'a', 'd', 'f']
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.select_all('test').keyset('bogus')
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.select_all('test').order_by('description').keyset(
+            db.select_all('test').order_by('value').keyset().next_keyset_token({'id': 3, 'value': 1.0}))
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.select_all('test').next_keyset_token({'id': 3})
+
+    with pytest.raises(ValueError):
+        db.select_all('test').order_by({'column': 'value', 'direction': 'DESC, id'})
+
+
+def test_insert_many_mapped():
+    db = SQLiteDB(':memory:', table_mappers, preprocessors={'test': {'value': value_preprocessor}})
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value INTEGER)')
+
+    db.insert_mapped('test', {'description': 'test 1', 'value': 2})
+
+    ids = db.insert_many_mapped('test', [
+        {'description': 'test 2', 'value': 3},
+        {'description': 'test 3'},
+        {'value': 5, 'description': 'test 4'},
+        {'id': 10, 'description': 'test 10'},
+        {'description': 'test 5'},
+    ])
+
+    assert ids == [2, 4, 3, 10, 5]
+
+    assert db.select_all('test').all() == [
+        (1, 'test 1', 1),
+        (2, 'test 2', 2),
+        (3, 'test 4', 4),
+        (4, 'test 3', None),
+        (5, 'test 5', None),
+        (10, 'test 10', None),
+    ]
+
+    # Each group of columns is one (cached) statement
+    assert db.statement_cache_info()['misses'] == 4
+
+    assert db.insert_many_mapped('test', []) == []
+
+    # Ids which are not given as integers (such as null) are the rowids SQLite assigns
+    assert db.insert_many_mapped('test', [{'id': None, 'description': 'a'}, {'id': '20', 'description': 'b'},
+                                          {'id': None, 'description': 'c'}]) == [11, 20, 21]
+    assert db.select('test', ['id', 'description']).where(['id', 'gt', 10]).all() == [(11, 'a'), (20, 'b'), (21, 'c')]
+
+    with pytest.raises(TypeError):
+        db.insert_many_mapped('test', [{'description': 'test 6'}, 5])
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.insert_many_mapped('test', [{}])
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.insert_many_mapped('test', [{'bogus': 1}])
+
+
+def test_put_many_mapped():
+    db = SQLiteDB(':memory:', table_mappers, preprocessors={'test': {'description': description_validator}})
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value INTEGER)')
+
+    db.insert_many_mapped('test', [{'description': 'test 1', 'value': 1}, {'description': 'test 2', 'value': 2}])
+
+    # Updates only the given columns (in order), skips ids which do not exist, and inserts rows without an id
+    db.put_many_mapped('test', [
+        {'id': 1, 'description': 'test 1', 'value': 10},
+        {'id': 2, 'value': 20},
+        {'description': 'test 3', 'value': 3},
+        {'id': 5, 'description': 'test 5', 'value': 5},
+        {'id': 1, 'value': 11},
+        {'id': 1, 'value': 12, 'description': 'test one'},
+    ])
+
+    assert db.select_all('test').all() == [
+        (1, 'test one', 12),
+        (2, 'test 2', 20),
+        (3, 'test 3', 3),
+    ]
+
+    with pytest.raises(RuntimeError):
+        db.put_many_mapped('test', [{'id': 1, 'description': 'bogus'}])
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.put_many_mapped('test', [{}])
+
+    with pytest.raises(SQLCompositorBadInput):
+        db.update('test').set_values_many([{'value': 1}])
+
+
+def test_processor_pipelines():
+    db = SQLiteDB(':memory:', table_mappers, preprocessors={
+        'test': {
+            'value': [value_preprocessor, value_preprocessor],
+        },
+    }, postprocessors={
+        'test': {
+            'value': value_postprocessor,
+        }
+    })
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value INTEGER)')
+
+    db.insert('test', ('description', 'value')).values([['test 1', 10], ['test 2', 20]])
+
+    # Compiled once per table, column list and mode
+    pipeline = db.get_processor_pipeline('test', ['id', 'description', 'value'], 'SELECT')
+    assert pipeline is db.get_processor_pipeline('test', ('id', 'description', 'value'), 'SELECT')
+    assert pipeline.steps == ((2, (value_postprocessor, )), )
+
+    insert_pipeline = db.get_processor_pipeline('test', ('description', 'value'), 'INSERT INTO')
+    assert insert_pipeline.steps == ((1, (value_preprocessor, value_preprocessor)), )
+    assert insert_pipeline.context == {'db': db, 'mode': 'INSERT INTO'}
+
+    assert db.select_all('test').all() == [[1, 'test 1', 9], [2, 'test 2', 19]]
+
+    # Rows without any processed columns are returned as-is
+    assert db.select('test', ['id', 'description']).all() == [(1, 'test 1'), (2, 'test 2')]
+    assert db.select('test', ['description']).where(['value', 'eq', 20]).one() == ('test 2', )
+
+    assert db.select_all('test').count().scalar() == 2
+
+    assert list(db.select_all('test').result().chunks(1)) == [[[1, 'test 1', 9]], [[2, 'test 2', 19]]]
+
+
+def test_json_serialization():
+    db = SQLiteDB(':memory:', table_mappers, postprocessors={'test': {'value': lambda value: value is not None and value > 1}})
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    db.insert('test', ('description', 'value')).values([['Quote " and \\ and é \U0001F600', 1.5], [None, None]])
+
+    for query in (db.select_all('test'), db.select('test', ['description', 'id']), db.select('test', ['id'])):
+        assert json.loads(query.all_json()) == query.all_mapped()
+
+    assert db.select('test', ['description', 'id']).all_mapped() == [
+        {'description': 'Quote " and \\ and é \U0001F600', 'id': 1},
+        {'description': None, 'id': 2},
+    ]
+
+    assert db.select_all('test').where(['id', 'eq', 2]).one_json() == '{"id":2,"description":null,"value":false}'
+    assert db.select_all('test').where(['id', 'eq', 3]).one_or_none_json() is None
+
+    serializer = db.select('test', ['id', 'value']).json_serializer()
+    assert serializer is db.get_json_serializer(('id', 'value'))
+    assert serializer.rows([(1, 0.1), (-2, float('nan')), (3, float('-inf'))]) == \
+        '{"id":1,"value":0.1},{"id":-2,"value":NaN},{"id":3,"value":-Infinity}'
+
+    assert JSONRowSerializer(['100%']).row(['x']) == '{"100%":"x"}'
+
+    # Bytes, with the templates for the json module codec, and otherwise encoded by the codec
+    assert serializer.row_bytes((1, 0.1)) == b'{"id":1,"value":0.1}'
+    assert db.get_json_serializer(('id', 'value'), StdlibJSONCodec()).rows_bytes([(1, None), (2, 'é')]) == \
+        b'{"id":1,"value":null},{"id":2,"value":"\\u00e9"}'
+
+    class UpperCodec():
+        def dumps(self, data):
+            return json.dumps(data).upper().encode('utf-8')
+
+        def loads(self, data):
+            return json.loads(data)
+
+    codec = UpperCodec()
+    codec_serializer = db.get_json_serializer(('id', 'value'), codec)
+    assert codec_serializer is not serializer
+    assert codec_serializer.row_bytes((1, 'x')) == b'{"ID": 1, "VALUE": "X"}'
+    assert codec_serializer.rows_bytes([(1, 'x'), (2, None)]) == b'{"ID": 1, "VALUE": "X"},{"ID": 2, "VALUE": NULL}'
+
+
+def test_query_metrics():
+    metrics = Metrics()
+    db = SQLiteDB(':memory:', table_mappers, metrics=metrics)
+
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+
+    db.insert('test', ('description', 'value')).values([['test 1', 0.5], ['test 2', 1.5], ['test 3', 2.5]])
+    db.commit()
+
+    for _ in range(2):
+        assert len(db.select_all('test').where(['value', 'gt', 1]).all()) == 2
+
+    with pytest.raises(IntegrityError):
+        db.insert('test', ('id', 'description')).values([1, 'duplicate'])
+
+    select_statement = 'SELECT "id","description","value" FROM test WHERE "value" > ?'
+    insert_statement = 'INSERT INTO test("description","value") VALUES (?,?)'
+    assert metrics.statements[select_statement]['executions'] == 2
+    assert metrics.statements[select_statement]['rows_returned'] == 4
+    assert metrics.statements[insert_statement]['rows_affected'] == 3
+    assert metrics.statements['INSERT INTO test("id","description") VALUES (?,?)']['errors'] == 1
+
+    output = metrics.render_prometheus()
+    label = select_statement.replace('"', '\\"')
+    assert f'restomatic_statement_executions_total{{statement="{label}"}} 2\n' in output
+    assert f'restomatic_statement_duration_seconds_count{{statement="{label}"}} 2\n' in output
+    assert f'restomatic_statement_duration_seconds_bucket{{statement="{label}",le="+Inf"}} 2\n' in output
+    assert 'restomatic_statement_cache_hits_total{db=":memory:"} 1\n' in output
+
+    limited = Metrics(max_statements=1)
+    limited.record_statement('SELECT 1', 0.001)
+    limited.record_statement('SELECT 2', 0.001)
+    assert sorted(limited.statements.keys()) == ['SELECT 1', 'other']
+
+
+def test_migrate_schema(tmp_path):
+    db_path = str(tmp_path / 'schema.db')
+    schema_mappers = {
+        'test': {
+            'columns': {'id': 'INTEGER', 'description': 'TEXT NOT NULL', 'value': 'REAL'},
+            'primary_key': 'id',
+            'indexes': [
+                {'columns': ['description']},
+                {'columns': ['description', {'column': 'value', 'direction': 'DESC'}], 'unique': True},
+                {'columns': ['value'], 'where': {'and': [['value', 'isnotnull'], ['description', 'in', ["it's", 'b']]]}},
+            ],
+        },
+        'other': ['id', 'name'],
+    }
+
+    db = SQLiteDB(db_path, schema_mappers)
+    assert db.table_mappers == {'test': ['id', 'description', 'value'], 'other': ['id', 'name']}
+    assert db.migrate_schema() == [
+        'CREATE TABLE IF NOT EXISTS test ("id" INTEGER, "description" TEXT NOT NULL, "value" REAL, PRIMARY KEY ("id"))',
+        'CREATE INDEX "idx_test_description" ON test("description")',
+        'CREATE UNIQUE INDEX "idx_test_description_value" ON test("description","value" DESC)',
+        'CREATE INDEX "idx_test_value" ON test("value") WHERE ("value" IS NOT NULL) AND ("description" IN (\'it\'\'s\',\'b\'))',
+    ]
+    assert db.migrate_schema() == []
+
+    assert db.insert_many_mapped('test', [{'description': 'a', 'value': 1.0}, {'description': 'b'}]) == [1, 2]
+    db.commit()
+    db.close()
+
+    # Add a column and a covering index, and change an index
+    schema_mappers['test']['columns']['created'] = 'TEXT'
+    schema_mappers['test']['indexes'][0] = {'columns': ['description'], 'include': ['created']}
+    schema_mappers['test']['indexes'][1]['unique'] = False
+
+    db = SQLiteDB(db_path, schema_mappers)
+    assert db.migrate_schema() == [
+        'ALTER TABLE test ADD COLUMN "created" TEXT',
+        'CREATE INDEX "idx_test_description_created" ON test("description","created")',
+        'DROP INDEX "idx_test_description_value"',
+        'CREATE INDEX "idx_test_description_value" ON test("description","value" DESC)',
+    ]
+    assert db.migrate_schema() == []
+    assert db.select_all('test').all_mapped() == [
+        {'id': 1, 'description': 'a', 'value': 1.0, 'created': None},
+        {'id': 2, 'description': 'b', 'value': None, 'created': None},
+    ]
+
+    with pytest.raises(SQLCompositorBadInput):
+        SQLiteDB(':memory:', {'test': {'columns': ['id'], 'indexes': [{'columns': ['id']}, {'columns': ['id'], 'unique': True}]}})
+
+    with pytest.raises(ValueError):
+        SQLiteDB(':memory:', {'test': {'columns': ['id'], 'indexes': [{'columns': ['missing']}]}})
+
+
+def test_read_connections(tmp_path):
+    db = SQLiteDB(str(tmp_path / 'read.db'), table_mappers, read_connections=2, pool_timeout=1.0,
+                  pragma_profile='write-heavy')
+
+    with pytest.raises(SQLCompositorBadInput):
+        SQLiteDB(':memory:', table_mappers, read_connections=2)
+    with pytest.raises(SQLCompositorBadInput):
+        SQLiteDB(str(tmp_path / 'other.db'), table_mappers, read_connections=2, pool_size=4)
+    with pytest.raises(SQLCompositorBadInput):
+        SQLiteDB(str(tmp_path / 'other.db'), table_mappers, read_connections=2, group_commit_window=0.01)
+
+    with db.checkout():
+        db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+        db.insert_many_mapped('test', [{'description': f'test {i}', 'value': i} for i in range(1, 101)])
+        db.commit()
+
+    with db.checkout(read_only=True) as conn:
+        with db.checkout(read_only=True) as nested_conn:
+            assert nested_conn is conn
+        with pytest.raises(OperationalError):
+            conn.execute('DELETE FROM test')
+
+        # A long read (with an open statement) does not block writes from other threads
+        result = db.select_all('test').result()
+        assert result.fetchone() == (1, 'test 1', 1.0)
+
+        def write_from_other_thread():
+            with db.checkout():
+                db.update_mapped('test', {'value': 0}).where(('id', 'eq', 1)).run()
+                db.commit()
+
+        thread = threading.Thread(target=write_from_other_thread)
+        thread.start()
+        thread.join()
+        assert len(result.fetchall()) == 99
+
+        # Writes check out the writer, which the rest of the block then uses
+        db.update_mapped('test', {'value': 2.5}).where(('id', 'eq', 2)).run()
+        assert db.in_transaction() is True
+        assert db.select('test', ['value']).where(('id', 'eq', 2)).scalar() == 2.5
+        db.commit()
+
+    assert db.pool_stats() is None
+    assert db.read_pool_stats()['checkouts'] == 1
+
+    # Writes outside of a checkout use the same (one) writer connection
+    writer = db.connection()
+    db.update_mapped('test', {'value': 3.5}).where(('id', 'eq', 3)).run()
+    assert writer.in_transaction is True
+    db.commit()
+    with db.checkout() as conn:
+        assert conn is writer
+
+    with db.checkout(read_only=True):
+        assert db.select('test', ['value']).where(('id', 'in', [1, 2, 3])).all() == [(0.0, ), (2.5, ), (3.5, )]
+
+    # Read-only checkouts within a writer checkout use the writer
+    with db.checkout() as conn:
+        with db.checkout(read_only=True) as nested_conn:
+            assert nested_conn is conn
+
+    db.close()
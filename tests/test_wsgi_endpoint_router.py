@@ -1,10 +1,18 @@
+import asyncio
+import gzip
 import json
 import pytest
 import html
+import zlib
 
-from restomatic.wsgi_endpoint_router import EndpointRouter, EndpointRouterBadDefinition, EndpointRouterBadInput
+from restomatic import wsgi_endpoint_router
+from restomatic.wsgi_endpoint_router import EndpointRouter, EndpointRouterBadDefinition, EndpointRouterBadInput, StreamingResponse, EncodedResponse, \
+    PrefixTree, negotiate_encoding
 
 from restomatic.wsgi_debugger import WSGIDebugger
+from restomatic.metrics import Metrics
+from restomatic.endpoint import register_restomatic_endpoint
+from restomatic.json_sql_compositor import SQLiteDB
 
 
 def endpt_index(request):
@@ -189,3 +197,406 @@ def test_exceptions():
 
     assert bad_input.status_code == 401
     assert bad_input.to_dict() == {'found exception': 'here', 'message': 'message'}
+
+
+def test_endpoint_router_metrics():
+    metrics = Metrics()
+    router = EndpointRouter(metrics=metrics)
+
+    router.register_endpoint(endpt_index, exact=['/', '/index.html'], method='GET')
+    router.register_endpoint(endpt_echo, prefix='/echo', method='GET', out_format='json')
+    router.register_endpoint(endpt_exception, exact='/whoops', method='GET')
+    router.register_metrics_endpoint()
+
+    wsgi = WSGIDebugger(router.application)
+
+    wsgi.test_endpoint('GET', '/')
+    wsgi.test_endpoint('GET', '/echo/one')
+    wsgi.test_endpoint('GET', '/echo/two')
+    wsgi.test_endpoint('POST', '/echo/three')
+    wsgi.test_endpoint('GET', '/whoops')
+    wsgi.test_endpoint('GET', '/not_found')
+
+    response = wsgi.test_endpoint('GET', '/_metrics')
+    assert wsgi.status == '200 OK'
+    assert wsgi.headers[0] == ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+
+    assert 'restomatic_requests_total{method="GET",route="/",status="200"} 1\n' in response
+    assert 'restomatic_requests_total{method="GET",route="/echo",status="200"} 2\n' in response
+    assert 'restomatic_requests_total{method="POST",route="/echo",status="405"} 1\n' in response
+    assert 'restomatic_requests_total{method="GET",route="/whoops",status="500"} 1\n' in response
+    assert 'restomatic_requests_total{method="GET",route="unmatched",status="404"} 1\n' in response
+    assert 'restomatic_request_duration_seconds_count{method="GET",route="/echo"} 2\n' in response
+    assert '# TYPE restomatic_request_duration_seconds histogram\n' in response
+
+    with pytest.raises(EndpointRouterBadDefinition):
+        EndpointRouter().register_metrics_endpoint()
+
+
+def test_endpoint_router_etags():
+    router = EndpointRouter()
+
+    versions = {'current': 'v1'}
+    calls = []
+
+    def endpt_versioned(request):
+        calls.append(request['body'])
+        return {'version': versions['current']}
+
+    router.register_endpoint(endpt_index, exact='/', method='GET', etag=True)
+    router.register_endpoint(endpt_versioned, exact='/versioned', method='POST', in_format='json', out_format='json',
+                             etag=lambda request: versions['current'])
+    router.register_endpoint(endpt_index, exact='/post', method='POST', etag=True)
+
+    wsgi = WSGIDebugger(router.application)
+
+    response = wsgi.test_endpoint('GET', '/')
+    etag = dict(wsgi.headers)['ETag']
+    assert response == 'Hello World!'
+    assert etag.startswith('"') and etag.endswith('"')
+
+    response = wsgi.test_endpoint('GET', '/', headers={'If-None-Match': etag})
+    assert response == ''
+    assert wsgi.status == '304 Not Modified'
+    assert wsgi.headers == [('ETag', etag)]
+
+    for if_none_match in (f'"other", W/{etag}', '*'):
+        wsgi.test_endpoint('GET', '/', headers={'If-None-Match': if_none_match})
+        assert wsgi.status == '304 Not Modified'
+
+    response = wsgi.test_endpoint('GET', '/', headers={'If-None-Match': '"other"'})
+    assert response == 'Hello World!'
+    assert wsgi.status == '200 OK'
+
+    # If-None-Match is only checked for other methods with an etag function
+    response = wsgi.test_endpoint('POST', '/post', headers={'If-None-Match': etag})
+    assert wsgi.status == '200 OK'
+
+    response = wsgi.test_endpoint('POST', '/versioned', json.dumps({'a': 1}))
+    assert json.loads(response) == {'version': 'v1'}
+    assert dict(wsgi.headers)['ETag'] == '"v1"'
+
+    response = wsgi.test_endpoint('POST', '/versioned', json.dumps({'a': 2}), headers={'If-None-Match': '"v1"'})
+    assert wsgi.status == '304 Not Modified'
+    assert calls == [{'a': 1}]
+
+    versions['current'] = 'v2'
+    response = wsgi.test_endpoint('POST', '/versioned', json.dumps({'a': 3}), headers={'If-None-Match': '"v1"'})
+    assert json.loads(response) == {'version': 'v2'}
+    assert dict(wsgi.headers)['ETag'] == '"v2"'
+
+    with pytest.raises(EndpointRouterBadDefinition):
+        router.register_endpoint(endpt_index, exact='/bad', method='GET', etag='v1')
+
+
+def run_asgi(application, scope, body_chunks=(b'', )):
+    # Runs one ASGI request or lifespan to completion, returning the sent messages
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(body_chunks) - 1}
+                for i, chunk in enumerate(body_chunks)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(application(scope, receive, send))
+    finally:
+        loop.close()
+    return sent
+
+
+def test_endpoint_router_asgi():
+    router = EndpointRouter(asgi_max_workers=2)
+
+    def endpt_stream(request):
+        return StreamingResponse(iter(['one,', '', 'two,', 'three']))
+
+    router.register_endpoint(endpt_index, exact='/', method='GET')
+    router.register_endpoint(endpt_echo, prefix='/echo', method='GET', out_format='json')
+    router.register_endpoint(endpt_echo_body, exact='/echo_body', method='PATCH', in_format='json', out_format='json')
+    router.register_endpoint(endpt_stream, exact='/stream', method='GET')
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'GET', 'path': '/', 'headers': []})
+    assert sent == [
+        {'type': 'http.response.start', 'status': 200,
+         'headers': [(b'content-type', b'text/plain; charset=utf-8'), (b'content-length', b'12')]},
+        {'type': 'http.response.body', 'body': b'Hello World!', 'more_body': False},
+    ]
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'GET', 'path': '/echo/a b',
+                                              'raw_path': b'/echo/a%20b', 'query_string': b'x=1'})
+    assert json.loads(sent[1]['body']) == {'You sent this uri': '/echo/a b'}
+
+    body = json.dumps({'testing': 'yep'}).encode('utf-8')
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'PATCH', 'path': '/echo_body',
+                                              'headers': [(b'content-type', b'application/json')]},
+                    [body[:5], body[5:]])
+    assert sent[0]['status'] == 200
+    assert json.loads(sent[1]['body']) == {'You sent this request body': {'testing': 'yep'}}
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'GET', 'path': '/stream'})
+    assert sent == [
+        {'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'text/plain; charset=utf-8')]},
+        {'type': 'http.response.body', 'body': b'one,', 'more_body': True},
+        {'type': 'http.response.body', 'body': b'two,', 'more_body': True},
+        {'type': 'http.response.body', 'body': b'three', 'more_body': True},
+        {'type': 'http.response.body', 'body': b'', 'more_body': False},
+    ]
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'POST', 'path': '/'})
+    assert sent[0]['status'] == 405
+    assert (b'allow', b'GET') in sent[0]['headers']
+
+    lifespan_messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+
+    async def lifespan_receive():
+        return lifespan_messages.pop(0)
+
+    sent = []
+
+    async def lifespan_send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(router.asgi_application({'type': 'lifespan'}, lifespan_receive, lifespan_send))
+    loop.close()
+    assert sent == [{'type': 'lifespan.startup.complete'}, {'type': 'lifespan.shutdown.complete'}]
+
+
+def test_restomatic_endpoints_asgi():
+    # The default shared (non-pooled) connection is created here, and used from the ASGI pool threads
+    db = SQLiteDB(':memory:', {'test': ['id', 'description', 'value']})
+    db.execute('CREATE TABLE test (id INTEGER PRIMARY KEY, description TEXT, value REAL)')
+    db.commit(no_changes_ok=True)
+
+    router = EndpointRouter(asgi_max_workers=4)
+    register_restomatic_endpoint(router, db, 'test', ['GET', 'POST', 'PATCH'], stream_search=True, ingest=True)
+
+    json_headers = [(b'content-type', b'application/json')]
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'POST', 'path': '/test', 'headers': json_headers},
+                    [json.dumps([{'description': f'test {i}', 'value': i} for i in range(1, 6)]).encode('utf-8')])
+    assert sent[0]['status'] == 201
+    assert json.loads(sent[1]['body']) == {'success': True, 'ids': [1, 2, 3, 4, 5]}
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'POST', 'path': '/test/ingest'},
+                    [b'{"description": "test 6"}\n', b'{"description": "test 7"}\n'])
+    assert json.loads(sent[1]['body']) == {'success': True, 'inserted': 2, 'failed': 0, 'aborted': False, 'errors': []}
+
+    async def concurrent_requests():
+        sent_by_request = [[] for i in range(8)]
+
+        async def request(i, scope, body):
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent_by_request[i].append(message)
+
+            await router.asgi_application(scope, receive, send)
+
+        requests = []
+        for i in range(8):
+            if i % 2:
+                scope = {'type': 'http', 'method': 'PATCH', 'path': f'/test/{i}', 'headers': json_headers}
+                body = json.dumps({'value': i * 10}).encode('utf-8')
+            else:
+                scope = {'type': 'http', 'method': 'GET', 'path': f'/test/{i + 1}'}
+                body = b''
+            requests.append(request(i, scope, body))
+        await asyncio.gather(*requests)
+        return sent_by_request
+
+    loop = asyncio.new_event_loop()
+    try:
+        sent_by_request = loop.run_until_complete(concurrent_requests())
+    finally:
+        loop.close()
+
+    assert [sent[0]['status'] for sent in sent_by_request] == [200] * 8
+    assert json.loads(sent_by_request[2][1]['body'])['description'] == 'test 3'
+
+    sent = run_asgi(router.asgi_application, {'type': 'http', 'method': 'POST', 'path': '/test/search', 'headers': json_headers},
+                    [json.dumps({'where': ['value', 'gte', 10]}).encode('utf-8')])
+    assert sent[0]['status'] == 200
+    assert [r['id'] for r in json.loads(b''.join([m.get('body', b'') for m in sent[1:]]))['results']] == [1, 3, 5, 7]
+
+
+def test_endpoint_router_prefix_matching():
+    tree = PrefixTree()
+    for prefix in ('/test', '/', '/testing', '/te', '/other'):
+        tree.insert(prefix, prefix)
+
+    assert tree.matches('/testing/1') == ['/testing', '/test', '/te', '/']
+    assert tree.matches('/test/1') == ['/test', '/te', '/']
+    assert tree.matches('/t') == ['/']
+    assert tree.matches('/oth') == ['/']
+    assert tree.matches('nope') == []
+
+    router = EndpointRouter()
+
+    router.register_endpoint(static_data='catch all', prefix='/', method='GET')
+    router.register_endpoint(static_data='catch all post', prefix='/', method='POST')
+    router.register_endpoint(static_data='test', prefix='/test', method='GET')
+    router.register_endpoint(static_data='testing', prefix='/testing', method='GET')
+    router.register_endpoint(static_data='testing put', prefix='/testing', method='PUT')
+    router.register_endpoint(static_data='exact', exact='/testing/exact', method='DELETE')
+
+    wsgi = WSGIDebugger(router.application)
+
+    assert wsgi.test_endpoint('GET', '/testing/1') == 'testing'
+    assert wsgi.test_endpoint('GET', '/test/1') == 'test'
+    assert wsgi.test_endpoint('GET', '/elsewhere') == 'catch all'
+    # Shorter prefixes serve methods the longer ones don't have
+    assert wsgi.test_endpoint('POST', '/testing/1') == 'catch all post'
+    assert wsgi.test_endpoint('DELETE', '/testing/exact') == 'exact'
+    assert wsgi.test_endpoint('GET', '/testing/exact') == 'testing'
+
+    # The Allow list is from the exact match, or else the longest matching prefix
+    wsgi.test_endpoint('PATCH', '/testing/1')
+    assert wsgi.status == '405 Method Not Allowed'
+    assert dict(wsgi.headers)['Allow'] == 'GET, PUT'
+    wsgi.test_endpoint('PATCH', '/testing/exact')
+    assert dict(wsgi.headers)['Allow'] == 'DELETE'
+
+    # Routes registered after the first request are matched too
+    router.register_endpoint(static_data='patched', prefix='/testing', method='PATCH')
+    assert wsgi.test_endpoint('PATCH', '/testing/1') == 'patched'
+
+
+@pytest.mark.parametrize('codec_name', ['json', 'orjson'])
+def test_endpoint_router_json_codecs(codec_name):
+    if codec_name == 'orjson':
+        pytest.importorskip('orjson')
+
+    router = EndpointRouter(json_codec=codec_name)
+    assert router.json_codec.name == codec_name
+
+    def endpt_big(request):
+        return {'big': 2 ** 70, 1: 'non-string key', 'text': 'é \U0001F600'}
+
+    def endpt_encoded(request):
+        return EncodedResponse(b'{"already":"bytes"}')
+
+    def endpt_nan(request):
+        return {'nan': float('nan'), 'inf': float('inf')}
+
+    router.register_endpoint(endpt_echo_body, exact='/echo_body', method='PATCH', in_format='json', out_format='json')
+    router.register_endpoint(endpt_big, exact='/big', method='GET', out_format='json')
+    router.register_endpoint(endpt_encoded, exact='/encoded', method='GET', out_format='json')
+    router.register_endpoint(endpt_nan, exact='/nan', method='GET', out_format='json')
+
+    wsgi = WSGIDebugger(router.application)
+
+    response = wsgi.test_endpoint('PATCH', '/echo_body', json.dumps({'testing': ['yep', 1.5, None]}))
+    assert json.loads(response) == {'You sent this request body': {'testing': ['yep', 1.5, None]}}
+    assert wsgi.headers == [('Content-Type', 'application/json; charset=utf-8'), ('Content-Length', str(len(response.encode('utf-8'))))]
+
+    response = wsgi.test_endpoint('GET', '/big')
+    assert json.loads(response) == {'big': 2 ** 70, '1': 'non-string key', 'text': 'é \U0001F600'}
+
+    response = wsgi.test_endpoint('GET', '/encoded')
+    assert response == '{"already":"bytes"}'
+
+    # orjson writes NaN and Infinity as null
+    response = wsgi.test_endpoint('GET', '/nan')
+    if codec_name == 'orjson':
+        assert response == '{"nan":null,"inf":null}'
+    else:
+        assert response == '{"nan": NaN, "inf": Infinity}'
+
+    # The same error messages with either codec
+    response = wsgi.test_endpoint('PATCH', '/echo_body', '{"testing": "missing quote}')
+    assert wsgi.status == '400 Bad Request'
+    assert json.loads(response) == {'message': 'Failed to parse JSON input: Unterminated string starting at: line 1 column 13 (char 12)'}
+
+    with pytest.raises(ValueError):
+        EndpointRouter(json_codec='unknown')
+
+    # orjson is opt-in
+    assert EndpointRouter().json_codec.name == 'json'
+
+
+def test_endpoint_router_compression(monkeypatch):
+    router = EndpointRouter(compression=True, compression_min_size=100, compression_level=9)
+
+    large_data = 'Hello World! ' * 100
+
+    def endpt_stream(request):
+        return StreamingResponse(iter(['{"results":[', '1,' * 50, '2', ']}']))
+
+    router.register_endpoint(static_data=large_data, exact='/large', method='GET', etag=True)
+    router.register_endpoint(static_data='small', exact='/small', method='GET')
+    router.register_endpoint(static_data=large_data, exact='/uncompressed', method='GET', compress=False)
+    router.register_endpoint(endpt_stream, exact='/stream', method='GET', out_format='json')
+
+    wsgi = WSGIDebugger(router.application)
+
+    assert negotiate_encoding('gzip, deflate, br') == 'gzip'
+    assert negotiate_encoding('gzip;q=0.5, deflate') == 'deflate'
+    assert negotiate_encoding('*;q=0.1, gzip;q=0') == 'deflate'
+    assert negotiate_encoding('br, identity') is None
+    assert negotiate_encoding(None) is None
+
+    for accept_encoding, decompress in (('gzip', gzip.decompress), ('deflate;q=1.0, gzip;q=0.5', zlib.decompress)):
+        body = b''.join(router.application({'REQUEST_METHOD': 'GET', 'REQUEST_URI': '/large',
+                                            'HTTP_ACCEPT_ENCODING': accept_encoding}, wsgi.start_response))
+        headers = dict(wsgi.headers)
+        encoding = accept_encoding.split(';')[0]
+        assert decompress(body).decode('utf-8') == large_data
+        assert headers['Content-Encoding'] == encoding
+        assert headers['Content-Length'] == str(len(body))
+        assert headers['Vary'] == 'Accept-Encoding'
+        assert headers['ETag'].endswith(f'-{encoding}"')
+
+    # Both representations' ETags are accepted
+    etag = headers['ETag']
+    response = wsgi.test_endpoint('GET', '/large', headers={'If-None-Match': etag})
+    assert wsgi.status == '304 Not Modified'
+    assert dict(wsgi.headers)['ETag'] == etag.replace('-deflate', '')
+
+    # With an etag function, 304s have the same ETag as the 200, so even small responses are compressed
+    router.register_endpoint(static_data='small', exact='/versioned', method='GET', etag=lambda request: 'v1')
+    response = b''.join(router.application({'REQUEST_METHOD': 'GET', 'REQUEST_URI': '/versioned',
+                                            'HTTP_ACCEPT_ENCODING': 'gzip'}, wsgi.start_response))
+    assert gzip.decompress(response) == b'small'
+    versioned_etag = dict(wsgi.headers)['ETag']
+    assert versioned_etag == '"v1-gzip"'
+    response = wsgi.test_endpoint('GET', '/versioned', headers={'If-None-Match': versioned_etag, 'Accept-Encoding': 'gzip'})
+    assert wsgi.status == '304 Not Modified'
+    assert dict(wsgi.headers)['ETag'] == versioned_etag
+
+    # Not modified responses are not compressed at all
+    compressed = []
+    monkeypatch.setattr(wsgi_endpoint_router, 'compress_response',
+                        lambda data, encoding, level: compressed.append(encoding) or zlib.compress(data))
+    response = wsgi.test_endpoint('GET', '/large', headers={'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+    assert wsgi.status == '304 Not Modified'
+    assert dict(wsgi.headers)['ETag'] == etag.replace('-deflate', '-gzip')
+    assert compressed == []
+    monkeypatch.undo()
+
+    response = wsgi.test_endpoint('GET', '/large')
+    assert response == large_data
+    assert 'Content-Encoding' not in dict(wsgi.headers)
+    assert dict(wsgi.headers)['Vary'] == 'Accept-Encoding'
+
+    response = wsgi.test_endpoint('GET', '/small', headers={'Accept-Encoding': 'gzip'})
+    assert response == 'small'
+    assert dict(wsgi.headers) == {'Content-Type': 'text/plain; charset=utf-8', 'Vary': 'Accept-Encoding', 'Content-Length': '5'}
+
+    response = wsgi.test_endpoint('GET', '/uncompressed', headers={'Accept-Encoding': 'gzip'})
+    assert response == large_data
+    assert 'Vary' not in dict(wsgi.headers)
+
+    body = b''.join(router.application({'REQUEST_METHOD': 'GET', 'REQUEST_URI': '/stream',
+                                        'HTTP_ACCEPT_ENCODING': 'gzip'}, wsgi.start_response))
+    assert json.loads(gzip.decompress(body)) == {'results': [1] * 50 + [2]}
+    assert dict(wsgi.headers) == {'Content-Type': 'application/json; charset=utf-8', 'Vary': 'Accept-Encoding',
+                                  'Content-Encoding': 'gzip'}